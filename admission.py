@@ -0,0 +1,375 @@
+import argparse
+import asyncio
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from dotenv import load_dotenv
+
+import metrics
+
+# Admission control for the expensive report routes (/create_report and
+# /create_reports), whose uploads cost PlantNet and OpenAI calls.
+#
+# Every gunicorn worker on the host shares the limiter state through one
+# SQLite file, so the limits hold for the whole host, not per process:
+#
+#   - Token buckets per user (email) and per client IP. A report takes one
+#     token from each bucket, and a batch takes one per image. A request
+#     without tokens gets 429 with the time until the bucket refills.
+#   - A cap on pipelines (identification and classification) in flight at
+#     once, across every worker, thread and asyncio task. A request that
+#     finds every slot taken waits for one, unless too many requests are
+#     already waiting or none frees up in time; then it is shed with 429.
+#     Background jobs always wait, since their queue is already bounded.
+#   - A cap on expensive requests in progress at once, so a flood of uploads
+#     cannot occupy every worker thread and the cheap read routes
+#     (/getMarkers and the like), which never go through admission, keep the
+#     rest of the capacity.
+#
+# Slots are leases in the same file; a lease left behind by a crashed process
+# expires, or is dropped as soon as its process is gone.
+#
+# to see the current state: python admission.py stats
+
+load_dotenv()
+
+POLL_SECONDS = 0.05
+# Retry-After, in seconds, for requests shed for lack of a slot or queue space.
+RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+
+
+class Rejected(Exception):
+    """Raised when a request is not admitted. retry_after is in seconds."""
+
+    def __init__(self, message, reason, retry_after):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """
+    Token buckets and slot leases in a SQLite file shared by every process
+    on the host. Each change runs in a BEGIN IMMEDIATE transaction.
+    """
+
+    def __init__(self, path, lease_ttl):
+        self._path = path
+        self._lease_ttl = lease_ttl
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, pid INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS leases_kind ON leases (kind, expires_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def take(self, buckets, cost=1):
+        """
+        Takes cost tokens from every bucket, or from none of them.
+
+        Parameters:
+            buckets (list): (key, rate per second, burst) for each bucket.
+            cost (int): Tokens to take. A cost above a bucket's burst is let
+                through once the bucket is full, leaving it in debt.
+
+        Returns:
+            (None, 0) if the tokens were taken, otherwise (key, seconds until
+            that bucket has enough tokens).
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            levels = []
+            for key, rate, burst in buckets:
+                row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                needed = min(cost, burst)
+                if tokens < needed:
+                    return key, (needed - tokens) / rate
+                levels.append((key, tokens - cost))
+            conn.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                             [(key, tokens, now) for key, tokens in levels])
+            # Full buckets carry no state; drop the idle ones now and then.
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - 86400,))
+        return None, 0
+
+    def acquire(self, kind, limit):
+        """Takes a lease of this kind if fewer than limit are held. Returns its ID or None."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            held = conn.execute("SELECT pid FROM leases WHERE kind = ?", (kind,)).fetchall()
+            if len(held) >= limit:
+                gone = [pid for pid in {row[0] for row in held} if not _alive(pid)]
+                if not gone:
+                    return None
+                conn.executemany("DELETE FROM leases WHERE pid = ?", [(pid,) for pid in gone])
+                if len([row for row in held if row[0] not in gone]) >= limit:
+                    return None
+            lease_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO leases (id, kind, pid, expires_at) VALUES (?, ?, ?, ?)",
+                         (lease_id, kind, os.getpid(), now + self._lease_ttl))
+        return lease_id
+
+    def release(self, lease_id):
+        self._connect().execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+
+    def stats(self):
+        """Returns the leases held by kind and the number of buckets not full."""
+        conn = self._connect()
+        leases = dict(conn.execute(
+            "SELECT kind, COUNT(*) FROM leases WHERE expires_at >= ? GROUP BY kind", (time.time(),)
+        ).fetchall())
+        return {"leases": leases, "buckets": conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_control = None
+_control_pid = None
+_control_lock = threading.Lock()
+
+
+def get_control():
+    """
+    Returns this process's admission control, or None if ADMISSION=off.
+    Created per PID, so gunicorn workers do not share a forked connection.
+
+    Environment:
+        ADMISSION_DB: SQLite file shared by the workers (default admission.db).
+        ADMISSION_LEASE_TTL: Seconds before a slot left by a crashed process
+            is freed (default 600).
+        Limits: see admit and pipeline_slot.
+    """
+    global _control, _control_pid
+    if os.getenv("ADMISSION", "on").lower() == "off":
+        return None
+    with _control_lock:
+        if _control is None or _control_pid != os.getpid():
+            _control = AdmissionControl(os.getenv("ADMISSION_DB", "admission.db"),
+                                        float(os.getenv("ADMISSION_LEASE_TTL", "600")))
+            _control_pid = os.getpid()
+        return _control
+
+
+def client_ip(remote_addr, forwarded_for=None):
+    """
+    Returns the client address to rate limit: the peer address, or with
+    ADMISSION_TRUSTED_PROXIES=n, the address in X-Forwarded-For that the
+    outermost of our n proxies saw.
+    """
+    proxies = int(os.getenv("ADMISSION_TRUSTED_PROXIES", "0"))
+    if proxies <= 0 or not forwarded_for:
+        return remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+    return hops[-proxies] if len(hops) >= proxies else remote_addr
+
+
+def _reject(route, reason, message, retry_after):
+    metrics.inc("admission_requests_total", route=route, outcome=reason)
+    return Rejected(message, reason, retry_after)
+
+
+class Ticket:
+    """An admitted expensive request. release() frees its request slot."""
+
+    def __init__(self, control=None, lease_id=None):
+        self._control = control
+        self._lease_id = lease_id
+
+    def release(self):
+        if self._lease_id is not None:
+            lease_id, self._lease_id = self._lease_id, None
+            self._control.release(lease_id)
+
+
+def admit(route, email, ip, cost=1):
+    """
+    Admits an expensive request, taking cost tokens from the user's and the
+    client IP's buckets and a request slot.
+
+    Parameters:
+        route (str): Route name, used as a metrics label.
+        email (str): Reporter's email.
+        ip (str): Client address.
+        cost (int): Reports the request creates.
+
+    Returns:
+        A Ticket to release when the response is done.
+
+    Raises:
+        Rejected: With reason "user_rate" or "ip_rate" when a bucket is empty,
+            or "busy" when every request slot is taken.
+
+    Environment:
+        ADMISSION_USER_RATE: Reports per minute per user (default 10).
+        ADMISSION_USER_BURST: Reports a user may send at once (default 20).
+        ADMISSION_IP_RATE: Reports per minute per client IP (default 30).
+        ADMISSION_IP_BURST: Reports an IP may send at once (default 60).
+        ADMISSION_REQUEST_SLOTS: Expensive requests in progress at once on
+            the host (default 0, no cap). Set it below the total number of
+            worker threads to keep the rest for read routes.
+        ADMISSION_RETRY_AFTER: Retry-After, in seconds, for requests shed
+            for lack of a slot (default 5).
+        ADMISSION_TRUSTED_PROXIES: Proxies in front of the app (see client_ip).
+    """
+    control = get_control()
+    if control is None:
+        return Ticket()
+    buckets = [
+        (f"user:{email}", float(os.getenv("ADMISSION_USER_RATE", "10")) / 60,
+         float(os.getenv("ADMISSION_USER_BURST", "20"))),
+        (f"ip:{ip}", float(os.getenv("ADMISSION_IP_RATE", "30")) / 60,
+         float(os.getenv("ADMISSION_IP_BURST", "60"))),
+    ]
+    key, wait = control.take(buckets, cost)
+    if key is not None:
+        reason = "user_rate" if key.startswith("user:") else "ip_rate"
+        raise _reject(route, reason, "Too many reports, try again later", max(1, math.ceil(wait)))
+
+    slots = int(os.getenv("ADMISSION_REQUEST_SLOTS", "0"))
+    lease_id = None
+    if slots > 0:
+        lease_id = control.acquire("request", slots)
+        if lease_id is None:
+            raise _reject(route, "busy", "Too many reports in progress, try again shortly", RETRY_AFTER)
+    metrics.inc("admission_requests_total", route=route, outcome="admitted")
+    return Ticket(control, lease_id)
+
+
+def _pipeline_limits():
+    return (int(os.getenv("ADMISSION_MAX_PIPELINES", "8")),
+            int(os.getenv("ADMISSION_MAX_WAITING", "16")),
+            float(os.getenv("ADMISSION_WAIT_SECONDS", "10")))
+
+
+def _try_pipeline(control, limit, waiting, shed):
+    # Returns (lease_id, wait_lease_id); lease_id is None if the caller has to wait.
+    lease_id = control.acquire("pipeline", limit)
+    if lease_id is not None or not shed:
+        return lease_id, None
+    wait_lease_id = control.acquire("pipeline_wait", waiting)
+    if wait_lease_id is None:
+        raise _reject("pipeline", "overloaded", "Too many reports in progress, try again shortly", RETRY_AFTER)
+    return None, wait_lease_id
+
+
+def _timed_out(control, wait_lease_id):
+    control.release(wait_lease_id)
+    return _reject("pipeline", "overloaded", "Too many reports in progress, try again shortly", RETRY_AFTER)
+
+
+@contextmanager
+def pipeline_slot(shed=True):
+    """
+    Holds one of the host's pipeline slots while the body runs, waiting for
+    one if they are all taken.
+
+    Parameters:
+        shed (bool): Give up instead of waiting when ADMISSION_MAX_WAITING
+            requests are already waiting or no slot frees up within
+            ADMISSION_WAIT_SECONDS. False waits as long as it takes.
+
+    Raises:
+        Rejected: With reason "overloaded" when shed.
+
+    Environment:
+        ADMISSION_MAX_PIPELINES: Pipelines in flight at once on the host (default 8, 0 for no cap).
+        ADMISSION_MAX_WAITING: Requests waiting for a slot before more are shed (default 16).
+        ADMISSION_WAIT_SECONDS: Longest wait for a slot (default 10).
+    """
+    control = get_control()
+    limit, waiting, wait_seconds = _pipeline_limits()
+    if control is None or limit <= 0:
+        yield
+        return
+    started = time.monotonic()
+    lease_id, wait_lease_id = _try_pipeline(control, limit, waiting, shed)
+    while lease_id is None:
+        if wait_lease_id is not None and time.monotonic() - started >= wait_seconds:
+            raise _timed_out(control, wait_lease_id)
+        time.sleep(POLL_SECONDS * random.uniform(0.5, 1.5))
+        lease_id = control.acquire("pipeline", limit)
+    if wait_lease_id is not None:
+        control.release(wait_lease_id)
+    metrics.observe("admission_wait_seconds", time.monotonic() - started)
+    try:
+        yield
+    finally:
+        control.release(lease_id)
+
+
+@asynccontextmanager
+async def pipeline_slot_async(shed=True):
+    """pipeline_slot for the ASGI app: waits with asyncio.sleep and runs SQLite on worker threads."""
+    control = get_control()
+    limit, waiting, wait_seconds = _pipeline_limits()
+    if control is None or limit <= 0:
+        yield
+        return
+    started = time.monotonic()
+    lease_id, wait_lease_id = await asyncio.to_thread(_try_pipeline, control, limit, waiting, shed)
+    while lease_id is None:
+        if wait_lease_id is not None and time.monotonic() - started >= wait_seconds:
+            raise await asyncio.to_thread(_timed_out, control, wait_lease_id)
+        await asyncio.sleep(POLL_SECONDS * random.uniform(0.5, 1.5))
+        lease_id = await asyncio.to_thread(control.acquire, "pipeline", limit)
+    if wait_lease_id is not None:
+        await asyncio.to_thread(control.release, wait_lease_id)
+    metrics.observe("admission_wait_seconds", time.monotonic() - started)
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(control.release, lease_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the admission control state.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats")
+    args = parser.parse_args()
+
+    control = get_control()
+    if control is None:
+        print("Admission control is disabled (ADMISSION=off).")
+    else:
+        print(control.stats())
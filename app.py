@@ -1,19 +1,104 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, Response, stream_with_context, after_this_request
 from flask_cors import CORS
 import firebase_admin
 from firebase_admin import credentials, firestore
 import prof as userprofile
 import idplant as idplant
+import admission
 import checkinvasive as ci
 import reports as rp
+import geo
+import imagestore
+import ingest
+import markerview
+import preprocess
+import dataset
+import storage
+import tiles
+import metrics
+import json
+import gzip
+import hashlib
+import math
 from io import BytesIO
 from PIL import Image
 import os 
 
+try:
+    import brotli  # Optional; responses fall back to gzip without it.
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed.
+COMPRESS_MIN_BYTES = 1024
+
 app = Flask(__name__, static_folder='out', static_url_path='/')
 CORS(app)
+# Reject oversized uploads before reading them; leave room for the form fields.
+app.config['MAX_CONTENT_LENGTH'] = preprocess.MAX_UPLOAD_BYTES + 64 * 1024
+# Request timers, Server-Timing headers and /metrics when METRICS=on.
+metrics.init_app(app)
+
+def encode_json(payload, accept_encodings):
+    """
+    Serializes payload for a JSON response, compressed with brotli or gzip
+    when the client accepts it and the body is worth compressing.
+
+    Parameters:
+        payload: The value to serialize.
+        accept_encodings: The parsed Accept-Encoding header (werkzeug Accept).
 
-from firebase_client import db
+    Returns:
+        (body, content_encoding or None, etag) where etag, computed before
+        compression, is meant to be sent as a weak ETag.
+    """
+    body = app.json.dumps(payload).encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    encoding = None
+    if len(body) >= COMPRESS_MIN_BYTES:
+        if brotli is not None and "br" in accept_encodings:
+            body, encoding = brotli.compress(body, quality=5), "br"
+        elif "gzip" in accept_encodings:
+            body, encoding = gzip.compress(body, compresslevel=6), "gzip"
+    return body, encoding, etag
+
+def _json_response(payload):
+    """
+    Returns payload as a JSON response with a weak ETag, answered with 304 when
+    the client already has it, and compressed when the client accepts it.
+    """
+    body, encoding, etag = encode_json(payload, request.accept_encodings)
+    response = Response(body, mimetype="application/json")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    # Weak: the same page is equivalent whichever encoding it was sent with.
+    response.set_etag(etag, weak=True)
+    return response.make_conditional(request)
+
+def _too_many_requests(message, retry_after):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+def _admit(route, email, cost=1):
+    """
+    Admits an expensive request (see admission.admit) and frees its request
+    slot once the response has been sent. Returns None, or the 429 response
+    if it is not admitted.
+    """
+    try:
+        ip = admission.client_ip(request.remote_addr, request.headers.get("X-Forwarded-For"))
+        ticket = admission.admit(route, email, ip, cost)
+    except admission.Rejected as e:
+        return _too_many_requests(str(e), e.retry_after)
+
+    @after_this_request
+    def release(response):
+        response.call_on_close(ticket.release)
+        return response
+    return None
 
 @app.route('/')
 def index():
@@ -28,11 +113,18 @@ def index():
 def create_report():
     """
     Processes a new invasive plant report by:
-      1. Reading the image from the POST request.
-      2. Ensuring the image is in JPEG or PNG format.
-      3. Converting the image data to raw bytes.
-      4. Passing a file-like object to the plant identification function.
+      1. Spooling the image from the POST request under a size cap.
+      2. Downscaling, orienting and re-encoding it (see preprocess.py).
+      3. Passing the prepared image to the plant identification function.
+      4. Checking whether the plant is invasive.
       5. Storing the report in Firestore via the rp module.
+
+    With INGEST_MODE=async (or ?async=1) steps 2-5 run on the ingestion worker
+    pool instead, and the response is 202 with a job ID to poll at
+    /report_status/<job_id>.
+
+    Uploads past the user's or the client's rate limit, or while the host is
+    overloaded, get 429 with a Retry-After header (see admission.py).
     """
     # Retrieve email, latitude, and longitude from the request form.
     email = request.form.get("email")
@@ -40,72 +132,137 @@ def create_report():
     lng = request.form.get("lng")
     if not email or not lat or not lng:
         return jsonify({"error": "Missing email, latitude, or longitude"}), 400
+    try:
+        geo.parse_point(lat, lng)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     # Retrieve the image file from the request (expecting key 'image').
     image_file = request.files.get("image")
     if not image_file:
         return jsonify({"error": "No image provided"}), 400
 
-    # Read the image file data.
-    image_data = image_file.read()
+    rejected = _admit("create_report", email)
+    if rejected is not None:
+        return rejected
 
-    # Use BytesIO to work with the image data.
-    image_stream = BytesIO(image_data)
+    # Spool the upload (to disk past a small threshold) under a hard byte cap.
     try:
-        img = Image.open(image_stream)
-    except Exception as e:
-        return jsonify({"error": "Invalid image file"}), 400
-
-    # Check the image format. If it's not JPEG or PNG, convert it to JPEG.
-    if img.format not in ["JPEG", "PNG"]:
-        output = BytesIO()
-        # JPEG does not support transparency so convert the image to RGB if needed.
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        img.save(output, format="JPEG")
-        output.seek(0)
-        image_for_plant = output
-        # Use the converted bytes for storage.
-        converted_data = output.getvalue()
-        image_blob = converted_data  # Store raw bytes in Firestore.
-    else:
-        # The image is already JPEG or PNG.
-        image_for_plant = BytesIO(image_data)
-        image_blob = image_data  # Store raw bytes in Firestore.
-
-    # Pass the file-like object to the plant identification function.
-    plantResult = idplant.getPlant(image_for_plant)
-    if not plantResult[0]:
-        return jsonify({"error": "Not a plant"}), 400
-
-    invasiveResult = ci.check_invasive_plant(plantResult[1], lat, lng)
-    if invasiveResult[0] == "Not a plant":
-        return jsonify({"error": "Not a plant"}), 400
-
-    # Store the report in Firestore via your reports module.
-    rp.storeInfo(
-        User_Email=email,
-        plant_name=plantResult[1],
-        image_data=image_blob,  # Save the raw bytes.
-        lat=lat,
-        lng=lng,
-        description=invasiveResult[1],
-        invasive_info=invasiveResult[0]
-    )
+        upload = preprocess.spool_upload(image_file.stream)
+    except preprocess.ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+
+    if ingest.async_enabled() or request.args.get("async") == "1":
+        # Only check the header here; decoding happens on the worker.
+        try:
+            preprocess.check_header(upload)
+        except preprocess.ImageRejected as e:
+            upload.close()
+            return jsonify({"error": str(e)}), 400
+        try:
+            job_id = ingest.get_pool().submit(email, lat, lng, upload)
+        except ingest.QueueFull:
+            return _too_many_requests("Too many reports in progress, try again shortly", admission.RETRY_AFTER)
+        status_url = url_for('report_status', job_id=job_id)
+        return jsonify({"job_id": job_id, "status_url": status_url}), 202, {"Location": status_url}
+
+    try:
+        ingest.run_pipeline(email, lat, lng, upload)
+    except ingest.ReportRejected as e:
+        return jsonify({"error": str(e)}), 400
+    except ci.ClassificationFailed:
+        return jsonify({"error": "Could not check whether the plant is invasive, try again shortly"}), 503
+    except ingest.StoreFailed:
+        return jsonify({"error": "Could not store the report, try again shortly"}), 503
+    except admission.Rejected as e:
+        return _too_many_requests(str(e), e.retry_after)
     
     return redirect(url_for('index'))
 
+@app.route('/report_status/<job_id>', methods=['GET'])
+def report_status(job_id):
+    """
+    Returns the progress of an asynchronously submitted report.
+    status is one of queued, running, done, rejected or failed; stage names the
+    pipeline step currently running and result holds the plant name and
+    invasive verdict once the job is done.
+    """
+    job = ingest.get_pool().store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/create_reports', methods=['POST'])
+def create_reports():
+    """
+    Processes a batch of reports from one survey upload. Expects email and
+    one or more 'images' files; 'lat' and 'lng' may be given once per image,
+    in the same order, and images without them are placed by their EXIF GPS
+    position. The response streams one NDJSON outcome per image as it
+    finishes and ends with {"done": true, ...} once every accepted report has
+    been stored (see ingest.run_batch).
+    """
+    request.max_content_length = ingest.BATCH_MAX_IMAGES * preprocess.MAX_UPLOAD_BYTES + 64 * 1024
+
+    email = request.form.get("email")
+    if not email:
+        return jsonify({"error": "Missing email"}), 400
+    image_files = request.files.getlist("images")
+    if not image_files:
+        return jsonify({"error": "No images provided"}), 400
+    if len(image_files) > ingest.BATCH_MAX_IMAGES:
+        return jsonify({"error": f"At most {ingest.BATCH_MAX_IMAGES} images per batch"}), 400
+    lats = request.form.getlist("lat")
+    lngs = request.form.getlist("lng")
+
+    # Each image counts as one report against the rate limits.
+    rejected = _admit("create_reports", email, cost=len(image_files))
+    if rejected is not None:
+        return rejected
+
+    items = []
+    try:
+        for i, image_file in enumerate(image_files):
+            upload = preprocess.spool_upload(image_file.stream)
+            items.append(ingest.BatchItem(image_file.filename, upload,
+                                          lats[i] if i < len(lats) else None,
+                                          lngs[i] if i < len(lngs) else None))
+    except preprocess.ImageRejected as e:
+        for item in items:
+            item.upload.close()
+        return jsonify({"error": f"{image_file.filename}: {e}"}), 413
+
+    def outcomes():
+        for outcome in ingest.run_batch(email, items):
+            yield json.dumps(outcome) + "\n"
+
+    return Response(stream_with_context(outcomes()), mimetype="application/x-ndjson")
+
 @app.route('/getUserReportsInfo', methods=['GET'])
 def get_user_reports_info():
     """
     Example: GET /getUserReportsInfo?email=user@example.com
+
+    Reports are returned newest first. For one page at a time, add limit and
+    then the cursor from the previous page:
+    /getUserReportsInfo?email=...&limit=20&cursor=...&fields=id,plant_name,thumb
+    The response is then {"reports": [...], "next_cursor": <string or null>}.
+    fields limits the fields returned (see reports.REPORT_FIELDS); list views
+    that leave out image skip the image data of older reports entirely.
     """
     email = request.args.get("email")
     if not email:
         return jsonify({"error": "Missing email"}), 400
 
-    # Directly return the response from getUserReportsInfo.
-    return rp.getUserReportsInfo(email)
+    try:
+        fields = rp.parseReportFields(request.args.get("fields"))
+        limit = request.args.get("limit")
+        if limit is not None:
+            limit = max(1, min(int(limit), 200))
+        payload = rp.getUserReportsInfo(email, fields=fields, cursor=request.args.get("cursor"), limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _json_response(payload)
 
 
 @app.route('/getMarkerInfo', methods=['GET'])
@@ -126,7 +283,7 @@ def get_marker_info():
 @app.route('/get_marker', methods=['GET'])
 def get_marker():
     """
-    Retrieves a single marker (report) from Firestore based on its document ID.
+    Retrieves a single marker (report) based on its document ID.
     Expects marker_id as a query parameter.
     Example: /get_marker?marker_id=...
     """
@@ -134,11 +291,9 @@ def get_marker():
     if not marker_id:
         return jsonify({"error": "Missing marker_id"}), 400
     try:
-        doc_ref = db.collection('plant_info').document(marker_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            marker = doc.to_dict()
-            marker["id"] = doc.id
+        marker = storage.get_storage().get_report(marker_id)
+        if marker is not None:
+            marker["id"] = marker_id
             return jsonify(marker)
         else:
             return jsonify({'error': 'Marker not found'}), 404
@@ -158,29 +313,224 @@ def delete_marker():
     if not (name and lat and lng):
         return jsonify({"error": "Missing name, lat, or lng"}), 400
     try:
-        markers_ref = db.collection('plant_info')
-        query = markers_ref.where('plant_name', '==', name) \
-                           .where('lat', '==', str(lat)) \
-                           .where('lng', '==', str(lng)).stream()
-        found = False
-        for doc in query:
-            rp.markMarkerAsRemoved(doc.id, True)
-            found = True
-        if found:
+        # Match on the numeric coordinates through the geohash index, so a
+        # different float formatting of lat/lng still finds the marker.
+        lat_num, lng_num = float(lat), float(lng)
+        tolerance = 1e-7
+        bbox = (lat_num - tolerance, lng_num - tolerance, lat_num + tolerance, lng_num + tolerance)
+        marker_ids = rp.findMarkersInRegion(bbox=bbox, species=name)
+        if not marker_ids:
+            # Reports written before the geohash index only match on the strings.
+            marker_ids = [report_id for report_id, _ in storage.get_storage().reports_at(lat, lng, name)]
+        if marker_ids:
+            rp.bulkRemoveMarkers(marker_ids)
             return jsonify({"message": "Marker(s) marked as removed"})
         else:
             return jsonify({"error": "No marker found with provided criteria"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/bulk_remove_markers', methods=['POST'])
+def bulk_remove_markers():
+    """
+    Marks many markers as removed at once, for crews clearing a whole site.
+    Expects a JSON body with either a list of marker IDs:
+        {"ids": ["...", "..."]}
+    or a region, optionally limited to one species:
+        {"bbox": [south, west, north, east], "species": "..."}
+        {"polygon": [[lat, lng], [lat, lng], [lat, lng], ...], "species": "..."}
+    Returns per-ID outcomes and the number of markers removed.
+    """
+    body = request.get_json(silent=True) or {}
+    ids = body.get("ids")
+    try:
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, str) and i for i in ids):
+                raise ValueError("ids must be a list of marker IDs")
+        elif body.get("polygon") is not None:
+            polygon = geo.parse_polygon(body["polygon"])
+            ids = rp.findMarkersInRegion(polygon=polygon, species=body.get("species"))
+        elif body.get("bbox") is not None:
+            bbox = body["bbox"]
+            bbox = geo.parse_bbox(bbox if isinstance(bbox, str) else ",".join(str(v) for v in bbox))
+            ids = rp.findMarkersInRegion(bbox=bbox, species=body.get("species"))
+        else:
+            raise ValueError("Provide ids, bbox or polygon")
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(rp.bulkRemoveMarkers(ids))
+
 @app.route('/getMarkers', methods=['GET'])
 def get_markers():
     """
     Returns a list of invasive plant markers that have not been marked as removed.
     Each marker is formatted as a point of interest (POI) with a key and location.
+
+    When a bbox is given, only markers inside it are returned, one page at a time:
+    /getMarkers?bbox=south,west,north,east&species=...&cursor=...&limit=...
+    The response is then {"markers": [...], "next_cursor": <string or null>}.
+
+    With since, only changes are returned: /getMarkers?since=<cursor> (use 0
+    the first time) answers {"markers": [...], "removed": [ids], "cursor": ...,
+    "has_more": ...}, where removed lists markers to drop from the local copy.
+    """
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            limit = max(1, min(int(request.args.get("limit", 500)), 1000))
+            return jsonify(rp.getMarkerChanges(since, limit=limit))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    bbox_param = request.args.get("bbox")
+    if not bbox_param:
+        # Serve the pre-serialized body from the in-memory view when it is live.
+        view = markerview.get_view()
+        snapshot = view.snapshot() if view is not None else None
+        if snapshot is not None:
+            body, compressed, etag = snapshot
+            if "gzip" in request.accept_encodings:
+                response = Response(compressed, mimetype="application/json")
+                response.headers["Content-Encoding"] = "gzip"
+                etag += "-gz"
+            else:
+                response = Response(body, mimetype="application/json")
+            response.headers["Vary"] = "Accept-Encoding"
+            response.set_etag(etag)
+            return response.make_conditional(request)
+
+        markers = rp.getMarkers()
+        return jsonify(markers)
+
+    try:
+        bbox = geo.parse_bbox(bbox_param)
+        limit = int(request.args.get("limit", 200))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid bbox or limit: {e}"}), 400
+    limit = max(1, min(limit, 500))
+
+    try:
+        page = rp.getMarkersInBBox(
+            bbox,
+            species=request.args.get("species"),
+            cursor=request.args.get("cursor"),
+            limit=limit
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(page)
+
+@app.route('/getMarkerViewStats', methods=['GET'])
+def get_marker_view_stats():
+    """
+    Returns the size and freshness of this worker's in-memory marker view.
+    """
+    view = markerview.get_view()
+    if view is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(view.stats(), enabled=True))
+
+@app.route('/getMarkerClusters', methods=['GET'])
+def get_marker_clusters():
+    """
+    Returns per-cell marker aggregates for zoomed-out map views.
+    Example: /getMarkerClusters?bbox=south,west,north,east&zoom=8
+    Each cluster has its centroid, marker count, top species and a
+    representative marker ID (see clusters.py).
+    """
+    try:
+        bbox = geo.parse_bbox(request.args.get("bbox", ""))
+        zoom = int(request.args.get("zoom", ""))
+    except ValueError as e:
+        return jsonify({"error": f"Missing or invalid bbox or zoom: {e}"}), 400
+    return jsonify(storage.get_storage().clusters(bbox, zoom))
+
+@app.route('/tiles/<species>/<int:z>/<int:x>/<y>', methods=['GET'])
+def get_density_tile(species, z, x, y):
     """
-    markers = rp.getMarkers()
-    return jsonify(markers)
+    Serves a density heatmap tile of active invasive markers for one species,
+    or every species with species "all" (see tiles.py).
+    Example: /tiles/Pueraria%20montana/12/1135/1602.png (or .json for the
+    compact grid; ?format=json works too). Defaults to PNG.
+
+    Tiles are cached on disk and only recomputed after a report inside them
+    changes, and responses carry a strong ETag for revalidation.
+    """
+    y, _, extension = y.partition(".")
+    tile_format = request.args.get("format") or extension or "png"
+    try:
+        body, etag = tiles.get_tile(species, z, x, int(y), tile_format)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    response = Response(body, mimetype=tiles.FORMATS[tile_format])
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@app.route('/image/<image_hash>', methods=['GET'])
+def get_image(image_hash):
+    """
+    Serves a stored report image by its content hash.
+    Example: /image/<sha256>?size=thumb|medium|full (defaults to full)
+
+    Content behind a hash never changes, so responses carry a strong ETag and
+    can be cached by browsers and CDNs indefinitely.
+    """
+    size = request.args.get("size", "full")
+    if size not in imagestore.SIZES:
+        return jsonify({"error": "size must be one of thumb, medium, full"}), 400
+    if not imagestore.is_valid_hash(image_hash):
+        return jsonify({"error": "Image not found"}), 404
+
+    result = imagestore.get_store().get(image_hash, size)
+    if result is None:
+        return jsonify({"error": "Image not found"}), 404
+    data, content_type = result
+
+    response = Response(data, mimetype=content_type)
+    response.set_etag(f"{image_hash}-{size}")
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response.make_conditional(request)
+
+@app.route('/export', methods=['GET'])
+def export_reports():
+    """
+    Streams every report for partner organizations.
+    Example: /export?format=ndjson|csv|geojson&fields=id,plant_name,lat,lng
+    Defaults to NDJSON with every column except image (see
+    dataset.DEFAULT_FIELDS); reporter emails are never exported. Reports are read and written one page at a time.
+    """
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in dataset.EXPORTERS:
+        return jsonify({"error": "format must be one of ndjson, csv, geojson"}), 400
+    try:
+        fields = dataset.parse_fields(request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rows = dataset.EXPORTERS[export_format](fields)
+    response = Response(stream_with_context(rows), mimetype=dataset.FORMATS[export_format])
+    extension = "json" if export_format == "geojson" else export_format
+    response.headers["Content-Disposition"] = f"attachment; filename=reports.{extension}"
+    return response
+
+@app.route('/import', methods=['POST'])
+def import_reports():
+    """
+    Imports reports from an NDJSON request body, one report per line (see
+    dataset.import_ndjson for the accepted keys). The response streams NDJSON
+    progress records as batches are written and ends with {"done": true, ...}.
+    """
+    # Imports are far larger than image uploads.
+    request.max_content_length = dataset.IMPORT_MAX_BYTES
+
+    def progress():
+        for record in dataset.import_ndjson(request.stream):
+            yield json.dumps(record) + "\n"
+
+    return Response(stream_with_context(progress()), mimetype="application/x-ndjson")
 
 @app.route('/getProfileInfo', methods=['GET'])
 def get_profile_info():
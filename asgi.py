@@ -0,0 +1,191 @@
+import asyncio
+import functools
+import math
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, RedirectResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header, parse_etags
+
+import admission
+import app as flaskapp
+import checkinvasive as ci
+import geo
+import ingest
+import metrics
+import preprocess
+import prof as userprofile
+import reports as rp
+
+# asyncio serving mode.
+#
+# The routes that spend their time waiting on the network (report ingestion,
+# which calls PlantNet, the LLM and storage, and the per-user reads) are
+# served natively on the event loop with the async clients, so one process
+# can hold hundreds of reports in flight without a thread for each. Every
+# other route is passed to the Flask app in app.py, unchanged, on a thread.
+#
+# to run: gunicorn asgi:app -k uvicorn_worker.UvicornWorker
+#
+# The slow-request profiler (METRICS_SLOW_MS) samples thread stacks and only
+# covers the Flask routes; the native routes still get timings and Server-Timing.
+
+# Same request cap as the Flask app (the upload plus the form fields).
+MAX_CONTENT_LENGTH = flaskapp.app.config['MAX_CONTENT_LENGTH']
+
+
+def _timed(endpoint_name):
+    """Records a native route in the request metrics under the Flask endpoint name."""
+    def decorate(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(request):
+            if not metrics.ENABLED:
+                return await endpoint(request)
+            metrics.begin_request()
+            response = await endpoint(request)
+            finished = metrics.finish_request(request.method, endpoint_name, response.status_code,
+                                              len(response.body) if hasattr(response, "body") else None)
+            if finished is not None:
+                response.headers["Server-Timing"] = finished[1]
+            return response
+        return timed
+    return decorate
+
+
+def _json_response(request, payload):
+    # Same body, compression and weak ETag as app._json_response.
+    body, encoding, etag = flaskapp.encode_json(payload, parse_accept_header(request.headers.get("accept-encoding")))
+    headers = {"Vary": "Accept-Encoding", "ETag": f'W/"{etag}"'}
+    if parse_etags(request.headers.get("if-none-match")).contains_weak(etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _too_many_requests(message, retry_after):
+    return JSONResponse({"error": message, "retry_after": retry_after}, 429,
+                        headers={"Retry-After": str(math.ceil(retry_after))})
+
+
+@_timed("create_report")
+async def create_report(request):
+    """
+    Same as the Flask route: runs the ingestion pipeline and redirects to the
+    index, or with INGEST_MODE=async (or ?async=1) answers 202 with a job ID
+    and runs it as an asyncio task.
+    """
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_CONTENT_LENGTH:
+        return JSONResponse({"error": "Request too large"}, 413)
+
+    async with request.form(max_files=1) as form:
+        email = form.get("email")
+        lat = form.get("lat")
+        lng = form.get("lng")
+        if not email or not lat or not lng:
+            return JSONResponse({"error": "Missing email, latitude, or longitude"}, 400)
+        try:
+            geo.parse_point(lat, lng)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, 400)
+
+        image_file = form.get("image")
+        if not isinstance(image_file, UploadFile):
+            return JSONResponse({"error": "No image provided"}, 400)
+
+        ip = admission.client_ip(request.client.host if request.client else None,
+                                 request.headers.get("x-forwarded-for"))
+        try:
+            ticket = await asyncio.to_thread(admission.admit, "create_report", email, ip)
+        except admission.Rejected as e:
+            return _too_many_requests(str(e), e.retry_after)
+        try:
+            return await _ingest_report(request, email, lat, lng, image_file)
+        finally:
+            await asyncio.to_thread(ticket.release)
+
+
+async def _ingest_report(request, email, lat, lng, image_file):
+    # Copy into our own spool under the byte cap; the form's files are
+    # closed when the form is, and async jobs outlive the request.
+    try:
+        upload = await asyncio.to_thread(preprocess.spool_upload, image_file.file)
+    except preprocess.ImageRejected as e:
+        return JSONResponse({"error": str(e)}, 413)
+
+    if ingest.async_enabled() or request.query_params.get("async") == "1":
+        try:
+            await asyncio.to_thread(preprocess.check_header, upload)
+        except preprocess.ImageRejected as e:
+            upload.close()
+            return JSONResponse({"error": str(e)}, 400)
+        try:
+            job_id = ingest.get_async_runner().submit(email, lat, lng, upload)
+        except ingest.QueueFull:
+            return _too_many_requests("Too many reports in progress, try again shortly", admission.RETRY_AFTER)
+        status_url = request.app.url_path_for("report_status", job_id=job_id)
+        return JSONResponse({"job_id": job_id, "status_url": status_url}, 202, headers={"Location": status_url})
+
+    try:
+        await ingest.run_pipeline_async(email, lat, lng, upload)
+    except ingest.ReportRejected as e:
+        return JSONResponse({"error": str(e)}, 400)
+    except ci.ClassificationFailed:
+        return JSONResponse({"error": "Could not check whether the plant is invasive, try again shortly"}, 503)
+    except ingest.StoreFailed:
+        return JSONResponse({"error": "Could not store the report, try again shortly"}, 503)
+    except admission.Rejected as e:
+        return _too_many_requests(str(e), e.retry_after)
+    return RedirectResponse("/", status_code=302)
+
+
+@_timed("report_status")
+async def report_status(request):
+    """Same as the Flask route, for jobs started by either server mode in this process."""
+    job = await asyncio.to_thread(ingest.get_job_store().get, request.path_params["job_id"])
+    if job is None:
+        return JSONResponse({"error": "Job not found"}, 404)
+    return JSONResponse(job)
+
+
+@_timed("get_user_reports_info")
+async def get_user_reports_info(request):
+    """Same as the Flask route (paging, fields, weak ETag and compression)."""
+    email = request.query_params.get("email")
+    if not email:
+        return JSONResponse({"error": "Missing email"}, 400)
+
+    try:
+        fields = rp.parseReportFields(request.query_params.get("fields"))
+        limit = request.query_params.get("limit")
+        if limit is not None:
+            limit = max(1, min(int(limit), 200))
+        payload = await rp.getUserReportsInfoAsync(email, fields=fields, cursor=request.query_params.get("cursor"), limit=limit)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    return _json_response(request, payload)
+
+
+@_timed("get_profile_info")
+async def get_profile_info(request):
+    """Same as the Flask route."""
+    email = request.query_params.get("email")
+    if not email:
+        return JSONResponse({"error": "Missing email"}, 400)
+    user_data = await userprofile.getProfileAsync(email)
+    if not user_data:
+        return JSONResponse({"error": "User not found"}, 404)
+    return _json_response(request, user_data)
+
+
+app = Starlette(routes=[
+    Route('/create_report', create_report, methods=['POST']),
+    Route('/report_status/{job_id}', report_status, methods=['GET']),
+    Route('/getUserReportsInfo', get_user_reports_info, methods=['GET']),
+    Route('/getProfileInfo', get_profile_info, methods=['GET']),
+    # Everything else, including the static frontend, is served by Flask.
+    Mount('/', app=WSGIMiddleware(flaskapp.app)),
+])
@@ -0,0 +1,622 @@
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+import fakeproviders
+
+# End-to-end load and latency benchmark.
+#
+# Starts the fake PlantNet and OpenAI servers (fakeproviders.py), seeds a
+# synthetic dataset into the in-memory Firestore stand-in (or the SQLite
+# backend), serves the real Flask app in-process or under gunicorn, and drives
+# it with a scripted load profile. Per-endpoint throughput, latency
+# percentiles, response sizes and the server's peak RSS are printed and
+# written as JSON, so two commits can be compared with the compare command.
+#
+# to run:     python bench.py run --profile mixed --reports 10000 --output head.json
+# to compare: python bench.py compare base.json head.json
+# Flask vs ASGI (asgi.py) under the same load:
+#             python bench.py versus --profile ingest-burst
+#
+# With --server gunicorn the dataset is seeded once in the gunicorn master
+# (--preload) and each worker gets a copy; with the memory backend, reports
+# created during the run are only visible to the worker that stored them.
+
+REGION = (33.8, -84.3, 36.6, -75.5)  # Roughly North Carolina.
+
+# Each phase runs `concurrency` closed-loop clients for `seconds`, picking
+# requests according to `mix`. Phases with "record": false warm the server up.
+PROFILES = {
+    "read-heavy": [
+        {"name": "warmup", "seconds": 3, "concurrency": 4, "record": False,
+         "mix": {"getMarkers": 1, "getMarkers_bbox": 1}},
+        {"name": "steady", "seconds": 20, "concurrency": 16,
+         "mix": {"getMarkers": 6, "getMarkers_bbox": 3, "getUserReportsInfo": 1}},
+    ],
+    "map": [
+        {"name": "warmup", "seconds": 3, "concurrency": 4, "record": False,
+         "mix": {"getMarkers_bbox": 1, "getMarkerClusters": 1}},
+        {"name": "steady", "seconds": 20, "concurrency": 16,
+         "mix": {"getMarkers_bbox": 6, "getMarkerClusters": 4}},
+    ],
+    "ingest": [
+        {"name": "steady", "seconds": 20, "concurrency": 8, "mix": {"create_report": 1}},
+    ],
+    # Many uploads in flight at once, mostly waiting on the providers.
+    "ingest-burst": [
+        {"name": "warmup", "seconds": 3, "concurrency": 8, "record": False, "mix": {"create_report": 1}},
+        {"name": "burst", "seconds": 20, "concurrency": 128,
+         "mix": {"create_report": 4, "getUserReportsInfo": 1}},
+    ],
+    "mixed": [
+        {"name": "warmup", "seconds": 3, "concurrency": 4, "record": False,
+         "mix": {"getMarkers": 1, "getMarkers_bbox": 1}},
+        {"name": "steady", "seconds": 20, "concurrency": 16,
+         "mix": {"getMarkers": 5, "getMarkers_bbox": 2, "getUserReportsInfo": 2, "create_report": 1}},
+        {"name": "spike", "seconds": 10, "concurrency": 64,
+         "mix": {"getMarkers": 5, "getMarkers_bbox": 2, "getUserReportsInfo": 2, "create_report": 1}},
+    ],
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+# ────────────── Synthetic data ──────────────
+
+def make_image(seed, size=(640, 480), quality=80):
+    """Returns JPEG bytes of a noisy gradient, distinct for every seed."""
+    rng = random.Random(seed)
+    width, height = size
+    base = Image.linear_gradient("L").resize(size)
+    color = Image.merge("RGB", (
+        base.point(lambda v: (v + rng.randrange(256)) % 256),
+        base.rotate(90).resize(size).point(lambda v: (v * 2 + rng.randrange(256)) % 256),
+        Image.effect_noise(size, rng.uniform(20, 80)),
+    ))
+    output = BytesIO()
+    color.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def user_email(i):
+    return f"user{i}@bench.test"
+
+
+def seed_dataset(reports, users, images, seed=0):
+    """
+    Writes synthetic reports through the configured storage backend.
+
+    Reports are spread uniformly over REGION, split between users and the
+    fakeproviders species, about one in ten marked as removed, and share a
+    pool of distinct images in the image store.
+    """
+    import imagestore
+    import reports as rp
+    import storage
+
+    rng = random.Random(seed)
+    store = imagestore.get_store()
+    hashes = [store.put(make_image(seed * 100003 + i)) for i in range(images)] or [None]
+    backend = storage.get_storage()
+    south, west, north, east = REGION
+    chunk = []
+    started = time.monotonic()
+    for i in range(reports):
+        name, invasive = fakeproviders.SPECIES[rng.randrange(len(fakeproviders.SPECIES))]
+        lat = round(rng.uniform(south, north), 6)
+        lng = round(rng.uniform(west, east), 6)
+        chunk.append((None, rp.buildReport(
+            user_email(rng.randrange(users)), name, hashes[i % len(hashes)], lat, lng,
+            "Synthetic benchmark report.", invasive, is_removed=rng.random() < 0.1,
+        )))
+        if len(chunk) == 500:
+            backend.add_reports(chunk)
+            chunk = []
+        if (i + 1) % 100000 == 0:
+            print(f"Seeded {i + 1} reports ({time.monotonic() - started:.0f}s).", file=sys.stderr)
+    if chunk:
+        backend.add_reports(chunk)
+
+
+def seeded_app():
+    """
+    gunicorn entry point (bench:seeded_app()): seeds the dataset described by
+    the BENCH_* environment variables and returns the Flask app.
+    """
+    seed_dataset(
+        int(os.getenv("BENCH_REPORTS", "1000")),
+        int(os.getenv("BENCH_USERS", "100")),
+        int(os.getenv("BENCH_IMAGES", "16")),
+        int(os.getenv("BENCH_SEED", "0")),
+    )
+    # Keep the master from starting a marker view; each worker builds its own
+    # on its first /getMarkers, from the data it inherited.
+    marker_view = os.environ.get("MARKER_VIEW")
+    os.environ["MARKER_VIEW"] = "off"
+    try:
+        import app
+    finally:
+        if marker_view is None:
+            del os.environ["MARKER_VIEW"]
+        else:
+            os.environ["MARKER_VIEW"] = marker_view
+    return app.app
+
+
+def seeded_asgi_app():
+    """
+    gunicorn entry point for the ASGI app (bench:seeded_asgi_app()), seeded
+    like seeded_app.
+    """
+    seeded_app()
+    import asgi
+    return asgi.app
+
+
+# ────────────── Load generation ──────────────
+
+class Workload:
+    """Builds the requests for each endpoint name used in profile mixes."""
+
+    def __init__(self, base_url, users, uploads, seed=0):
+        self.base_url = base_url
+        self.users = users
+        self.uploads = uploads
+        self.rng = random.Random(seed)
+
+    def _bbox(self, span):
+        south, west, north, east = REGION
+        lat = self.rng.uniform(south, north - span)
+        lng = self.rng.uniform(west, east - span)
+        return f"{lat},{lng},{lat + span},{lng + span}"
+
+    def request(self, session, endpoint):
+        """Sends one request and returns the response."""
+        url = self.base_url
+        if endpoint == "getMarkers":
+            return session.get(f"{url}/getMarkers")
+        if endpoint == "getMarkers_bbox":
+            return session.get(f"{url}/getMarkers", params={"bbox": self._bbox(0.25), "limit": 200})
+        if endpoint == "getMarkerClusters":
+            return session.get(f"{url}/getMarkerClusters", params={"bbox": self._bbox(2.0), "zoom": 8})
+        if endpoint == "getUserReportsInfo":
+            return session.get(f"{url}/getUserReportsInfo", params={"email": user_email(self.rng.randrange(self.users))})
+        if endpoint == "create_report":
+            south, west, north, east = REGION
+            form = {
+                "email": user_email(self.rng.randrange(self.users)),
+                "lat": str(round(self.rng.uniform(south, north), 6)),
+                "lng": str(round(self.rng.uniform(west, east), 6)),
+            }
+            image = self.uploads[self.rng.randrange(len(self.uploads))]
+            return session.post(f"{url}/create_report", data=form,
+                                files={"image": ("capture.jpg", image, "image/jpeg")}, allow_redirects=False)
+        raise ValueError(f"Unknown endpoint {endpoint}")
+
+
+def _client(workload, mix, deadline, samples, seed):
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        endpoint = rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            response = workload.request(session, endpoint)
+            elapsed = time.perf_counter() - started
+            size = int(response.headers.get("Content-Length") or len(response.content))
+            samples.append((endpoint, elapsed, response.status_code, size))
+        except requests.RequestException:
+            samples.append((endpoint, time.perf_counter() - started, None, 0))
+    session.close()
+
+
+def run_phase(workload, phase, seed=0):
+    """Runs one profile phase and returns its (endpoint, seconds, status, bytes) samples."""
+    samples = []
+    deadline = time.monotonic() + phase["seconds"]
+    threads = [
+        threading.Thread(target=_client, args=(workload, phase["mix"], deadline, samples, seed * 1000 + i), daemon=True)
+        for i in range(phase["concurrency"])
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, seconds):
+    """Returns per-endpoint throughput, error count, latency percentiles (ms) and sizes."""
+    by_endpoint = {}
+    for endpoint, elapsed, status, size in samples:
+        by_endpoint.setdefault(endpoint, []).append((elapsed, status, size))
+    summary = {}
+    for endpoint, rows in sorted(by_endpoint.items()):
+        latencies = sorted(elapsed * 1000.0 for elapsed, _, _ in rows)
+        sizes = [size for _, status, size in rows if status is not None]
+        errors = sum(1 for _, status, _ in rows if status is None or status >= 400)
+        summary[endpoint] = {
+            "requests": len(rows),
+            "errors": errors,
+            "throughput_rps": len(rows) / seconds,
+            "latency_ms": dict(
+                {f"p{pct}": percentile(latencies, pct) for pct in PERCENTILES},
+                mean=sum(latencies) / len(latencies),
+                max=latencies[-1],
+            ),
+            "response_bytes": {
+                "mean": sum(sizes) / len(sizes) if sizes else 0,
+                "max": max(sizes) if sizes else 0,
+            },
+        }
+    return summary
+
+
+# ────────────── Servers ──────────────
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _peak_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return [int(child) for child in children.read().split()]
+    except OSError:
+        return []
+
+
+class InProcessServer:
+    """Serves the app on a threaded werkzeug server inside this process."""
+
+    def __init__(self, env):
+        self.env = env
+        self.url = None
+        self._server = None
+
+    def start(self):
+        os.environ.update(self.env)
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        app = seeded_app()
+        self._server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def peak_rss_kb(self):
+        # Includes the load generator, which shares the process.
+        return {"total": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "max_worker": None}
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class GunicornServer:
+    """
+    Runs the app under gunicorn in a subprocess, seeded in the master. With
+    app "asgi" the ASGI app runs on uvicorn workers (threads is then unused).
+    """
+
+    def __init__(self, env, workers, threads, ready_timeout, app="flask"):
+        self.env = env
+        self.workers = workers
+        self.threads = threads
+        self.ready_timeout = ready_timeout
+        self.app = app
+        self.url = None
+        self._process = None
+
+    def start(self):
+        port = _free_port()
+        self.url = f"http://127.0.0.1:{port}"
+        command = [
+            sys.executable, "-m", "gunicorn", "--preload",
+            "-w", str(self.workers), "--threads", str(self.threads),
+            "-b", f"127.0.0.1:{port}", "--log-level", "warning",
+        ]
+        if self.app == "asgi":
+            command += ["-k", "uvicorn_worker.UvicornWorker", "bench:seeded_asgi_app()"]
+        else:
+            command.append("bench:seeded_app()")
+        self._process = subprocess.Popen(command, env=dict(os.environ, **self.env),
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("gunicorn exited during startup")
+            try:
+                requests.get(f"{self.url}/getMarkerViewStats", timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.5)
+        self.stop()
+        raise RuntimeError("gunicorn did not become ready in time")
+
+    def peak_rss_kb(self):
+        workers = [_peak_rss_kb(pid) for pid in _children(self._process.pid)]
+        return {"total": _peak_rss_kb(self._process.pid) + sum(workers), "max_worker": max(workers, default=0)}
+
+    def stop(self):
+        self._process.terminate()
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+
+
+# ────────────── Commands ──────────────
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Runs a benchmark and returns the results dictionary."""
+    if args.profile_file:
+        with open(args.profile_file) as profile_file:
+            phases = json.load(profile_file)
+    else:
+        phases = PROFILES[args.profile]
+    if args.duration:
+        phases = [dict(phase, seconds=args.duration) if phase.get("record", True) else phase for phase in phases]
+
+    plantnet = fakeproviders.FakeBehaviour(args.plantnet_latency_ms, args.plantnet_latency_ms / 4, args.plantnet_error_rate)
+    openai = fakeproviders.FakeBehaviour(args.openai_latency_ms, args.openai_latency_ms / 4, args.openai_error_rate)
+    env, fake_servers = fakeproviders.start_all(plantnet, openai)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    env.update({
+        "FIRESTORE_BACKEND": "memory",
+        "STORAGE_BACKEND": args.backend,
+        "STORAGE_SQLITE_PATH": os.path.join(workdir, "reports.db"),
+        "IMAGE_STORE_DIR": os.path.join(workdir, "images"),
+        "INGEST_JOB_DB": os.path.join(workdir, "ingest_jobs.db"),
+        "BENCH_REPORTS": str(args.reports),
+        "BENCH_USERS": str(args.users),
+        "BENCH_IMAGES": str(args.images),
+        "BENCH_SEED": str(args.seed),
+    })
+    if args.provider_concurrency:
+        for provider in ("PLANTNET", "OPENAI"):
+            env[f"{provider}_MAX_CONCURRENCY"] = str(args.provider_concurrency)
+            env[f"{provider}_POOL_SIZE"] = str(args.provider_concurrency)
+    if args.caches:
+        env["ID_CACHE_DB"] = os.path.join(workdir, "id_cache.db")
+        env["VERDICT_CACHE_DB"] = os.path.join(workdir, "verdict_cache.db")
+    else:
+        env["ID_CACHE"] = "off"
+        env["VERDICT_CACHE"] = "off"
+    # Every bench client shares one address, so the per-IP limit would throttle the load.
+    if args.admission:
+        env["ADMISSION_DB"] = os.path.join(workdir, "admission.db")
+    else:
+        env["ADMISSION"] = "off"
+
+    if args.server == "gunicorn":
+        server = GunicornServer(env, args.workers, args.threads, ready_timeout=max(60, args.reports / 2000), app=args.app)
+    elif args.app == "asgi":
+        raise ValueError("--app asgi needs --server gunicorn")
+    else:
+        server = InProcessServer(env)
+    print(f"Seeding {args.reports} reports and starting the {args.app} app on {args.server}...", file=sys.stderr)
+    started = time.monotonic()
+    server.start()
+    startup_seconds = time.monotonic() - started
+
+    width, height = (int(edge) for edge in args.upload_size.split("x"))
+    uploads = [make_image(10_000_000 + i, size=(width, height), quality=92) for i in range(args.uploads)]
+    workload = Workload(server.url, args.users, uploads, seed=args.seed)
+    results = {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("func", "output")},
+        "startup_seconds": startup_seconds,
+        "phases": {},
+    }
+    try:
+        for i, phase in enumerate(phases):
+            print(f"Phase {phase['name']}: {phase['concurrency']} clients for {phase['seconds']}s", file=sys.stderr)
+            samples = run_phase(workload, phase, seed=args.seed + i)
+            if phase.get("record", True):
+                results["phases"][phase["name"]] = {
+                    "seconds": phase["seconds"],
+                    "concurrency": phase["concurrency"],
+                    "endpoints": summarize(samples, phase["seconds"]),
+                }
+        results["peak_rss_kb"] = server.peak_rss_kb()
+    finally:
+        server.stop()
+        for fake in fake_servers:
+            fake.shutdown()
+    results["providers"] = {
+        "plantnet": {"requests": plantnet.requests, "errors": plantnet.errors},
+        "openai": {"requests": openai.requests, "errors": openai.errors},
+    }
+    return results
+
+
+def print_results(results):
+    print(f"commit {results['commit']}  startup {results['startup_seconds']:.1f}s  "
+          f"peak RSS {results['peak_rss_kb']['total'] / 1024:.0f} MiB")
+    header = f"{'phase':<8} {'endpoint':<20} {'req':>7} {'err':>5} {'rps':>8} " \
+             f"{'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'bytes':>9}"
+    print(header)
+    for phase_name, phase in results["phases"].items():
+        for endpoint, stats in phase["endpoints"].items():
+            latency = stats["latency_ms"]
+            print(f"{phase_name:<8} {endpoint:<20} {stats['requests']:>7} {stats['errors']:>5} "
+                  f"{stats['throughput_rps']:>8.1f} {latency['p50']:>8.1f} {latency['p90']:>8.1f} "
+                  f"{latency['p99']:>8.1f} {latency['max']:>8.1f} {stats['response_bytes']['mean']:>9.0f}")
+
+
+def print_versus(results):
+    """Prints per-endpoint throughput and latency of each app side by side."""
+    names = list(results)
+    print("  ".join(f"{name}: peak RSS {result['peak_rss_kb']['total'] / 1024:.0f} MiB" for name, result in results.items()))
+    header = f"{'phase':<8} {'endpoint':<20}" + "".join(
+        f" {name + ' rps':>12} {name + ' p50':>11} {name + ' p99':>11} {name + ' err':>9}" for name in names)
+    print(header + f" {'rps ratio':>10}")
+    first = results[names[0]]
+    for phase_name, phase in first["phases"].items():
+        for endpoint in phase["endpoints"]:
+            row = f"{phase_name:<8} {endpoint:<20}"
+            rps = []
+            for name in names:
+                stats = results[name]["phases"].get(phase_name, {}).get("endpoints", {}).get(endpoint)
+                if stats is None:
+                    row += f" {'-':>12} {'-':>11} {'-':>11} {'-':>9}"
+                    rps.append(None)
+                    continue
+                latency = stats["latency_ms"]
+                row += f" {stats['throughput_rps']:>12.1f} {latency['p50']:>11.1f} {latency['p99']:>11.1f} {stats['errors']:>9}"
+                rps.append(stats["throughput_rps"])
+            if len(rps) == 2 and rps[0] and rps[1] is not None:
+                row += f" {rps[1] / rps[0]:>9.2f}x"
+            print(row)
+
+
+def compare(base, head, threshold):
+    """
+    Compares two result files endpoint by endpoint.
+
+    Returns:
+        A list of regression descriptions: p50/p99 latency or peak RSS up by
+        more than threshold (a fraction), or throughput down by more than it.
+    """
+    regressions = []
+    for phase_name, phase in head["phases"].items():
+        base_phase = base["phases"].get(phase_name)
+        if not base_phase:
+            continue
+        for endpoint, stats in phase["endpoints"].items():
+            before = base_phase["endpoints"].get(endpoint)
+            if not before:
+                continue
+            label = f"{phase_name}/{endpoint}"
+            for pct in ("p50", "p99"):
+                old, new = before["latency_ms"][pct], stats["latency_ms"][pct]
+                if old and new > old * (1 + threshold):
+                    regressions.append(f"{label} {pct} {old:.1f}ms -> {new:.1f}ms")
+            old, new = before["throughput_rps"], stats["throughput_rps"]
+            if old and new < old * (1 - threshold):
+                regressions.append(f"{label} throughput {old:.1f} -> {new:.1f} rps")
+    old, new = base["peak_rss_kb"]["total"], head["peak_rss_kb"]["total"]
+    if old and new > old * (1 + threshold):
+        regressions.append(f"peak RSS {old / 1024:.0f} -> {new / 1024:.0f} MiB")
+    return regressions
+
+
+def _add_run_arguments(parser):
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="mixed")
+    parser.add_argument("--profile-file", help="JSON list of phases, instead of a built-in profile")
+    parser.add_argument("--duration", type=float, help="override the seconds of every recorded phase")
+    parser.add_argument("--reports", type=int, default=10000, help="synthetic reports to seed (1k-1M)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=32, help="distinct images shared by seeded reports")
+    parser.add_argument("--uploads", type=int, default=16, help="distinct phone-sized images to upload")
+    parser.add_argument("--upload-size", default="2016x1512",
+                        help="WIDTHxHEIGHT of uploads; smaller ones make ingestion provider-bound rather than decode-bound")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=("firestore", "sqlite"), default="firestore",
+                        help="storage backend; firestore uses the in-memory stand-in")
+    parser.add_argument("--server", choices=("inprocess", "gunicorn"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--provider-concurrency", type=int,
+                        help="concurrent calls and pooled connections allowed per provider and process")
+    parser.add_argument("--caches", action="store_true", help="keep the identification and verdict caches on")
+    parser.add_argument("--admission", action="store_true", help="keep admission control on (see admission.py)")
+    parser.add_argument("--plantnet-latency-ms", type=float, default=400.0)
+    parser.add_argument("--plantnet-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency-ms", type=float, default=800.0)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the report API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run a load profile")
+    versus_parser = commands.add_parser("versus", help="run a load profile against the Flask and ASGI apps")
+    for command_parser in (run_parser, versus_parser):
+        _add_run_arguments(command_parser)
+    run_parser.add_argument("--app", choices=("flask", "asgi"), default="flask",
+                            help="asgi serves asgi.py on uvicorn workers (needs --server gunicorn)")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        results = run(args)
+        print_results(results)
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(results, output, indent=2)
+    elif args.command == "versus":
+        if args.server != "gunicorn":
+            parser.error("versus needs --server gunicorn")
+        results = {}
+        for app_name in ("flask", "asgi"):
+            args.app = app_name
+            results[app_name] = run(args)
+            print_results(results[app_name])
+        print_versus(results)
+        if args.output:
+            with open(args.output, "w") as output:
+                json.dump(results, output, indent=2)
+    else:
+        with open(args.base) as base_file, open(args.head) as head_file:
+            regressions = compare(json.load(base_file), json.load(head_file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if not regressions:
+            print("No regressions.")
+        sys.exit(1 if regressions else 0)
@@ -1,75 +1,349 @@
-from openai import OpenAI
+import asyncio
+import json
 import os
+import threading
 from dotenv import load_dotenv
-import re
+import invasiveindex
+import metrics
+import verdictcache
+import outbound
 
 # Load API key from .env
 load_dotenv()
 
+# Invasive-species classification.
+#
+# Species listed as invasive for the plant's region in the bundled index
+# (invasiveindex.py) are answered from it. Other verdicts come from the
+# verdict cache when possible. Misses are micro-batched:
+# the first caller waits up to CLASSIFY_BATCH_WINDOW_MS for concurrent callers,
+# then sends one completion covering every distinct (species, region) pair
+# collected, with a JSON schema response format. The reply is parsed strictly
+# and each verdict handed back to the callers waiting on it.
+
+MODEL = "gpt-4o-mini"
+BATCH_WINDOW = float(os.getenv("CLASSIFY_BATCH_WINDOW_MS", "50")) / 1000.0
+BATCH_MAX = int(os.getenv("CLASSIFY_BATCH_MAX", "16"))
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "invasive_verdicts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["verdicts"],
+            "properties": {
+                "verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "additionalProperties": False,
+                        "required": ["index", "invasive", "description"],
+                        "properties": {
+                            "index": {"type": "integer"},
+                            "invasive": {"type": "boolean"},
+                            "description": {"type": "string"},
+                        },
+                    },
+                },
+            },
+        },
+    },
+}
+
+SYSTEM_PROMPT = (
+    "You are a knowledgeable bot about plant species. For each numbered plant, decide whether it is an "
+    "invasive species at its location. For invasive plants, describe its harmful effects and mention the "
+    "location in words, never the coordinates. For other plants, give basic information about the plant. "
+    "Return exactly one verdict per plant, with its index."
+)
+
+
+class ClassificationFailed(Exception):
+    """Raised when no verdict could be obtained (provider error or a reply that does not match the schema)."""
 
-#to run python /Users/billym./HackDuke2025/HackDuke2025/Backend/checkinvasive.py
-def clean_text(text):
-    cleaned = text.replace("\n", " ")
-    
-    # Remove markdown bold markers
-    cleaned = cleaned.replace("**", "")
-    
-    # Remove numbered list markers (e.g., "2. ", "3. ", etc.)
-    cleaned = re.sub(r'\b\d+\.\s*', '', cleaned)
-    
-    # Remove any extra spaces (e.g., multiple spaces in a row)
-    cleaned = re.sub(r'\s+', ' ', cleaned)
-    
-    # Trim leading/trailing whitespace
-    return cleaned.strip()
 
 def check_invasive_plant(plant_name, lat, long):
+    """
+    Returns (is_invasive, description) for a plant at the given coordinates.
+    Species the bundled index lists as invasive in the plant's region are
+    answered from it. Other verdicts come from the verdict cache when
+    possible; misses are batched with concurrent calls into one LLM request,
+    and cached.
+
+    Raises:
+        ClassificationFailed: If the LLM call fails or its reply is malformed.
+    """
+    listing = invasiveindex.lookup(plant_name, lat, long)
+    if listing is not None and listing.description:
+        return True, invasiveindex.describe(listing)
+
+    cache = verdictcache.get_cache()
+    result = cache.get(plant_name, lat, long) if cache is not None else None
+    if result is None:
+        result = get_batcher().classify(plant_name, lat, long)
+        if cache is not None:
+            cache.put(plant_name, lat, long, result)
+    return _listed_verdict(listing, result)
+
+async def check_invasive_plant_async(plant_name, lat, long):
+    """
+    check_invasive_plant for the ASGI app: awaits the LLM on the asyncio
+    client. Verdict cache reads and writes (SQLite) run on a worker thread.
+    """
+    listing = invasiveindex.lookup(plant_name, lat, long)
+    if listing is not None and listing.description:
+        return True, invasiveindex.describe(listing)
+
+    cache = verdictcache.get_cache()
+    result = await asyncio.to_thread(cache.get, plant_name, lat, long) if cache is not None else None
+    if result is None:
+        result = await get_async_batcher().classify(plant_name, lat, long)
+        if cache is not None:
+            await asyncio.to_thread(cache.put, plant_name, lat, long, result)
+    return _listed_verdict(listing, result)
+
+def _listed_verdict(listing, result):
+    # A listed species without a description in the table: the table's
+    # verdict stands, the LLM only supplies the description.
+    if listing is None:
+        return result
+    return True, invasiveindex.describe(listing, result[1] if result[0] else None)
+
+
+# ────────────── Batched requests ──────────────
+
+def _messages(items):
+    plants = [{"index": index, "species": plant_name, "lat": str(lat), "lng": str(lng)}
+              for index, (plant_name, lat, lng) in enumerate(items)]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": "Plants:\n" + json.dumps(plants)},
+    ]
+
+def _parse_verdicts(completion, count):
+    """
+    Returns one (is_invasive, description) tuple per requested plant, in order.
+    Raises ClassificationFailed unless the reply holds exactly one well-formed
+    verdict for each index.
+    """
+    choice = completion.choices[0]
+    if choice.finish_reason != "stop" or getattr(choice.message, "refusal", None):
+        raise ClassificationFailed(f"Incomplete reply ({choice.finish_reason})")
     try:
-        prompt = f"Is the plant '{plant_name}' at these coordinates '{lat}' , '{long}' an invasive species? If yes, return 'true' and list its harmful effects. If no, return 'false' and basic information about the plant. Mention the location of the plant in your response, but do not mention anything regarding coordinates. It is crucial to start the response with true is the plant is invasive and false if it is not. The first word should be true or false."
-
-        client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY")
-        )
-        completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-         messages=[
-                {"role": "system", "content": "You are a knowledgeable bot about plant species."},
-                {"role": "user", "content": prompt}
-            ],
-        )
-
-        content = completion.choices[0].message.content.strip()
-        # Extract the first word (removing punctuation like '.' or ',')
-        print(content)
-        first_word = content.split()[0].strip(".,").lower()
-        
-        if first_word == "true":
-            # Split off the first sentence (assumes the first period marks the end of the "True." marker)
-            parts = content.split('.', 1)
-            # parts[0] is "True", parts[1] is the rest of the message
-            if len(parts) > 1:
-                rest_of_text = parts[1].strip()
-            else:
-                rest_of_text = ""
-            rest_of_text = clean_text(rest_of_text)
-            return (True, rest_of_text)
-        
-        elif first_word == "false":
-            return (False, "Not Invasive")
+        payload = json.loads(choice.message.content)
+    except (TypeError, ValueError) as e:
+        raise ClassificationFailed(f"Reply is not JSON: {e}")
+    verdicts = payload.get("verdicts") if isinstance(payload, dict) else None
+    if not isinstance(verdicts, list):
+        raise ClassificationFailed("Reply has no verdicts")
+
+    results = [None] * count
+    for verdict in verdicts:
+        if not isinstance(verdict, dict) or set(verdict) != {"index", "invasive", "description"}:
+            raise ClassificationFailed(f"Malformed verdict: {verdict!r}")
+        index = verdict["index"]
+        if type(index) is not int or not 0 <= index < count or results[index] is not None:
+            raise ClassificationFailed(f"Unexpected verdict index: {index!r}")
+        if type(verdict["invasive"]) is not bool or not isinstance(verdict["description"], str):
+            raise ClassificationFailed(f"Malformed verdict: {verdict!r}")
+        if verdict["invasive"]:
+            results[index] = (True, verdict["description"].strip())
         else:
-            return (False, "Invalid response")
+            results[index] = (False, "Not Invasive")
+    if None in results:
+        raise ClassificationFailed(f"Reply covers {count - results.count(None)} of {count} plants")
+    return results
 
-        # print(f"Answer: {answer}")
+def _classify(items):
+    metrics.observe("classify_batch_size", len(items), buckets=metrics.BATCH_BUCKETS)
+    try:
+        # Shared client: pooled connections, timeouts, retries and a circuit breaker.
+        completion = outbound.get_provider("openai").chat(
+            model=MODEL, messages=_messages(items), response_format=RESPONSE_FORMAT)
+        return _parse_verdicts(completion, len(items))
+    except ClassificationFailed:
+        raise
+    except Exception as e:
+        # Includes replies too malformed to parse, e.g. without choices.
+        raise ClassificationFailed(str(e))
 
-        # if "true" in answer.lower():
-        #     is_invasive = True
-        #     harmful_effects = answer.replace("true", "").strip()
-        # else:
-        #     is_invasive = False
-        #     harmful_effects = ""
+async def _classify_async(items):
+    metrics.observe("classify_batch_size", len(items), buckets=metrics.BATCH_BUCKETS)
+    try:
+        completion = await outbound.get_async_provider("openai").chat(
+            model=MODEL, messages=_messages(items), response_format=RESPONSE_FORMAT)
+        return _parse_verdicts(completion, len(items))
+    except ClassificationFailed:
+        raise
     except Exception as e:
-        print(f"Error: {e}")
-        return None, None
+        # Includes replies too malformed to parse, e.g. without choices.
+        raise ClassificationFailed(str(e))
+
+
+class _Batch:
+    """Plants collected for one request, deduplicated by (species, region)."""
+
+    def __init__(self, event_class):
+        self.items = []  # (plant_name, lat, lng)
+        self._indexes = {}
+        self.verdicts = None
+        self.error = None
+        self.full = event_class()
+        self.done = event_class()
+
+    def add(self, plant_name, lat, lng):
+        """Adds a plant unless the same species and region are already in, and returns its index."""
+        key = (verdictcache.normalize_species(plant_name), verdictcache.region_key(lat, lng))
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self.items)
+            self.items.append((plant_name, lat, lng))
+        return index
+
+    def finish(self):
+        """Wakes the waiting callers; a batch that ended without verdicts fails."""
+        if self.verdicts is None and self.error is None:
+            self.error = ClassificationFailed("Classification was interrupted")
+        self.done.set()
+
+    def result(self, index):
+        if self.error is not None:
+            raise ClassificationFailed(str(self.error))
+        if self.verdicts is None:
+            raise ClassificationFailed("No verdicts")
+        return self.verdicts[index]
+
+
+class VerdictBatcher:
+    """
+    Batches concurrent classifications from threads. The caller that opens
+    a batch waits up to `window` seconds (or until `max_size` plants are in),
+    sends it, and wakes the other callers.
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def classify(self, plant_name, lat, lng):
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch(threading.Event)
+            index = batch.add(plant_name, lat, lng)
+            if len(batch.items) >= self.max_size:
+                self._pending = None
+                batch.full.set()
+
+        if not leader:
+            batch.done.wait()
+            return batch.result(index)
+
+        try:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            batch.verdicts = _classify(batch.items)
+        except Exception as e:
+            print(f"Error classifying {len(batch.items)} plants: {e}")
+            batch.error = e
+        finally:
+            # Also on KeyboardInterrupt, so the other callers never wait forever.
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            batch.finish()
+        return batch.result(index)
+
+
+class AsyncVerdictBatcher:
+    """VerdictBatcher for coroutines on one event loop."""
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._pending = None
+
+    async def classify(self, plant_name, lat, lng):
+        batch = self._pending
+        leader = batch is None
+        if leader:
+            batch = self._pending = _Batch(asyncio.Event)
+        index = batch.add(plant_name, lat, lng)
+        if len(batch.items) >= self.max_size:
+            self._pending = None
+            batch.full.set()
+
+        if not leader:
+            await batch.done.wait()
+            return batch.result(index)
+
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            if self._pending is batch:
+                self._pending = None
+            batch.verdicts = await _classify_async(batch.items)
+        except Exception as e:
+            print(f"Error classifying {len(batch.items)} plants: {e}")
+            batch.error = e
+        finally:
+            # Also when the leader is cancelled: the followers then fail
+            # instead of waiting forever.
+            if self._pending is batch:
+                self._pending = None
+            batch.finish()
+        return batch.result(index)
+
+
+_batcher = None
+_async_batcher = None
+_batcher_pid = None
+_batcher_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Called with _batcher_lock held.
+    global _batcher, _async_batcher, _batcher_pid
+    if _batcher_pid != os.getpid():
+        _batcher = _async_batcher = None
+        _batcher_pid = os.getpid()
+
+
+def get_batcher():
+    """
+    Returns this process's classification batcher.
+
+    Environment:
+        CLASSIFY_BATCH_WINDOW_MS: How long the first caller waits for others (default 50; 0 disables batching).
+        CLASSIFY_BATCH_MAX: Most plants in one request (default 16).
+    """
+    global _batcher
+    with _batcher_lock:
+        _reset_after_fork()
+        if _batcher is None:
+            _batcher = VerdictBatcher(BATCH_WINDOW, BATCH_MAX)
+        return _batcher
+
+
+def get_async_batcher():
+    """Returns this process's batcher for the ASGI app's event loop."""
+    global _async_batcher
+    with _batcher_lock:
+        _reset_after_fork()
+        if _async_batcher is None:
+            _async_batcher = AsyncVerdictBatcher(BATCH_WINDOW, BATCH_MAX)
+        return _async_batcher
+
 '''
 if __name__ == "__main__":
     plant_name = "Lonicera japonica"  # Replace with any plant name
@@ -77,4 +351,4 @@ if __name__ == "__main__":
     ret = check_invasive_plant(plant_name,"35.9940° N", "78.8986° W")
     #need to store UserId, name, isInvasive, info, location, image
     print(ret)
-'''
\ No newline at end of file
+'''
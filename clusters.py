@@ -0,0 +1,237 @@
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+
+import geo
+
+# Server-side marker clustering for zoomed-out map views.
+#
+# Every active invasive marker is counted in one aggregate document per
+# geohash precision (1 to MAX_PRECISION) in the 'marker_clusters' collection.
+# The document ID is the cell's geohash prefix and it holds the marker count,
+# coordinate sums (for the centroid), per-species counts and a representative
+# marker ID. storeInfo and markMarkerAsRemoved apply +1/-1 increments in the
+# same write as the marker itself, so a cluster request only reads the
+# aggregates for the visible cells, never the markers.
+#
+# to rebuild every aggregate from scratch: python clusters.py
+
+from firebase_client import db
+
+COLLECTION = 'marker_clusters'
+MAX_PRECISION = 7
+TOP_SPECIES = 3
+
+
+def _cells(lat, lng):
+    full = geo.encode(lat, lng, MAX_PRECISION)
+    return [full[:precision] for precision in range(1, MAX_PRECISION + 1)]
+
+
+def add_marker(batch, marker_id, lat, lng, species, delta=1):
+    """
+    Adds (delta=1) or subtracts (delta=-1) one marker from the aggregates of
+    every cell containing it. Writes are added to the given batch or transaction.
+    """
+    for cell in _cells(lat, lng):
+        update = {
+            'cell': cell,
+            'precision': len(cell),
+            'count': firestore.Increment(delta),
+            'sum_lat': firestore.Increment(lat * delta),
+            'sum_lng': firestore.Increment(lng * delta),
+            'species': {species: firestore.Increment(delta)},
+        }
+        if delta > 0:
+            # The most recently added marker represents the cell.
+            update['rep_id'] = marker_id
+        batch.set(db.collection(COLLECTION).document(cell), update, merge=True)
+
+
+def represented_cells(marker_id, lat, lng, transaction=None):
+    """
+    Returns the cells whose representative is the given marker. Call this
+    before remove_marker (inside the same transaction, if any) so the removed
+    marker stops representing them.
+    """
+    refs = [db.collection(COLLECTION).document(cell) for cell in _cells(lat, lng)]
+    return [
+        snap.id for snap in db.get_all(refs, field_paths=['rep_id'], transaction=transaction)
+        if snap.exists and snap.to_dict().get('rep_id') == marker_id
+    ]
+
+
+def remove_marker(batch, marker_id, lat, lng, species, rep_cells=()):
+    """
+    Subtracts one marker from the aggregates of every cell containing it and
+    clears it as the representative of rep_cells (see represented_cells).
+    """
+    add_marker(batch, marker_id, lat, lng, species, delta=-1)
+    for cell in rep_cells:
+        batch.set(db.collection(COLLECTION).document(cell), {'rep_id': firestore.DELETE_FIELD}, merge=True)
+
+
+def accumulate(deltas, lat, lng, species, delta=-1):
+    """
+    Adds one marker's contribution to a {cell: totals} dictionary so many
+    markers can be applied with a single write per cell (see apply_deltas).
+    """
+    for cell in _cells(lat, lng):
+        total = deltas.setdefault(cell, {'count': 0, 'sum_lat': 0.0, 'sum_lng': 0.0, 'species': {}})
+        total['count'] += delta
+        total['sum_lat'] += lat * delta
+        total['sum_lng'] += lng * delta
+        total['species'][species] = total['species'].get(species, 0) + delta
+
+
+def apply_deltas(batch, deltas, removed_ids=()):
+    """
+    Writes accumulated deltas, one merge per cell, into the batch. Cells whose
+    representative is in removed_ids have it cleared.
+
+    Returns:
+        The number of writes added to the batch.
+    """
+    refs = [db.collection(COLLECTION).document(cell) for cell in deltas]
+    reps = {}
+    if removed_ids:
+        for snap in db.get_all(refs, field_paths=['rep_id']):
+            if snap.exists:
+                reps[snap.id] = snap.to_dict().get('rep_id')
+    for ref in refs:
+        total = deltas[ref.id]
+        update = {
+            'cell': ref.id,
+            'precision': len(ref.id),
+            'count': firestore.Increment(total['count']),
+            'sum_lat': firestore.Increment(total['sum_lat']),
+            'sum_lng': firestore.Increment(total['sum_lng']),
+            'species': {name: firestore.Increment(n) for name, n in total['species'].items()},
+        }
+        if reps.get(ref.id) in removed_ids:
+            update['rep_id'] = firestore.DELETE_FIELD
+        batch.set(ref, update, merge=True)
+    return len(refs)
+
+
+def precision_for_zoom(zoom):
+    """
+    Maps a web map zoom level to the geohash precision whose cells are roughly
+    a quarter of a 256px map tile wide.
+    """
+    target_width = 360.0 / (2 ** zoom) / 4
+    for precision in range(1, MAX_PRECISION + 1):
+        if geo.cell_size(precision)[1] <= target_width:
+            return precision
+    return MAX_PRECISION
+
+
+def _repair_rep(cell):
+    # The representative was removed; pick any remaining active marker in the cell.
+    query = db.collection('plant_info') \
+        .where(filter=FieldFilter("removed", "==", False)) \
+        .where(filter=FieldFilter("invasive_info", "==", True)) \
+        .where(filter=FieldFilter("geohash", ">=", cell)) \
+        .where(filter=FieldFilter("geohash", "<", cell + geo.RANGE_END)) \
+        .limit(1)
+    for doc in query.stream():
+        db.collection(COLLECTION).document(cell).set({'rep_id': doc.id}, merge=True)
+        return doc.id
+    return None
+
+
+def getClusters(bbox, zoom):
+    """
+    Returns the cluster aggregates for the cells visible in a bounding box.
+
+    Parameters:
+        bbox (tuple): (south, west, north, east) in degrees.
+        zoom (int): Web map zoom level, used to pick the cell size.
+
+    Returns:
+        A dictionary {"precision": <int>, "clusters": [...]} where each cluster is
+        {"cell", "lat", "lng", "count", "top_species": [{"name", "count"}], "marker_id"}.
+    """
+    precision = precision_for_zoom(zoom)
+    clusters_ref = db.collection(COLLECTION)
+    clusters = []
+    # Read the aggregates with range queries over a few coarser cells instead
+    # of fetching every visible cell by ID, most of which would be empty.
+    for prefix in geo.cover_bbox(bbox, max_cells=8, max_precision=precision):
+        query = clusters_ref.where(filter=FieldFilter("precision", "==", precision)) \
+                            .where(filter=FieldFilter("cell", ">=", prefix)) \
+                            .where(filter=FieldFilter("cell", "<", prefix + geo.RANGE_END))
+        for doc in query.stream():
+            data = doc.to_dict()
+            count = data.get('count', 0)
+            if count <= 0:
+                continue
+            lat = data['sum_lat'] / count
+            lng = data['sum_lng'] / count
+            if not geo.in_bbox(lat, lng, bbox):
+                continue
+            species = sorted(
+                ((name, n) for name, n in (data.get('species') or {}).items() if n > 0),
+                key=lambda item: -item[1]
+            )[:TOP_SPECIES]
+            marker_id = data.get('rep_id') or _repair_rep(doc.id)
+            clusters.append({
+                "cell": doc.id,
+                "lat": lat,
+                "lng": lng,
+                "count": count,
+                "top_species": [{"name": name, "count": n} for name, n in species],
+                "marker_id": marker_id,
+            })
+    return {"precision": precision, "clusters": clusters}
+
+
+def rebuild():
+    """
+    Recomputes every aggregate from the active markers in 'plant_info'.
+    Existing aggregates are deleted first.
+
+    Returns:
+        The number of markers counted.
+    """
+    for doc in db.collection(COLLECTION).stream():
+        doc.reference.delete()
+
+    totals = {}
+    counted = 0
+    query = db.collection('plant_info') \
+        .where(filter=FieldFilter("removed", "==", False)) \
+        .where(filter=FieldFilter("invasive_info", "==", True))
+    for doc in query.select(['lat', 'lng', 'lat_num', 'lng_num', 'plant_name']).stream():
+        data = doc.to_dict()
+        lat = geo.to_float(data.get('lat_num', data.get('lat')))
+        lng = geo.to_float(data.get('lng_num', data.get('lng')))
+        if lat is None or lng is None:
+            continue
+        counted += 1
+        for cell in _cells(lat, lng):
+            total = totals.setdefault(cell, {
+                'cell': cell, 'precision': len(cell), 'count': 0,
+                'sum_lat': 0.0, 'sum_lng': 0.0, 'species': {}, 'rep_id': doc.id,
+            })
+            total['count'] += 1
+            total['sum_lat'] += lat
+            total['sum_lng'] += lng
+            name = data.get('plant_name', doc.id)
+            total['species'][name] = total['species'].get(name, 0) + 1
+
+    batch = db.batch()
+    pending = 0
+    for cell, total in totals.items():
+        batch.set(db.collection(COLLECTION).document(cell), total)
+        pending += 1
+        if pending == 400:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return counted
+
+
+if __name__ == "__main__":
+    print(f"Rebuilt clusters from {rebuild()} markers.")
@@ -0,0 +1,281 @@
+import base64
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+import geo
+import imagestore
+import preprocess
+import reports as rp
+import storage
+
+# Bulk export and import of the 'plant_info' collection for partner organizations.
+#
+# Export walks the reports in document ID order, one page at a time, and
+# yields each report as soon as its page arrives, so memory stays flat however
+# large the dataset is. Only the stored fields behind the requested columns are
+# fetched (a Firestore projection), which keeps legacy inline image bytes off
+# the wire unless "image" is asked for explicitly.
+#
+# Import reads NDJSON one line at a time and writes reports in batches (with
+# their cluster aggregates on Firestore), yielding a progress record after
+# each batch.
+
+load_dotenv()
+
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(512 * 1024 * 1024)))
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "geojson": "application/geo+json",
+}
+
+# Exported column -> stored fields it is built from.
+FIELDS = {
+    "id": [],
+    "plant_name": ["plant_name"],
+    "lat": ["lat", "lat_num"],
+    "lng": ["lng", "lng_num"],
+    "description": ["description"],
+    "invasive_info": ["invasive_info"],
+    "removed": ["removed"],
+    "image_hash": ["image_hash"],
+    "image_url": ["image_hash"],
+    "updated_at": ["updated_at"],
+    "image": ["image"],
+}
+
+# /export needs no credentials, so reporter emails (userEmail, reporters) are
+# never exportable. Inline image bytes are only exported when asked for.
+DEFAULT_FIELDS = [
+    "id", "plant_name", "lat", "lng", "description", "invasive_info",
+    "removed", "image_url", "updated_at",
+]
+
+
+def parse_fields(value):
+    """
+    Parses a comma-separated list of export columns.
+
+    Returns:
+        The list of columns, or DEFAULT_FIELDS when value is empty.
+
+    Raises:
+        ValueError: If a column is unknown.
+    """
+    if not value:
+        return list(DEFAULT_FIELDS)
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _row(doc_id, data, fields):
+    row = {}
+    for field in fields:
+        if field == "id":
+            value = doc_id
+        elif field in ("lat", "lng"):
+            value = geo.to_float(data.get(f"{field}_num", data.get(field)))
+        elif field == "image_url":
+            image_hash = data.get("image_hash")
+            value = imagestore.image_url(image_hash, "full") if image_hash else None
+        elif field == "image":
+            image = data.get("image")
+            value = base64.b64encode(image).decode("utf-8") if image else None
+        else:
+            value = data.get(field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        row[field] = value
+    return row
+
+
+def iter_reports(fields, page_size=EXPORT_PAGE_SIZE):
+    """
+    Yields every report as a dictionary of the requested columns, reading the
+    collection one page at a time in document ID order.
+    """
+    stored = sorted({path for field in fields for path in FIELDS[field]})
+    for doc_id, data in storage.get_storage().iter_reports(stored or ["__name__"], page_size):
+        yield _row(doc_id, data, fields)
+
+
+def export_ndjson(fields):
+    for row in iter_reports(fields):
+        yield json.dumps(row, separators=(",", ":")) + "\n"
+
+
+def export_csv(fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for row in iter_reports(fields):
+        writer.writerow(["" if row[field] is None else row[field] for field in fields])
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_geojson(fields):
+    # The ID and coordinates go in the feature itself, so they are always fetched.
+    columns = fields + [field for field in ("id", "lat", "lng") if field not in fields]
+    yield '{"type":"FeatureCollection","features":['
+    separator = ""
+    for row in iter_reports(columns):
+        lat, lng = row["lat"], row["lng"]
+        feature = {
+            "type": "Feature",
+            "id": row["id"],
+            "geometry": {"type": "Point", "coordinates": [lng, lat]} if lat is not None and lng is not None else None,
+            "properties": {field: row[field] for field in fields if field not in ("id", "lat", "lng")},
+        }
+        yield separator + json.dumps(feature, separators=(",", ":"))
+        separator = ","
+    yield "]}\n"
+
+
+EXPORTERS = {
+    "ndjson": export_ndjson,
+    "csv": export_csv,
+    "geojson": export_geojson,
+}
+
+
+def _parse_record(record):
+    # Returns (doc_id, plant_data) for one import line, raising ValueError if it is unusable.
+    if not isinstance(record, dict):
+        raise ValueError("line is not a JSON object")
+    plant_name = record.get("plant_name")
+    if not isinstance(plant_name, str) or not plant_name:
+        raise ValueError("plant_name is required")
+    lat, lng = geo.to_float(record.get("lat")), geo.to_float(record.get("lng"))
+    if lat is None or lng is None or not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise ValueError("lat and lng must be valid coordinates")
+    doc_id = record.get("id")
+    if doc_id is not None and (not isinstance(doc_id, str) or not doc_id or "/" in doc_id):
+        raise ValueError("id must be a document ID")
+
+    image_hash = record.get("image_hash")
+    if record.get("image"):
+        try:
+            image_data = base64.b64decode(record["image"], validate=True)
+        except (TypeError, ValueError):
+            raise ValueError("image must be base64")
+        # Imported images are prepared like uploads, so a line with bytes
+        # that are not an image is rejected instead of aborting the import.
+        try:
+            image = preprocess.prepare_image(io.BytesIO(image_data))
+        except preprocess.ImageRejected as e:
+            raise ValueError(f"image: {e}")
+        image_hash = imagestore.get_store().put(image.data)
+    elif image_hash is not None and not imagestore.is_valid_hash(image_hash):
+        raise ValueError("image_hash is not a valid hash")
+    removed = record.get("removed", False)
+    if not isinstance(removed, bool):
+        raise ValueError("removed must be true or false")
+
+    plant_data = rp.buildReport(
+        record.get("userEmail"),
+        plant_name,
+        image_hash,
+        record.get("lat"),
+        record.get("lng"),
+        record.get("description"),
+        record.get("invasive_info"),
+        is_removed=removed,
+    )
+    return doc_id, plant_data
+
+
+def import_ndjson(lines, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Imports reports from NDJSON lines in batched writes.
+
+    Each line is a report object with at least plant_name, lat and lng, and
+    optionally id, userEmail, description, invasive_info, removed and either
+    image_hash or base64 image bytes, which are prepared like an upload
+    (see preprocess.prepare_image). Lines whose id already exists are
+    skipped, so re-running an interrupted import is safe.
+
+    Parameters:
+        lines: An iterable of bytes or str lines.
+        batch_size (int): Reports per write batch.
+
+    Yields:
+        {"line", "error"} for each rejected line (or {"lines", "error"} for a
+        batch that failed to commit), a progress dictionary
+        {"processed", "imported", "skipped", "errors"} after every batch, and
+        finally the same dictionary with "done": True.
+    """
+    counts = {"processed": 0, "imported": 0, "skipped": 0, "errors": 0}
+    pending = []
+    seen = set()
+
+    def flush():
+        backend = storage.get_storage()
+        ids = [doc_id for _, doc_id, _ in pending if doc_id is not None]
+        existing = backend.existing_ids(ids) if ids else set()
+        reports = []
+        for _, doc_id, plant_data in pending:
+            if doc_id in existing:
+                counts["skipped"] += 1
+                continue
+            reports.append((doc_id, plant_data))
+        written = len(reports)
+        failed = None
+        if written:
+            try:
+                backend.add_reports(reports)
+            except Exception as e:
+                print(f"Error importing reports: {e}")
+                failed = {"lines": [pending[0][0], pending[-1][0]], "error": str(e)}
+                counts["errors"] += written
+                written = 0
+        counts["imported"] += written
+        if written:
+            rp.invalidateCaches([plant_data for _, plant_data in reports],
+                                [not plant_data["removed"] for _, plant_data in reports])
+        pending.clear()
+        return failed
+
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        if not line.strip():
+            continue
+        counts["processed"] += 1
+        try:
+            doc_id, plant_data = _parse_record(json.loads(line))
+        except ValueError as e:
+            counts["errors"] += 1
+            yield {"line": number, "error": str(e)}
+            continue
+        if doc_id is not None:
+            if doc_id in seen:
+                counts["skipped"] += 1
+                continue
+            seen.add(doc_id)
+        pending.append((number, doc_id, plant_data))
+        if len(pending) >= batch_size:
+            failed = flush()
+            if failed:
+                yield failed
+            yield dict(counts)
+
+    if pending:
+        failed = flush()
+        if failed:
+            yield failed
+    yield dict(counts, done=True)
@@ -0,0 +1,176 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for PlantNet and the OpenAI chat completions API, used by
+# bench.py so benchmarks neither need API keys nor depend on (or pay for) the
+# real services. Each server answers with a configurable latency, jitter and
+# error rate. Point the app at them with PLANTNET_URL and OPENAI_BASE_URL.
+#
+# to run both on their own: python fakeproviders.py --latency-ms 300
+
+SPECIES = [
+    ("Pueraria montana", True),
+    ("Lonicera japonica", True),
+    ("Ailanthus altissima", True),
+    ("Hedera helix", True),
+    ("Quercus alba", False),
+    ("Acer rubrum", False),
+    ("Cornus florida", False),
+    ("Liriodendron tulipifera", False),
+]
+INVASIVE = {name for name, invasive in SPECIES if invasive}
+
+
+class FakeBehaviour:
+    """Latency and failure settings shared by a fake server's handler threads."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Sleeps for the configured latency. Returns False if this call should fail."""
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+        return not failed
+
+
+class _Handler(BaseHTTPRequestHandler):
+    behaviour = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PlantNetHandler(_Handler):
+    def do_POST(self):
+        body = self._read_body()
+        if not self.path.startswith("/v2/identify/"):
+            return self._reply(404, {"error": "Not found"})
+        if not self.behaviour.wait():
+            return self._reply(503, {"error": "Service unavailable"})
+        # Same image, same species, so repeated uploads behave consistently.
+        name = SPECIES[zlib.crc32(body) % len(SPECIES)][0]
+        self._reply(200, {
+            "bestMatch": {"species": {"scientificNameWithoutAuthor": name}, "score": 0.9},
+            "results": [{"score": 0.9, "species": {"scientificNameWithoutAuthor": name}}],
+        })
+
+
+class OpenAIHandler(_Handler):
+    @staticmethod
+    def _verdicts(prompt):
+        # checkinvasive sends the plants as a JSON list on the prompt's last line.
+        plants = json.loads(prompt.splitlines()[-1])
+        return [{
+            "index": plant["index"],
+            "invasive": plant["species"] in INVASIVE,
+            "description": "Invasive in the region. It crowds out native species and degrades habitat."
+                           if plant["species"] in INVASIVE else "Native to the region.",
+        } for plant in plants]
+
+    def do_POST(self):
+        request = json.loads(self._read_body() or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self._reply(404, {"error": {"message": "Not found"}})
+        if not self.behaviour.wait():
+            return self._reply(503, {"error": {"message": "Service unavailable"}})
+        if request.get("response_format", {}).get("type") == "json_schema":
+            content = json.dumps({"verdicts": self._verdicts(request["messages"][-1]["content"])})
+        else:
+            prompt = " ".join(message.get("content", "") for message in request.get("messages", []))
+            invasive = any(name in prompt for name in INVASIVE)
+            if invasive:
+                content = "True. This plant is invasive in the region. It crowds out native species and degrades habitat."
+            else:
+                content = "False. This plant is native to the region."
+        self._reply(200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+
+def start_server(handler_class, behaviour, port=0):
+    """
+    Starts a fake provider on a daemon thread.
+
+    Returns:
+        The ThreadingHTTPServer; its URL is http://127.0.0.1:<server.server_port>.
+    """
+    handler = type(handler_class.__name__, (handler_class,), {"behaviour": behaviour})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=handler_class.__name__, daemon=True).start()
+    return server
+
+
+def start_all(plantnet=None, openai=None):
+    """
+    Starts both fake providers.
+
+    Returns:
+        (env, servers) where env holds the environment variables that point
+        the app at them.
+    """
+    plantnet_server = start_server(PlantNetHandler, plantnet or FakeBehaviour())
+    openai_server = start_server(OpenAIHandler, openai or FakeBehaviour())
+    env = {
+        "PLANTNET_URL": f"http://127.0.0.1:{plantnet_server.server_port}",
+        "PLANTAPIKEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_server.server_port}/v1",
+        "OPENAI_API_KEY": "bench",
+    }
+    return env, [plantnet_server, openai_server]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake PlantNet and OpenAI servers.")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    behaviour = FakeBehaviour(args.latency_ms, args.jitter_ms, args.error_rate)
+    env, servers = start_all(behaviour, behaviour)
+    for key, value in env.items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -1,37 +1,86 @@
 import os
 import json
 import base64
+import threading
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
 from dotenv import load_dotenv  # For local development
 
 load_dotenv()  # Load local .env variables
 
-# Get the Base64 string from the environment variable
-firebase_config_b64 = os.getenv("FIREBASE_CONFIG_BASE64")
-if not firebase_config_b64:
-    raise ValueError("Missing FIREBASE_CONFIG_BASE64 environment variable.")
+def uses_memory_backend():
+    """Returns True when FIRESTORE_BACKEND=memory selects the in-process stand-in."""
+    return os.getenv("FIRESTORE_BACKEND", "firestore").lower() == "memory"
 
-# Strip any extra whitespace
-firebase_config_b64 = firebase_config_b64.strip()
+def _connect():
+    if uses_memory_backend():
+        # In-process stand-in for local runs, tests and benchmarks. Data lives only
+        # as long as the process, and each gunicorn worker gets its own copy.
+        from memory_firestore import MemoryFirestore
+        return MemoryFirestore()
+    else:
+        _initialize_app()
+        # Create and return a Firestore client.
+        return firestore.client()
 
-# Check and add missing padding if necessary
-missing_padding = len(firebase_config_b64) % 4
-if missing_padding:
-    firebase_config_b64 += '=' * (4 - missing_padding)
+def _connect_async():
+    # The stand-in has no async client; storage.get_async_storage runs it on threads instead.
+    if uses_memory_backend():
+        raise ValueError("FIRESTORE_BACKEND=memory has no async client")
+    _initialize_app()
+    return firestore_async.client()
 
-# Decode and parse the JSON credentials
-try:
-    firebase_config_json = base64.b64decode(firebase_config_b64).decode('utf-8')
-except Exception as e:
-    raise ValueError(f"Error decoding Base64 string: {e}")
+def _initialize_app():
+    # Get the Base64 string from the environment variable
+    firebase_config_b64 = os.getenv("FIREBASE_CONFIG_BASE64")
+    if not firebase_config_b64:
+        raise ValueError("Missing FIREBASE_CONFIG_BASE64 environment variable.")
 
-firebase_config = json.loads(firebase_config_json)
+    # Strip any extra whitespace
+    firebase_config_b64 = firebase_config_b64.strip()
 
-# Initialize Firebase Admin if not already initialized.
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_config)
-    firebase_admin.initialize_app(cred)
+    # Check and add missing padding if necessary
+    missing_padding = len(firebase_config_b64) % 4
+    if missing_padding:
+        firebase_config_b64 += '=' * (4 - missing_padding)
 
-# Create and export a Firestore client.
-db = firestore.client()
+    # Decode and parse the JSON credentials
+    try:
+        firebase_config_json = base64.b64decode(firebase_config_b64).decode('utf-8')
+    except Exception as e:
+        raise ValueError(f"Error decoding Base64 string: {e}")
+
+    firebase_config = json.loads(firebase_config_json)
+
+    # Initialize Firebase Admin if not already initialized.
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(firebase_config)
+        firebase_admin.initialize_app(cred)
+
+
+class _LazyClient:
+    """
+    Stands in for the Firestore client and connects on first use, so modules
+    that import db can be loaded without credentials (for example when
+    STORAGE_BACKEND=sqlite never touches Firestore).
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+# Export a Firestore client, and the asyncio client used by the ASGI app (asgi.py).
+db = _LazyClient(_connect)
+async_db = _LazyClient(_connect_async)
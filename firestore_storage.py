@@ -0,0 +1,550 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import FieldFilter
+
+import clusters
+import geo
+import sightings
+import userstats
+
+# Report storage on Firestore (or its in-memory stand-in, FIRESTORE_BACKEND=memory).
+#
+# Reports live in the 'plant_info' collection and profiles in 'users'. Bounding
+# box queries go through the geohash index, and every write that changes the
+# set of active invasive markers updates the 'marker_clusters' aggregates in
+# the same batch or transaction (see clusters.py). Writes that add a report or
+# flip its removed flag also update the user's stats (see userstats.py). New invasive reports go
+# through add_sighting, which may merge them into a nearby report of the same
+# species instead (see sightings.py).
+
+from firebase_client import async_db, db
+
+# Reports per WriteBatch in add_reports. Each report is one write, plus one
+# aggregate write per cluster precision, which stays under the 500-write limit.
+ADD_CHUNK_SIZE = 50
+
+# Markers per WriteBatch in remove_many. Each marker is one write, plus one
+# aggregate write per touched cluster cell.
+BULK_CHUNK_SIZE = 200
+BULK_WORKERS = 4
+
+
+def _coords(data):
+    return geo.to_float(data.get('lat_num', data.get('lat'))), geo.to_float(data.get('lng_num', data.get('lng')))
+
+
+def _created_key(report):
+    # Reports without created_at sort as the oldest.
+    created_at = report[1].get('created_at')
+    return (created_at.timestamp() if created_at else 0.0, report[0])
+
+
+def _user_reports_query(client, email, field_paths, after, limit):
+    query = client.collection('plant_info').where(filter=FieldFilter("userEmail", "==", email))
+    if field_paths:
+        query = query.select(sorted(set(field_paths) | {'created_at'}))
+    if limit is None:
+        # Unpaged reads also return reports written before created_at existed,
+        # so they are sorted in _user_reports_page instead.
+        return query
+    # Needs a composite index on (userEmail, created_at desc, __name__ desc).
+    query = query.order_by('created_at', direction=firestore.Query.DESCENDING) \
+                 .order_by('__name__', direction=firestore.Query.DESCENDING)
+    if after:
+        query = query.start_after({'created_at': after[0], '__name__': after[1]})
+    return query.limit(limit)
+
+
+def _user_reports_page(reports, limit):
+    if limit is None:
+        reports.sort(key=_created_key, reverse=True)
+        return reports, None
+    if len(reports) < limit:
+        return reports, None
+    last_id, last = reports[-1]
+    return reports, (last['created_at'], last_id)
+
+
+def _active_query(species=None, client=db):
+    query = client.collection('plant_info') \
+        .where(filter=FieldFilter("removed", "==", False)) \
+        .where(filter=FieldFilter("invasive_info", "==", True))
+    if species:
+        query = query.where(filter=FieldFilter("plant_name", "==", species))
+    return query
+
+
+def _cell_query(cell, species=None, client=db):
+    return _active_query(species, client) \
+        .where(filter=FieldFilter("geohash", ">=", cell)) \
+        .where(filter=FieldFilter("geohash", "<", cell + geo.RANGE_END)) \
+        .order_by("geohash") \
+        .order_by("__name__")
+
+
+@firestore.transactional
+def _set_removed(transaction, marker_ref, is_removed):
+    # Reads the marker first so the cluster aggregates only change when the
+    # removed flag actually flips, even under concurrent or repeated calls.
+    snapshot = marker_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise ValueError(f"Marker {marker_ref.id} not found")
+    data = snapshot.to_dict()
+    if data.get('removed') == is_removed:
+        return
+    lat, lng = _coords(data)
+    counted = data.get('invasive_info') is True and lat is not None and lng is not None
+    rep_cells = []
+    if counted and is_removed:
+        rep_cells = clusters.represented_cells(marker_ref.id, lat, lng, transaction=transaction)
+
+    transaction.update(marker_ref, {'removed': is_removed, 'updated_at': firestore.SERVER_TIMESTAMP})
+    deltas = {}
+    userstats.count_removed(deltas, data.get('userEmail'), 1 if is_removed else -1)
+    userstats.apply(transaction, db, deltas)
+    if counted:
+        plant_name = data.get('plant_name', marker_ref.id)
+        if is_removed:
+            clusters.remove_marker(transaction, marker_ref.id, lat, lng, plant_name, rep_cells)
+        else:
+            clusters.add_marker(transaction, marker_ref.id, lat, lng, plant_name)
+
+
+def _sighting_reads(client, plant_data, radius_m):
+    # The lock documents and cell queries a sighting transaction reads (see sightings.py).
+    species = plant_data['plant_name']
+    _, cells = sightings.search_area(plant_data['lat_num'], plant_data['lng_num'], radius_m)
+    locks = client.collection(sightings.LOCK_COLLECTION)
+    return [locks.document(sightings.lock_id(species, cell)) for cell in cells], \
+        [_cell_query(cell, species, client) for cell in cells]
+
+
+def _write_sighting(transaction, client, plant_data, radius_m, site):
+    # Merges into the nearest site, or creates a new site and takes its cell lock.
+    deltas = {}
+    userstats.accumulate(deltas, plant_data)
+    userstats.apply(transaction, client, deltas)
+    if site is not None:
+        site_id, site_data = site
+        _update_site(transaction, client, site_id, sightings.merge(site_data, plant_data))
+        return site_id, True
+    doc_ref = client.collection('plant_info').document()
+    _create_site(transaction, client, doc_ref, plant_data, radius_m)
+    return doc_ref.id, False
+
+
+def _create_site(transaction, client, doc_ref, plant_data, radius_m):
+    # Writes a new report with its cluster updates and, for a site that later
+    # reports may merge into, the lock document of its cell.
+    transaction.set(doc_ref, plant_data)
+    if not sightings.mergeable(plant_data):
+        return
+    species = plant_data['plant_name']
+    lat, lng = plant_data['lat_num'], plant_data['lng_num']
+    clusters.add_marker(transaction, doc_ref.id, lat, lng, species)
+    cell = sightings.lock_cell(lat, lng, radius_m)
+    transaction.set(client.collection(sightings.LOCK_COLLECTION).document(sightings.lock_id(species, cell)),
+                    {'species': species, 'cell': cell, 'report_id': doc_ref.id,
+                     'updated_at': firestore.SERVER_TIMESTAMP})
+
+
+def _update_site(transaction, client, site_id, updates):
+    updates = dict(updates)
+    if 'image_hash' in updates:
+        updates['image'] = firestore.DELETE_FIELD
+    updates['updated_at'] = firestore.SERVER_TIMESTAMP
+    transaction.update(client.collection('plant_info').document(site_id), updates)
+
+
+@firestore.transactional
+def _add_sightings(transaction, reports, radius_m):
+    # Every read comes first (Firestore transactions cannot read after writing);
+    # sightings.plan then resolves merges, including within the batch.
+    collection = db.collection('plant_info')
+    candidates = []
+    for plant_data in reports:
+        if not sightings.mergeable(plant_data):
+            candidates.append([])
+            continue
+        lock_refs, queries = _sighting_reads(db, plant_data, radius_m)
+        list(transaction.get_all(lock_refs))
+        candidates.append([(doc.id, doc.to_dict()) for query in queries for doc in transaction.get(query)])
+
+    results, creates, updates = sightings.plan(reports, candidates, radius_m, lambda: collection.document().id)
+    for report_id, plant_data in creates.items():
+        _create_site(transaction, db, collection.document(report_id), plant_data, radius_m)
+    for site_id, changes in updates.items():
+        _update_site(transaction, db, site_id, changes)
+    deltas = {}
+    for plant_data in reports:
+        userstats.accumulate(deltas, plant_data)
+    userstats.apply(transaction, db, deltas)
+    return results
+
+
+@firestore.transactional
+def _add_sighting(transaction, plant_data, radius_m):
+    lock_refs, queries = _sighting_reads(db, plant_data, radius_m)
+    list(transaction.get_all(lock_refs))
+    candidates = [(doc.id, doc.to_dict()) for query in queries for doc in transaction.get(query)]
+    site = sightings.nearest(candidates, plant_data['lat_num'], plant_data['lng_num'], radius_m)
+    return _write_sighting(transaction, db, plant_data, radius_m, site)
+
+
+@firestore.async_transactional
+async def _add_sighting_async(transaction, plant_data, radius_m):
+    lock_refs, queries = _sighting_reads(async_db, plant_data, radius_m)
+    [snap async for snap in async_db.get_all(lock_refs, transaction=transaction)]
+    candidates = []
+    for query in queries:
+        candidates += [(doc.id, doc.to_dict()) async for doc in query.stream(transaction=transaction)]
+    site = sightings.nearest(candidates, plant_data['lat_num'], plant_data['lng_num'], radius_m)
+    return _write_sighting(transaction, async_db, plant_data, radius_m, site)
+
+
+class FirestoreStorage:
+    name = "firestore"
+
+    # ────────────── Writes ──────────────
+
+    def add_reports(self, reports):
+        """
+        Writes new reports built by reports.buildReport, with their cluster
+        aggregate updates, ADD_CHUNK_SIZE reports per batch.
+
+        Parameters:
+            reports (list): (doc_id, plant_data) pairs; doc_id None means auto-generated.
+
+        Returns:
+            The list of document IDs written.
+        """
+        ids = []
+        for start in range(0, len(reports), ADD_CHUNK_SIZE):
+            batch = db.batch()
+            deltas = {}
+            for doc_id, plant_data in reports[start:start + ADD_CHUNK_SIZE]:
+                doc_ref = db.collection('plant_info').document(doc_id)
+                batch.set(doc_ref, plant_data)
+                if plant_data['invasive_info'] is True and not plant_data['removed']:
+                    clusters.add_marker(batch, doc_ref.id, plant_data['lat_num'], plant_data['lng_num'], plant_data['plant_name'])
+                userstats.accumulate(deltas, plant_data)
+                ids.append(doc_ref.id)
+            userstats.apply(batch, db, deltas)
+            batch.commit()
+        return ids
+
+    def add_sighting(self, plant_data, radius_m):
+        """
+        Writes a new report built by reports.buildReport, or merges it into the
+        nearest active report of the same species within radius_m, in one
+        transaction (see sightings.py). Needs the same composite index as
+        markers_in_bbox with species.
+
+        Returns:
+            (report_id, merged): the ID of the report written or merged into,
+            and whether the new report was merged.
+        """
+        return _add_sighting(db.transaction(), plant_data, radius_m)
+
+    def add_sightings(self, reports, radius_m):
+        """
+        add_sighting for a batch: every report is written or merged (into a
+        stored site or one created earlier in the batch) in a single
+        transaction, so the batch is committed at once. A batch is limited by
+        Firestore's 500 writes per commit; a new site costs one write per
+        cluster precision plus two.
+
+        Returns:
+            One (report_id, merged) pair per report, in order.
+        """
+        return _add_sightings(db.transaction(), reports, radius_m)
+
+    def set_removed(self, report_id, is_removed):
+        """
+        Sets a report's removed flag in a transaction. Raises ValueError if the
+        report does not exist.
+        """
+        _set_removed(db.transaction(), db.collection('plant_info').document(report_id), is_removed)
+
+    def _remove_chunk(self, marker_ids):
+        # Marks one chunk of markers as removed with a single WriteBatch.
+        #
+        # Every marker update carries a last-update-time precondition, so if any of
+        # them changed after it was read the whole batch is rejected and the chunk is
+        # retried marker by marker through the transactional path.
+        refs = [db.collection('plant_info').document(marker_id) for marker_id in marker_ids]
+        results = {}
+        batch = db.batch()
+        deltas = {}
+        user_deltas = {}
+        removed_ids = set()
+        for snapshot in db.get_all(refs):
+            if not snapshot.exists:
+                results[snapshot.id] = "not_found"
+                continue
+            data = snapshot.to_dict()
+            if data.get('removed') is True:
+                results[snapshot.id] = "already_removed"
+                continue
+            batch.update(
+                snapshot.reference,
+                {'removed': True, 'updated_at': firestore.SERVER_TIMESTAMP},
+                option=db.write_option(last_update_time=snapshot.update_time)
+            )
+            results[snapshot.id] = "removed"
+            userstats.count_removed(user_deltas, data.get('userEmail'))
+            lat, lng = _coords(data)
+            if data.get('invasive_info') is True and lat is not None and lng is not None:
+                clusters.accumulate(deltas, lat, lng, data.get('plant_name', snapshot.id))
+                removed_ids.add(snapshot.id)
+
+        if "removed" not in results.values():
+            return results
+        clusters.apply_deltas(batch, deltas, removed_ids)
+        userstats.apply(batch, db, user_deltas)
+        try:
+            batch.commit()
+        except FailedPrecondition:
+            # Lost a race with another writer; fall back to one transaction per marker.
+            for marker_id, outcome in results.items():
+                if outcome == "removed":
+                    try:
+                        self.set_removed(marker_id, True)
+                    except Exception as e:
+                        results[marker_id] = f"Error updating marker: {e}"
+        return results
+
+    def remove_many(self, marker_ids):
+        """
+        Marks many markers as removed using chunked, parallel WriteBatch commits.
+
+        Returns:
+            A dictionary {<id>: <outcome>} where outcome is "removed",
+            "already_removed", "not_found" or an error message.
+        """
+        chunks = [marker_ids[i:i + BULK_CHUNK_SIZE] for i in range(0, len(marker_ids), BULK_CHUNK_SIZE)]
+        results = {}
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+            futures = [(chunk, executor.submit(self._remove_chunk, chunk)) for chunk in chunks]
+            for chunk, future in futures:
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    print(f"Error removing markers: {e}")
+                    for marker_id in chunk:
+                        results[marker_id] = f"error: {e}"
+        return results
+
+    # ────────────── Reads ──────────────
+
+    def existing_ids(self, report_ids):
+        """Returns the subset of report_ids that already exist."""
+        refs = [db.collection('plant_info').document(report_id) for report_id in report_ids]
+        return {snap.id for snap in db.get_all(refs, field_paths=[]) if snap.exists}
+
+    def get_report(self, report_id):
+        """Returns a report's fields, or None if it does not exist."""
+        doc = db.collection('plant_info').document(report_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_reports(self, report_ids, field_paths=None):
+        """Returns {id: data} for the reports that exist, reading only field_paths if given."""
+        refs = [db.collection('plant_info').document(report_id) for report_id in report_ids]
+        return {snap.id: snap.to_dict() for snap in db.get_all(refs, field_paths=field_paths) if snap.exists}
+
+    def reports_by_email(self, email, field_paths=None, after=None, limit=None):
+        """
+        Returns one page of a user's reports, newest first.
+
+        Parameters:
+            email (str): The reporter's email.
+            field_paths (list): Stored fields to read (a projection); None reads all.
+            after (tuple): (created_at, id) of the last report of the previous page.
+            limit (int): Page size; None returns every report in one page.
+
+        Returns:
+            ([(id, data), ...], next_position) where next_position is the
+            (created_at, id) of the last report when the page is full, else None.
+        """
+        query = _user_reports_query(db, email, field_paths, after, limit)
+        return _user_reports_page([(doc.id, doc.to_dict()) for doc in query.stream()], limit)
+
+    def reports_at(self, lat, lng, plant_name):
+        """Returns (id, data) pairs whose stored lat/lng strings and plant name match exactly."""
+        query = db.collection('plant_info').where(filter=FieldFilter('lat', '==', str(lat))) \
+                                           .where(filter=FieldFilter('lng', '==', str(lng))) \
+                                           .where(filter=FieldFilter('plant_name', '==', plant_name))
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def active_markers(self):
+        """Returns (id, data) pairs for every invasive report not marked as removed."""
+        return [(doc.id, doc.to_dict()) for doc in _active_query().stream()]
+
+    def markers_in_bbox(self, bbox, species=None, after=None, limit=200):
+        """
+        Returns up to limit active markers inside a bounding box, in
+        (geohash, id) order, starting after the given position.
+
+        The box is covered with a handful of geohash cells and each cell is read
+        with a range query on 'geohash'. This needs a composite index on
+        (removed, invasive_info, geohash, __name__), plus plant_name when
+        species is given.
+
+        Returns:
+            ([(id, data), ...], next_position) where next_position is the
+            (geohash, id) of the last marker when the page is full, else None.
+        """
+        markers = []
+        for cell in geo.cover_bbox(bbox):
+            # Cells are sorted and disjoint, so cells before the cursor are done.
+            if after and cell + geo.RANGE_END <= after[0]:
+                continue
+            query = _cell_query(cell, species)
+
+            # Cells overhang the box, so some documents are trimmed below; keep
+            # reading the cell until it is exhausted or the page is full.
+            position = after if after and after[0] >= cell else None
+            while True:
+                page_query = query
+                if position:
+                    page_query = page_query.start_after({"geohash": position[0], "__name__": position[1]})
+                docs = list(page_query.limit(limit).stream())
+                for doc in docs:
+                    data = doc.to_dict()
+                    position = (data.get('geohash'), doc.id)
+                    lat, lng = _coords(data)
+                    if lat is None or lng is None or not geo.in_bbox(lat, lng, bbox):
+                        continue
+                    markers.append((doc.id, data))
+                    if len(markers) == limit:
+                        return markers, position
+                if len(docs) < limit:
+                    break
+        return markers, None
+
+    def active_in_region(self, bbox, species=None, page_size=500):
+        """
+        Yields (id, data) for the active invasive markers inside a bounding box,
+        read through the geohash index one cell at a time.
+        """
+        for cell in geo.cover_bbox(bbox):
+            query = _cell_query(cell, species)
+            last = None
+            while True:
+                page_query = query.start_after(last) if last is not None else query
+                docs = list(page_query.limit(page_size).stream())
+                for doc in docs:
+                    data = doc.to_dict()
+                    lat, lng = _coords(data)
+                    if lat is not None and lng is not None and geo.in_bbox(lat, lng, bbox):
+                        yield doc.id, data
+                if len(docs) < page_size:
+                    break
+                last = docs[-1]
+
+    def changes(self, after=None, limit=500):
+        """
+        Returns up to limit (id, data) pairs in (updated_at, id) order,
+        starting after the given (datetime, id) position.
+        """
+        query = db.collection('plant_info').order_by('updated_at').order_by('__name__')
+        if after:
+            query = query.start_after({'updated_at': after[0], '__name__': after[1]})
+        return [(doc.id, doc.to_dict()) for doc in query.limit(limit).stream()]
+
+    def iter_reports(self, field_paths=None, page_size=500):
+        """
+        Yields (id, data) for every report in document ID order, reading one
+        page at a time. field_paths limits the fields fetched.
+        """
+        query = db.collection('plant_info').order_by('__name__').limit(page_size)
+        if field_paths:
+            query = query.select(field_paths)
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc is not None else query
+            docs = list(page_query.stream())
+            for doc in docs:
+                yield doc.id, doc.to_dict()
+            if len(docs) < page_size:
+                return
+            last_doc = docs[-1]
+
+    def clusters(self, bbox, zoom):
+        """Returns marker clusters for a viewport from the maintained aggregates (see clusters.py)."""
+        return clusters.getClusters(bbox, zoom)
+
+    # ────────────── Profiles ──────────────
+
+    def get_profile(self, email):
+        """
+        Returns (id, data) for the user with this email, or None. Profiles are
+        read by their email key (see userstats.py); profiles stored before
+        migrate_profiles.py ran are found with a query instead.
+        """
+        doc = db.collection('users').document(userstats.profile_key(email)).get()
+        if doc.exists:
+            return doc.id, doc.to_dict()
+        query = db.collection('users').where(filter=FieldFilter('email', '==', email)).limit(1)
+        for doc in query.stream():
+            return doc.id, doc.to_dict()
+        return None
+
+
+class AsyncFirestoreStorage:
+    """
+    The request path of FirestoreStorage on Firestore's AsyncClient, for the
+    ASGI app. Other operations are passed to `fallback` (the synchronous
+    backend run on worker threads, see storage.ThreadedStorage).
+    """
+
+    name = "firestore"
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+
+    def __getattr__(self, operation):
+        return getattr(self._fallback, operation)
+
+    async def add_reports(self, reports):
+        """Like FirestoreStorage.add_reports."""
+        ids = []
+        for start in range(0, len(reports), ADD_CHUNK_SIZE):
+            batch = async_db.batch()
+            deltas = {}
+            for doc_id, plant_data in reports[start:start + ADD_CHUNK_SIZE]:
+                doc_ref = async_db.collection('plant_info').document(doc_id)
+                batch.set(doc_ref, plant_data)
+                if plant_data['invasive_info'] is True and not plant_data['removed']:
+                    clusters.add_marker(batch, doc_ref.id, plant_data['lat_num'], plant_data['lng_num'], plant_data['plant_name'])
+                userstats.accumulate(deltas, plant_data)
+                ids.append(doc_ref.id)
+            userstats.apply(batch, async_db, deltas)
+            await batch.commit()
+        return ids
+
+    async def add_sighting(self, plant_data, radius_m):
+        """Like FirestoreStorage.add_sighting."""
+        return await _add_sighting_async(async_db.transaction(), plant_data, radius_m)
+
+    async def get_report(self, report_id):
+        """Like FirestoreStorage.get_report."""
+        doc = await async_db.collection('plant_info').document(report_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    async def reports_by_email(self, email, field_paths=None, after=None, limit=None):
+        """Like FirestoreStorage.reports_by_email."""
+        query = _user_reports_query(async_db, email, field_paths, after, limit)
+        return _user_reports_page([(doc.id, doc.to_dict()) async for doc in query.stream()], limit)
+
+    async def get_profile(self, email):
+        """Like FirestoreStorage.get_profile."""
+        doc = await async_db.collection('users').document(userstats.profile_key(email)).get()
+        if doc.exists:
+            return doc.id, doc.to_dict()
+        query = async_db.collection('users').where(filter=FieldFilter('email', '==', email)).limit(1)
+        async for doc in query.stream():
+            return doc.id, doc.to_dict()
+        return None
@@ -0,0 +1,329 @@
+import math
+
+# Geohash helpers used to index plant reports spatially.
+#
+# A geohash interleaves longitude and latitude bits and encodes them in base32,
+# so every prefix of a hash is a rectangular cell that contains all longer
+# hashes starting with it. Storing the full hash on each report lets Firestore
+# answer "all reports inside this cell" with a single range query.
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Precision written on every report. 9 characters is a cell of roughly 5m x 5m.
+INDEX_PRECISION = 9
+
+# Mean Earth radius, and the length of one degree of latitude, in meters.
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180.0
+
+# Sorts after every base32 character, so [prefix, prefix + RANGE_END) is the
+# range of all hashes that start with prefix.
+RANGE_END = "~"
+
+
+def encode(lat, lng, precision=INDEX_PRECISION):
+    """
+    Encodes a coordinate as a geohash string.
+
+    Parameters:
+        lat (float): Latitude in degrees.
+        lng (float): Longitude in degrees.
+        precision (int): Number of base32 characters to return.
+
+    Returns:
+        The geohash as a string.
+    """
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                bits = (bits << 1) | 1
+                lng_lo = mid
+            else:
+                bits = bits << 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_lo = mid
+            else:
+                bits = bits << 1
+                lat_hi = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def decode_bbox(geohash):
+    """
+    Returns the cell covered by a geohash as (min_lat, min_lng, max_lat, max_lng).
+    """
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    even = True
+    for char in geohash:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            if even:
+                mid = (lng_lo + lng_hi) / 2
+                if bit:
+                    lng_lo = mid
+                else:
+                    lng_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if bit:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+    return lat_lo, lng_lo, lat_hi, lng_hi
+
+
+def cell_size(precision):
+    """
+    Returns the (lat_degrees, lng_degrees) size of a cell at the given precision.
+    """
+    total_bits = 5 * precision
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def _cells_at(min_lat, min_lng, max_lat, max_lng, precision):
+    lat_step, lng_step = cell_size(precision)
+    lat_start = math.floor((min_lat + 90.0) / lat_step)
+    lat_stop = min(math.floor((max_lat + 90.0) / lat_step), int(round(180.0 / lat_step)) - 1)
+    lng_start = math.floor((min_lng + 180.0) / lng_step)
+    lng_stop = min(math.floor((max_lng + 180.0) / lng_step), int(round(360.0 / lng_step)) - 1)
+    cells = []
+    for i in range(lat_start, lat_stop + 1):
+        center_lat = -90.0 + (i + 0.5) * lat_step
+        for j in range(lng_start, lng_stop + 1):
+            center_lng = -180.0 + (j + 0.5) * lng_step
+            cells.append(encode(center_lat, center_lng, precision))
+    return cells
+
+
+def _count_at(min_lat, min_lng, max_lat, max_lng, precision):
+    lat_step, lng_step = cell_size(precision)
+    rows = math.floor((max_lat + 90.0) / lat_step) - math.floor((min_lat + 90.0) / lat_step) + 1
+    cols = math.floor((max_lng + 180.0) / lng_step) - math.floor((min_lng + 180.0) / lng_step) + 1
+    return rows * cols
+
+
+def split_bbox(bbox):
+    """
+    Splits a (south, west, north, east) box that crosses the antimeridian into
+    two boxes that do not. Other boxes are returned unchanged in a list.
+    """
+    south, west, north, east = bbox
+    if west <= east:
+        return [bbox]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def cover_bbox(bbox, max_cells=16, max_precision=INDEX_PRECISION):
+    """
+    Returns a sorted list of geohash prefixes whose cells together cover the box.
+
+    The finest precision that needs no more than max_cells cells is used, so a
+    small viewport gets tight cells and a whole-continent viewport gets a few
+    coarse ones.
+
+    Parameters:
+        bbox (tuple): (south, west, north, east) in degrees.
+        max_cells (int): Upper bound on the number of prefixes returned.
+        max_precision (int): Never use cells finer than this.
+
+    Returns:
+        A sorted list of geohash prefixes.
+    """
+    boxes = split_bbox(bbox)
+    precision = 1
+    for candidate in range(1, max_precision + 1):
+        if sum(_count_at(*box, candidate) for box in boxes) > max_cells:
+            break
+        precision = candidate
+    cells = set()
+    for box in boxes:
+        cells.update(_cells_at(*box, precision))
+    return sorted(cells)
+
+
+def cells_covering(bbox, precision):
+    """
+    Returns the sorted geohash cells at a fixed precision that cover the box.
+    Unlike cover_bbox, callers that need the same cells for nearby boxes
+    (such as lock documents) always get the same precision.
+    """
+    cells = set()
+    for box in split_bbox(bbox):
+        cells.update(_cells_at(*box, precision))
+    return sorted(cells)
+
+
+def precision_for_radius(radius_m):
+    """
+    Returns the finest precision whose cells are at least 2 * radius_m on
+    each side (at the equator), so a circle of that radius touches at most
+    four cells.
+    """
+    precision = 1
+    for candidate in range(1, INDEX_PRECISION + 1):
+        lat_step, lng_step = cell_size(candidate)
+        if min(lat_step, lng_step) * METERS_PER_DEGREE < 2 * radius_m:
+            break
+        precision = candidate
+    return precision
+
+
+def radius_bbox(lat, lng, radius_m):
+    """
+    Returns the (south, west, north, east) box around a circle. Near the
+    antimeridian west may be greater than east (see split_bbox).
+    """
+    lat_delta = radius_m / METERS_PER_DEGREE
+    south = max(-90.0, lat - lat_delta)
+    north = min(90.0, lat + lat_delta)
+    cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+    if cos_lat < 1e-9 or radius_m / (METERS_PER_DEGREE * cos_lat) >= 180.0:
+        return south, -180.0, north, 180.0
+    lng_delta = radius_m / (METERS_PER_DEGREE * cos_lat)
+    west = lng - lng_delta
+    east = lng + lng_delta
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    """Returns the great-circle (haversine) distance in meters between two coordinates."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def in_bbox(lat, lng, bbox):
+    """
+    Returns True if the coordinate falls inside the (south, west, north, east) box.
+    """
+    south, west, north, east = bbox
+    if not south <= lat <= north:
+        return False
+    if west <= east:
+        return west <= lng <= east
+    return lng >= west or lng <= east
+
+
+def parse_bbox(value):
+    """
+    Parses a "south,west,north,east" query string value into a tuple of floats.
+
+    Raises:
+        ValueError: If the value is malformed or out of range.
+    """
+    parts = [float(part) for part in value.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be south,west,north,east")
+    south, west, north, east = parts
+    if not (-90.0 <= south <= north <= 90.0):
+        raise ValueError("bbox latitudes must satisfy -90 <= south <= north <= 90")
+    if not (-180.0 <= west <= 180.0 and -180.0 <= east <= 180.0):
+        raise ValueError("bbox longitudes must be between -180 and 180")
+    return south, west, north, east
+
+
+def to_float(value):
+    """
+    Converts a stored coordinate (float, int or string such as "35.99") to a float.
+    Returns None if the value cannot be parsed.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_point(lat, lng):
+    """
+    Parses a latitude and longitude given as strings or numbers.
+
+    Returns:
+        A (lat, lng) tuple of floats.
+
+    Raises:
+        ValueError: If either is not a number or is out of range.
+    """
+    lat, lng = to_float(lat), to_float(lng)
+    if lat is None or lng is None:
+        raise ValueError("Latitude and longitude must be numbers")
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        raise ValueError("Latitude must be between -90 and 90 and longitude between -180 and 180")
+    return lat, lng
+
+
+def parse_polygon(points):
+    """
+    Validates a polygon given as a list of [lat, lng] pairs.
+
+    Returns:
+        A list of (lat, lng) float tuples.
+
+    Raises:
+        ValueError: If there are fewer than three points or a point is malformed.
+    """
+    if not isinstance(points, list) or len(points) < 3:
+        raise ValueError("polygon needs at least three [lat, lng] points")
+    polygon = []
+    for point in points:
+        if not isinstance(point, (list, tuple)) or len(point) != 2:
+            raise ValueError("polygon points must be [lat, lng] pairs")
+        lat, lng = float(point[0]), float(point[1])
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+            raise ValueError("polygon point out of range")
+        polygon.append((lat, lng))
+    return polygon
+
+
+def polygon_bbox(polygon):
+    """Returns the (south, west, north, east) box around a polygon."""
+    lats = [lat for lat, _ in polygon]
+    lngs = [lng for _, lng in polygon]
+    return min(lats), min(lngs), max(lats), max(lngs)
+
+
+def in_polygon(lat, lng, polygon):
+    """
+    Returns True if the coordinate is inside the polygon (ray casting).
+    The polygon is a list of (lat, lng) vertices and need not be closed.
+    """
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = (lng_j - lng_i) * (lat - lat_i) / (lat_j - lat_i) + lng_i
+            if lng < crossing:
+                inside = not inside
+        j = i
+    return inside
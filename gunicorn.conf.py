@@ -0,0 +1,15 @@
+# gunicorn settings shared by the Flask app and the ASGI app; gunicorn loads
+# this file from the working directory on its own.
+#
+# to run: gunicorn app:app
+#         gunicorn asgi:app -k uvicorn_worker.UvicornWorker
+
+
+def post_fork(server, worker):
+    # Each worker runs its own marker listener (see markerview.py); fill it
+    # before the worker takes requests so the first /getMarkers is served
+    # from memory. Imported here so the master never touches Firestore.
+    import markerview
+
+    if markerview.warm_up():
+        server.log.info("Marker view ready in worker %s", worker.pid)
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from io import BytesIO
+
+from dotenv import load_dotenv
+from PIL import Image
+
+# Cache of PlantNet identification results keyed by image content.
+#
+# A retry of the same photo, or a double submit from the frontend, should not
+# cost another PlantNet round trip. Each successful identification is stored
+# under the SHA-256 of the uploaded bytes (exact duplicates) and a 64-bit dHash
+# of the normalized image (near duplicates: re-encoded, resized or slightly
+# re-cropped copies). Near-duplicate lookups compare the Hamming distance of
+# the dHashes against a configurable threshold.
+#
+# The dHash is also split into eight 8-bit bands stored in indexed columns. Two
+# hashes within distance 7 must share at least one band, so candidates are found
+# with an index lookup instead of a table scan.
+
+load_dotenv()
+
+_BANDS = 8
+MAX_SUPPORTED_DISTANCE = _BANDS - 1
+
+
+def content_hash(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def dhash(image_data):
+    """
+    Returns the 64-bit difference hash of an image, or None if it cannot be decoded.
+
+    The image is reduced to a 9x8 grayscale grid and each bit records whether a
+    pixel is brighter than its right-hand neighbour, which survives re-encoding
+    and rescaling.
+    """
+    try:
+        img = Image.open(BytesIO(image_data))
+        # JPEG draft mode decodes at a fraction of full size, which is all we need.
+        img.draft("L", (64, 64))
+        pixels = img.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _bands(value):
+    return [(value >> (8 * i)) & 0xFF for i in range(_BANDS)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class IdentificationCache:
+    def __init__(self, path, ttl_seconds, max_entries, max_distance):
+        self.path = path
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.max_distance = min(max_distance, MAX_SUPPORTED_DISTANCE)
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+        band_columns = ", ".join(f"b{i} INTEGER NOT NULL" for i in range(_BANDS))
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS identifications ("
+                " sha256 TEXT PRIMARY KEY,"
+                " dhash TEXT,"
+                f" {band_columns},"
+                " species TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            for i in range(_BANDS):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS identifications_b{i} ON identifications (b{i})")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS identifications_accessed_at ON identifications (accessed_at)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _touch(self, conn, sha256, now):
+        with conn:
+            conn.execute("UPDATE identifications SET accessed_at = ? WHERE sha256 = ?", (now, sha256))
+
+    def lookup(self, image_data, image_dhash=None):
+        """
+        Returns the cached species for an exact or near-duplicate image, or None.
+
+        Parameters:
+            image_data (bytes): The encoded image.
+            image_dhash (int): The image's dHash if the caller already computed it.
+        """
+        now = time.time()
+        cutoff = now - self.ttl
+        conn = self._connect()
+        sha256 = content_hash(image_data)
+        row = conn.execute(
+            "SELECT species FROM identifications WHERE sha256 = ? AND created_at > ?",
+            (sha256, cutoff),
+        ).fetchone()
+        if row is not None:
+            self._count("exact_hits")
+            self._touch(conn, sha256, now)
+            return row[0]
+
+        if self.max_distance >= 0:
+            value = image_dhash if image_dhash is not None else dhash(image_data)
+            if value is not None:
+                bands = _bands(value)
+                where = " OR ".join(f"b{i} = ?" for i in range(_BANDS))
+                best = None
+                for candidate_sha, candidate_hash, species in conn.execute(
+                    f"SELECT sha256, dhash, species FROM identifications"
+                    f" WHERE ({where}) AND dhash IS NOT NULL AND created_at > ?",
+                    (*bands, cutoff),
+                ):
+                    distance = hamming(value, int(candidate_hash, 16))
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, candidate_sha, species)
+                if best is not None:
+                    self._count("near_hits")
+                    self._touch(conn, best[1], now)
+                    return best[2]
+
+        self._count("misses")
+        return None
+
+    def store(self, image_data, species, image_dhash=None):
+        """
+        Records a successful identification, then expires and evicts old entries.
+        """
+        now = time.time()
+        value = image_dhash if image_dhash is not None else dhash(image_data)
+        bands = _bands(value) if value is not None else [-1] * _BANDS
+        band_names = ", ".join(f"b{i}" for i in range(_BANDS))
+        placeholders = ", ".join("?" for _ in range(_BANDS))
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO identifications"
+                f" (sha256, dhash, {band_names}, species, created_at, accessed_at)"
+                f" VALUES (?, ?, {placeholders}, ?, ?, ?)",
+                (
+                    content_hash(image_data),
+                    f"{value:016x}" if value is not None else None,
+                    *bands,
+                    species,
+                    now,
+                    now,
+                ),
+            )
+            conn.execute("DELETE FROM identifications WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM identifications WHERE rowid IN ("
+                " SELECT rowid FROM identifications ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        """Returns hit/miss counters for this process and the number of stored entries."""
+        entries = self._connect().execute("SELECT COUNT(*) FROM identifications").fetchone()[0]
+        return {
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "entries": entries,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide identification cache, or None if ID_CACHE=off.
+
+    Environment:
+        ID_CACHE_DB: SQLite file (default id_cache.db).
+        ID_CACHE_TTL: Seconds before a result expires (default 7 days).
+        ID_CACHE_MAX: Maximum number of cached results (default 20000).
+        ID_CACHE_MAX_DISTANCE: Largest dHash Hamming distance treated as the
+            same photo (default 4, at most 7; -1 disables near matching).
+    """
+    global _cache
+    if os.getenv("ID_CACHE", "on").lower() == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = IdentificationCache(
+                os.getenv("ID_CACHE_DB", "id_cache.db"),
+                float(os.getenv("ID_CACHE_TTL", str(7 * 24 * 3600))),
+                int(os.getenv("ID_CACHE_MAX", "20000")),
+                int(os.getenv("ID_CACHE_MAX_DISTANCE", "4")),
+            )
+        return _cache
@@ -1,52 +1,114 @@
+import asyncio
+import httpx
 import requests
 from dotenv import load_dotenv
 import os
 import json
-from pprint import pprint
+from io import BytesIO
+import idcache
+import outbound
+
+load_dotenv()
 
 # Returns a tuple of (Boolean, string)
 # Boolean indicates if the image is recognized as a plant.
 # String is either the plant name (if recognized) or an error message.
-def getPlant(image) -> tuple:
-    load_dotenv()
+# Exact and near-duplicate images are answered from the identification cache.
+# filename and mime describe the image as uploaded to PlantNet.
+def getPlant(image, filename='capture.jpg', mime='image/jpeg') -> tuple:
+    image_data = image.read()
+    cache = idcache.get_cache()
+    image_dhash = None
+    if cache is not None:
+        image_dhash = idcache.dhash(image_data)
+        cached = cache.lookup(image_data, image_dhash)
+        if cached is not None:
+            return (True, cached)
+
+    result = _identify(BytesIO(image_data), filename, mime)
+    if cache is not None and result[0]:
+        cache.store(image_data, result[1], image_dhash)
+    return result
+
+def _identify(image, filename, mime) -> tuple:
     API_KEY = os.getenv("PLANTAPIKEY")
-    PROJECT = "all"
-    api_endpoint = f"https://my-api.plantnet.org/v2/identify/{PROJECT}?api-key={API_KEY}"
+    plantnet = outbound.get_provider("plantnet")
     
     try:
-        # Construct the files dictionary.
-        # Here we assume that the image is in PNG format.
-        # If your image might be JPEG, you can adjust the filename and MIME type accordingly.
+        # Construct the files dictionary with the image's real name and MIME type.
         files = {
-            'images': ('capture.png', image, 'image/png')
+            'images': (filename, image, mime)
         }
         
-        # Create and prepare the request.
-        req = requests.Request('POST', url=api_endpoint, files=files)
-        prepared = req.prepare()
-        s = requests.Session()
-        response = s.send(prepared)
-        
-        # Parse the JSON response.
-        json_result = response.json()
-        if response.status_code == 200:
-            pprint(json_result.get('bestMatch'))
-            best_match = json_result.get('bestMatch')
-            # best_match is expected to be a dictionary.
-            # Adjust the following extraction based on the actual API response.
-            if isinstance(best_match, dict) and "species" in best_match:
-                species = best_match["species"]
-                # Extract the scientific name (or any other field you prefer).
-                plant_name = species.get("scientificNameWithoutAuthor", str(best_match))
-            else:
-                plant_name = str(best_match)
-                print(f"Plant: {plant_name}")
-            return (True, plant_name)
-        else:
-            return (False, "error: try again")
+        # Send through the shared PlantNet client (pooled, with timeouts,
+        # retries and a circuit breaker).
+        response = plantnet.request('POST', _endpoint(plantnet), params={'api-key': API_KEY}, files=files)
+        return _parse_response(response)
+    except outbound.ProviderUnavailable as e:
+        print(f"PlantNet unavailable: {e}")
+        return (False, "error: try again")
     except requests.exceptions.RequestException as e:
         print(f"Request failed: {e}")
         return (False, f"Request failed: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
         return (False, f"Unexpected error: {e}")
+
+def _endpoint(plantnet):
+    PROJECT = "all"
+    return f"{plantnet.config['URL']}/v2/identify/{PROJECT}"
+
+def _parse_response(response) -> tuple:
+    # Parse the JSON response.
+    json_result = response.json()
+    if response.status_code == 200:
+        best_match = json_result.get('bestMatch')
+        # best_match is expected to be a dictionary.
+        # Adjust the following extraction based on the actual API response.
+        if isinstance(best_match, dict) and "species" in best_match:
+            species = best_match["species"]
+            # Extract the scientific name (or any other field you prefer).
+            plant_name = species.get("scientificNameWithoutAuthor", str(best_match))
+        else:
+            plant_name = str(best_match)
+            print(f"Plant: {plant_name}")
+        return (True, plant_name)
+    else:
+        return (False, "error: try again")
+
+async def getPlantAsync(image_data, filename='capture.jpg', mime='image/jpeg') -> tuple:
+    """
+    getPlant for the ASGI app: takes the image bytes and awaits PlantNet on the
+    asyncio client. Cache lookups (SQLite and image hashing) run on a worker thread.
+    """
+    cache = idcache.get_cache()
+    image_dhash = None
+    if cache is not None:
+        image_dhash = await asyncio.to_thread(idcache.dhash, image_data)
+        cached = await asyncio.to_thread(cache.lookup, image_data, image_dhash)
+        if cached is not None:
+            return (True, cached)
+
+    result = await _identify_async(image_data, filename, mime)
+    if cache is not None and result[0]:
+        await asyncio.to_thread(cache.store, image_data, result[1], image_dhash)
+    return result
+
+async def _identify_async(image_data, filename, mime) -> tuple:
+    API_KEY = os.getenv("PLANTAPIKEY")
+    plantnet = outbound.get_async_provider("plantnet")
+    try:
+        files = {
+            'images': (filename, image_data, mime)
+        }
+        response = await plantnet.request('POST', _endpoint(plantnet), params={'api-key': API_KEY}, files=files)
+        return _parse_response(response)
+    except outbound.ProviderUnavailable as e:
+        print(f"PlantNet unavailable: {e}")
+        return (False, "error: try again")
+    except httpx.HTTPError as e:
+        print(f"Request failed: {e}")
+        return (False, f"Request failed: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+        return (False, f"Unexpected error: {e}")
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from io import BytesIO
+
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+# Content-addressed storage for report images.
+#
+# Every uploaded image is stored once under the SHA-256 of its bytes, next to a
+# thumbnail and a medium rendition generated at ingest time. Reports only keep
+# the hash; the bytes are served by the /image/<hash> endpoint in app.py, which
+# can be cached forever because the content behind a hash never changes.
+
+load_dotenv()
+
+# Longest edge, in pixels, of each generated rendition.
+RENDITIONS = {
+    "thumb": 160,
+    "medium": 800,
+}
+SIZES = ("thumb", "medium", "full")
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_valid_hash(image_hash):
+    """Returns True if the value looks like a SHA-256 hex digest."""
+    return bool(image_hash) and bool(_HASH_RE.match(image_hash))
+
+
+def image_url(image_hash, size="medium"):
+    """
+    Returns the URL the frontend should use for a stored image.
+
+    IMAGE_BASE_URL can point at the backend (or a CDN in front of it) when the
+    frontend is served from a different origin.
+    """
+    base = os.getenv("IMAGE_BASE_URL", "").rstrip("/")
+    return f"{base}/image/{image_hash}?size={size}"
+
+
+def _render(img, max_edge):
+    rendition = img.copy()
+    rendition.thumbnail((max_edge, max_edge))
+    output = BytesIO()
+    rendition.save(output, format="JPEG", quality=82, optimize=True)
+    return output.getvalue()
+
+
+class LocalImageStore:
+    """
+    Stores images on the local filesystem, laid out as
+    <root>/<hash[:2]>/<hash>/{full,medium,thumb,meta.json}.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _dir(self, image_hash):
+        return os.path.join(self.root, image_hash[:2], image_hash)
+
+    def _write_atomic(self, path, data):
+        # Write to a temporary file first so readers never see a partial image.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def exists(self, image_hash):
+        return os.path.exists(os.path.join(self._dir(image_hash), "meta.json"))
+
+    def put(self, image_data):
+        """
+        Stores the image and its renditions if they are not stored already.
+
+        Parameters:
+            image_data (bytes): The encoded image.
+
+        Returns:
+            The SHA-256 hex digest that identifies the image.
+        """
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        if self.exists(image_hash):
+            return image_hash
+
+        img = Image.open(BytesIO(image_data))
+        full_type = Image.MIME.get(img.format, "application/octet-stream")
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        directory = self._dir(image_hash)
+        os.makedirs(directory, exist_ok=True)
+        self._write_atomic(os.path.join(directory, "full"), image_data)
+        for size, max_edge in RENDITIONS.items():
+            self._write_atomic(os.path.join(directory, size), _render(img, max_edge))
+
+        meta = {
+            "content_types": {"full": full_type, "medium": "image/jpeg", "thumb": "image/jpeg"},
+            "width": img.width,
+            "height": img.height,
+            "bytes": len(image_data),
+        }
+        # meta.json is written last and marks the entry as complete.
+        self._write_atomic(os.path.join(directory, "meta.json"), json.dumps(meta).encode("utf-8"))
+        return image_hash
+
+    def meta(self, image_hash):
+        """Returns the stored metadata dictionary, or None if the image is unknown."""
+        try:
+            with open(os.path.join(self._dir(image_hash), "meta.json"), "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+    def get(self, image_hash, size="full"):
+        """
+        Returns (bytes, content_type) for a rendition, or None if it does not exist.
+        """
+        meta = self.meta(image_hash)
+        if meta is None or size not in SIZES:
+            return None
+        with open(os.path.join(self._dir(image_hash), size), "rb") as f:
+            return f.read(), meta["content_types"][size]
+
+
+_store = None
+
+
+def get_store():
+    """
+    Returns the process-wide image store.
+    IMAGE_STORE_DIR selects where the local backend keeps its files.
+    """
+    global _store
+    if _store is None:
+        _store = LocalImageStore(os.getenv("IMAGE_STORE_DIR", "image_store"))
+    return _store
@@ -0,0 +1,671 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from io import BytesIO
+
+from dotenv import load_dotenv
+
+import admission
+import checkinvasive as ci
+import geo
+import idplant as idplant
+import imagestore
+import metrics
+import preprocess
+import reports as rp
+import verdictcache
+
+# Report ingestion pipeline: decode -> identify -> classify -> store.
+#
+# create_report can run the pipeline inline (the original behaviour) or hand
+# it to a bounded pool of worker threads and answer 202 straight away. Jobs go
+# through a pluggable queue backend and their progress is recorded in a job
+# store that /report_status/<job_id> reads from.
+#
+# The ASGI app (asgi.py) runs the same stages with run_pipeline_async, awaiting
+# PlantNet, the LLM and storage on one event loop, and its background jobs are
+# asyncio tasks (AsyncJobRunner) rather than pool threads.
+#
+# Survey uploads (/create_reports) carry many images. run_batch runs decode,
+# identify and classify for each on a bounded thread pool, classifies each
+# distinct (species, region) of the batch once, reports each image's outcome
+# as soon as it finishes, and stores every accepted report in one commit.
+#
+# Identification and classification run under one of the host's pipeline
+# slots (see admission.py). Uploads handled inline are shed when the slots
+# stay taken; background jobs and batch images wait for one.
+
+load_dotenv()
+
+STAGES = ("decode", "identify", "classify", "store")
+BATCH_MAX_IMAGES = int(os.getenv("INGEST_BATCH_MAX_IMAGES", "50"))
+
+
+class ReportRejected(Exception):
+    """Raised by a pipeline stage when the upload cannot become a report."""
+
+
+class StoreFailed(Exception):
+    """Raised when a report was accepted but could not be written to storage."""
+
+
+class QueueFull(Exception):
+    """Raised when the ingestion queue cannot take another job."""
+
+
+def run_pipeline(email, lat, lng, upload, on_stage=None, shed=True):
+    """
+    Runs every stage of report ingestion for one upload.
+
+    Parameters:
+        email (str): Reporter's email.
+        lat (str): Latitude from the form.
+        lng (str): Longitude from the form.
+        upload: Seekable file object holding the spooled upload. It is closed
+            once the image has been preprocessed.
+        on_stage (callable): Optional callback invoked with each stage name as it starts.
+        shed (bool): Give up with admission.Rejected when no pipeline slot
+            frees up in time, instead of waiting (see admission.pipeline_slot).
+
+    Returns:
+        A dictionary with plant_name, invasive and description.
+
+    Raises:
+        ReportRejected: If the image is invalid or not a plant.
+        checkinvasive.ClassificationFailed: If the invasive check could not be made.
+        admission.Rejected: If shed and the host is overloaded.
+        StoreFailed: If the image store or the storage backend failed.
+    """
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+
+    stage("decode")
+    try:
+        with metrics.timer("ingest_stage_duration_seconds", "decode", stage="decode"):
+            image = preprocess.prepare_image(upload)
+    except preprocess.ImageRejected as e:
+        raise ReportRejected(str(e))
+    finally:
+        upload.close()
+
+    with admission.pipeline_slot(shed):
+        stage("identify")
+        with metrics.timer("ingest_stage_duration_seconds", "identify", stage="identify"):
+            plantResult = idplant.getPlant(BytesIO(image.data), image.filename, image.mime)
+        if not plantResult[0]:
+            raise ReportRejected("Not a plant")
+
+        stage("classify")
+        with metrics.timer("ingest_stage_duration_seconds", "classify", stage="classify"):
+            invasiveResult = ci.check_invasive_plant(plantResult[1], lat, lng)
+    if invasiveResult[0] == "Not a plant":
+        raise ReportRejected("Not a plant")
+
+    stage("store")
+    try:
+        with metrics.timer("ingest_stage_duration_seconds", "store", stage="store"):
+            rp.storeInfo(
+                User_Email=email,
+                plant_name=plantResult[1],
+                image_data=image.data,
+                lat=lat,
+                lng=lng,
+                description=invasiveResult[1],
+                invasive_info=invasiveResult[0],
+                image_pixels=image.width * image.height
+            )
+    except Exception as e:
+        print(f"Error storing plant information: {e}")
+        raise StoreFailed(f"Could not store the report: {e}") from e
+    return {
+        "plant_name": plantResult[1],
+        "invasive": invasiveResult[0],
+        "description": invasiveResult[1],
+    }
+
+
+async def run_pipeline_async(email, lat, lng, upload, on_stage=None, shed=True):
+    """
+    run_pipeline for the ASGI app. Image decoding runs on a worker thread; the
+    identify, classify and store stages await the asyncio clients.
+    """
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+
+    stage("decode")
+    try:
+        with metrics.timer("ingest_stage_duration_seconds", "decode", stage="decode"):
+            image = await asyncio.to_thread(preprocess.prepare_image, upload)
+    except preprocess.ImageRejected as e:
+        raise ReportRejected(str(e))
+    finally:
+        upload.close()
+
+    async with admission.pipeline_slot_async(shed):
+        stage("identify")
+        with metrics.timer("ingest_stage_duration_seconds", "identify", stage="identify"):
+            plantResult = await idplant.getPlantAsync(image.data, image.filename, image.mime)
+        if not plantResult[0]:
+            raise ReportRejected("Not a plant")
+
+        stage("classify")
+        with metrics.timer("ingest_stage_duration_seconds", "classify", stage="classify"):
+            invasiveResult = await ci.check_invasive_plant_async(plantResult[1], lat, lng)
+    if invasiveResult[0] == "Not a plant":
+        raise ReportRejected("Not a plant")
+
+    stage("store")
+    try:
+        with metrics.timer("ingest_stage_duration_seconds", "store", stage="store"):
+            await rp.storeInfoAsync(
+                User_Email=email,
+                plant_name=plantResult[1],
+                image_data=image.data,
+                lat=lat,
+                lng=lng,
+                description=invasiveResult[1],
+                invasive_info=invasiveResult[0],
+                image_pixels=image.width * image.height
+            )
+    except Exception as e:
+        print(f"Error storing plant information: {e}")
+        raise StoreFailed(f"Could not store the report: {e}") from e
+    return {
+        "plant_name": plantResult[1],
+        "invasive": invasiveResult[0],
+        "description": invasiveResult[1],
+    }
+
+
+# ────────────── Batch uploads ──────────────
+
+class BatchItem:
+    """One image of a batch upload, with the coordinates given for it (if any)."""
+
+    def __init__(self, filename, upload, lat=None, lng=None):
+        self.filename = filename
+        self.upload = upload
+        self.lat = lat
+        self.lng = lng
+
+
+class _BatchClassifier:
+    """Classifies each distinct (species, region) of one batch once."""
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def classify(self, plant_name, lat, lng):
+        key = (verdictcache.normalize_species(plant_name), verdictcache.region_key(lat, lng))
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = concurrent.futures.Future()
+        if owner:
+            try:
+                future.set_result(ci.check_invasive_plant(plant_name, lat, lng))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+
+def _prepare_batch_item(email, item, classifier):
+    # Runs decode, identify and classify for one image and puts it in the image
+    # store. Returns (outcome, report); report is None unless it is accepted.
+    outcome = {"filename": item.filename}
+    try:
+        lat, lng = item.lat, item.lng
+        if not lat or not lng:
+            position = preprocess.gps_coordinates(item.upload)
+            if position is None:
+                raise ReportRejected("Missing latitude and longitude, and the image has no GPS data")
+            lat, lng = str(position[0]), str(position[1])
+        outcome.update(lat=lat, lng=lng)
+        try:
+            geo.parse_point(lat, lng)
+        except ValueError as e:
+            raise ReportRejected(str(e))
+
+        try:
+            with metrics.timer("ingest_stage_duration_seconds", "decode", stage="decode"):
+                image = preprocess.prepare_image(item.upload)
+        except preprocess.ImageRejected as e:
+            raise ReportRejected(str(e))
+
+        with admission.pipeline_slot(shed=False):
+            with metrics.timer("ingest_stage_duration_seconds", "identify", stage="identify"):
+                plantResult = idplant.getPlant(BytesIO(image.data), image.filename, image.mime)
+            if not plantResult[0]:
+                raise ReportRejected("Not a plant")
+
+            with metrics.timer("ingest_stage_duration_seconds", "classify", stage="classify"):
+                invasiveResult = classifier.classify(plantResult[1], lat, lng)
+        if invasiveResult[0] == "Not a plant":
+            raise ReportRejected("Not a plant")
+
+        image_hash = imagestore.get_store().put(image.data)
+        report = rp.buildReport(email, plantResult[1], image_hash, lat, lng, invasiveResult[1],
+                                invasiveResult[0], image_pixels=image.width * image.height)
+    except ReportRejected as e:
+        return dict(outcome, status="rejected", error=str(e)), None
+    except ci.ClassificationFailed:
+        return dict(outcome, status="failed",
+                    error="Could not check whether the plant is invasive, try again shortly"), None
+    except Exception as e:
+        print(f"Error processing {item.filename}: {e}")
+        return dict(outcome, status="failed", error=str(e)), None
+    finally:
+        item.upload.close()
+
+    outcome.update(status="identified", plant_name=plantResult[1],
+                   invasive=invasiveResult[0], description=invasiveResult[1])
+    return outcome, report
+
+
+def _store_batch(accepted):
+    # Stores the accepted reports, in upload order, and returns the summary line.
+    indexes = sorted(accepted)
+    summary = {"done": True, "accepted": len(indexes)}
+    if not indexes:
+        return dict(summary, stored=[])
+    try:
+        with metrics.timer("ingest_stage_duration_seconds", "store", stage="store"):
+            results = rp.storeReports([accepted[index] for index in indexes])
+    except Exception as e:
+        print(f"Error storing batch: {e}")
+        return dict(summary, stored=[], error=f"Could not store the reports: {e}")
+    return dict(summary, stored=[{"index": index, "id": report_id, "merged": merged}
+                                 for index, (report_id, merged) in zip(indexes, results)])
+
+
+def run_batch(email, items):
+    """
+    Runs decode, identify and classify for every image of a batch upload on
+    the batch thread pool, then stores the accepted reports with one commit.
+
+    Parameters:
+        email (str): Reporter's email.
+        items (list): BatchItem objects. Images without coordinates are
+            placed by their EXIF GPS position. Their uploads are closed.
+
+    Yields:
+        One outcome per image as soon as it finishes, in completion order:
+        {"index", "filename", "status", ...} where status is "identified"
+        (with plant_name, invasive and description), "rejected" or "failed"
+        (with error). Then a summary {"done": true, "accepted", "stored"},
+        where stored lists {"index", "id", "merged"} for every stored report,
+        or an "error" if the commit failed. If the consumer stops early the
+        remaining images are still processed and stored.
+    """
+    classifier = _BatchClassifier()
+    executor = get_batch_executor()
+    futures = {executor.submit(_prepare_batch_item, email, item, classifier): index
+               for index, item in enumerate(items)}
+    accepted = {}
+
+    def collect(future):
+        outcome, report = future.result()
+        index = futures[future]
+        if report is not None:
+            accepted[index] = report
+        return dict(outcome, index=index)
+
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield collect(future)
+    except GeneratorExit:
+        # The client went away; finish and store what was uploaded anyway.
+        for future in futures:
+            if futures[future] not in accepted:
+                collect(future)
+        _store_batch(accepted)
+        raise
+    yield _store_batch(accepted)
+
+
+# ────────────── Queue backends ──────────────
+
+class MemoryQueue:
+    """Bounded in-process FIFO queue of job payloads."""
+
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, job):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull()
+
+    def get(self, timeout=None):
+        """Returns the next job, or None if none arrived within timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+# ────────────── Job stores ──────────────
+
+class MemoryJobStore:
+    """Keeps job status in a dictionary; visible only to the current process."""
+
+    def __init__(self, ttl_seconds):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._ttl = ttl_seconds
+
+    def create(self, job_id, status):
+        with self._lock:
+            self._expire()
+            self._jobs[job_id] = dict(status)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _expire(self):
+        cutoff = time.time() - self._ttl
+        for job_id in [j for j, job in self._jobs.items() if job["updated_at"] < cutoff]:
+            del self._jobs[job_id]
+
+
+class SqliteJobStore:
+    """
+    Keeps job status in a SQLite file so every gunicorn worker on the host can
+    answer /report_status, whichever worker accepted the upload.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self._path = path
+        self._ttl = ttl_seconds
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, job_id, status):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - self._ttl,))
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, updated_at) VALUES (?, ?, ?)",
+                (job_id, json.dumps(status), status["updated_at"]),
+            )
+
+    def update(self, job_id, **fields):
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            status = json.loads(row[0])
+            status.update(fields)
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(status), status["updated_at"], job_id),
+            )
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def _create_job(store):
+    # Records a new queued job and returns its ID.
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    store.create(job_id, {
+        "job_id": job_id,
+        "status": "queued",
+        "stage": None,
+        "result": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    })
+    return job_id
+
+
+# ────────────── Worker pool ──────────────
+
+class WorkerPool:
+    """
+    A fixed number of daemon threads that take jobs off the queue and run the
+    pipeline, recording each stage in the job store.
+    """
+
+    def __init__(self, job_queue, job_store, workers):
+        self.queue = job_queue
+        self.store = job_store
+        self.workers = workers
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, email, lat, lng, upload):
+        """
+        Queues a spooled upload for processing. The worker closes it.
+
+        Returns:
+            The new job ID.
+
+        Raises:
+            QueueFull: If the queue is at capacity.
+        """
+        self.start()
+        job_id = _create_job(self.store)
+        try:
+            self.queue.put({"job_id": job_id, "email": email, "lat": lat, "lng": lng, "upload": upload})
+        except QueueFull:
+            upload.close()
+            self.store.update(job_id, status="failed", error="Ingestion queue is full", updated_at=time.time())
+            raise
+        return job_id
+
+    def _run(self):
+        while True:
+            job = self.queue.get(timeout=1.0)
+            if job is None:
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        job_id = job["job_id"]
+
+        def on_stage(name):
+            self.store.update(job_id, status="running", stage=name, updated_at=time.time())
+
+        try:
+            result = run_pipeline(job["email"], job["lat"], job["lng"], job["upload"], on_stage=on_stage, shed=False)
+        except ReportRejected as e:
+            self.store.update(job_id, status="rejected", error=str(e), updated_at=time.time())
+        except Exception as e:
+            print(f"Error processing report job {job_id}: {e}")
+            self.store.update(job_id, status="failed", error=str(e), updated_at=time.time())
+        else:
+            self.store.update(job_id, status="done", stage=None, result=result, updated_at=time.time())
+
+
+class AsyncJobRunner:
+    """
+    Runs submitted uploads as asyncio tasks on the ASGI server's event loop,
+    recording each stage in the job store like WorkerPool. At most
+    `max_tasks` jobs are in flight; waiting on providers costs no thread.
+    """
+
+    def __init__(self, job_store, max_tasks):
+        self.store = job_store
+        self.max_tasks = max_tasks
+        self._tasks = set()
+
+    def submit(self, email, lat, lng, upload):
+        """
+        Starts processing a spooled upload. Must be called on the event loop.
+
+        Returns:
+            The new job ID.
+
+        Raises:
+            QueueFull: If max_tasks jobs are already in flight.
+        """
+        if len(self._tasks) >= self.max_tasks:
+            upload.close()
+            raise QueueFull()
+        job_id = _create_job(self.store)
+        task = asyncio.get_running_loop().create_task(self._process(job_id, email, lat, lng, upload))
+        # The loop only keeps weak references to tasks.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    async def _process(self, job_id, email, lat, lng, upload):
+        def on_stage(name):
+            self.store.update(job_id, status="running", stage=name, updated_at=time.time())
+
+        try:
+            result = await run_pipeline_async(email, lat, lng, upload, on_stage=on_stage, shed=False)
+        except ReportRejected as e:
+            self.store.update(job_id, status="rejected", error=str(e), updated_at=time.time())
+        except Exception as e:
+            print(f"Error processing report job {job_id}: {e}")
+            self.store.update(job_id, status="failed", error=str(e), updated_at=time.time())
+        else:
+            self.store.update(job_id, status="done", stage=None, result=result, updated_at=time.time())
+
+
+_pool = None
+_runner = None
+_store = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_batch_executor = None
+
+
+def _reset_after_fork():
+    # Called with _pool_lock held.
+    global _pool, _runner, _store, _batch_executor, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = _runner = _store = _batch_executor = None
+        _pool_pid = os.getpid()
+
+
+def get_job_store():
+    """
+    Returns this process's job store, shared by the worker pool and the
+    asyncio job runner, creating it on first use.
+
+    Environment:
+        INGEST_JOB_STORE: "memory" (default) or "sqlite".
+        INGEST_JOB_DB: SQLite file for the sqlite job store (default ingest_jobs.db).
+        INGEST_JOB_TTL: Seconds to keep finished job status (default 3600).
+    """
+    global _store
+    with _pool_lock:
+        _reset_after_fork()
+        if _store is None:
+            ttl = float(os.getenv("INGEST_JOB_TTL", "3600"))
+            if os.getenv("INGEST_JOB_STORE", "memory") == "sqlite":
+                _store = SqliteJobStore(os.getenv("INGEST_JOB_DB", "ingest_jobs.db"), ttl)
+            else:
+                _store = MemoryJobStore(ttl)
+        return _store
+
+
+def get_pool():
+    """
+    Returns this process's worker pool, creating it on first use.
+
+    The pool is created lazily and per PID, so threads are started inside each
+    gunicorn worker rather than in a master process that forks them away.
+
+    Environment:
+        INGEST_WORKERS: Number of worker threads (default 4).
+        INGEST_QUEUE_SIZE: Maximum queued jobs before uploads get 429 (default 64).
+        Job store settings: see get_job_store.
+    """
+    global _pool
+    store = get_job_store()
+    with _pool_lock:
+        _reset_after_fork()
+        if _pool is None:
+            job_queue = MemoryQueue(int(os.getenv("INGEST_QUEUE_SIZE", "64")))
+            _pool = WorkerPool(job_queue, store, int(os.getenv("INGEST_WORKERS", "4")))
+        return _pool
+
+
+def get_async_runner():
+    """
+    Returns this process's asyncio job runner (for the ASGI app), creating it
+    on first use.
+
+    Environment:
+        INGEST_MAX_TASKS: Maximum jobs in flight before uploads get 429 (default 256).
+        Job store settings: see get_job_store.
+    """
+    global _runner
+    store = get_job_store()
+    with _pool_lock:
+        _reset_after_fork()
+        if _runner is None:
+            _runner = AsyncJobRunner(store, int(os.getenv("INGEST_MAX_TASKS", "256")))
+        return _runner
+
+
+def get_batch_executor():
+    """
+    Returns this process's thread pool for batch uploads, shared by every
+    /create_reports request, creating it on first use.
+
+    Environment:
+        INGEST_BATCH_WORKERS: Images processed at once across all batches (default 8).
+        INGEST_BATCH_MAX_IMAGES: Most images in one batch upload (default 50).
+    """
+    global _batch_executor
+    with _pool_lock:
+        _reset_after_fork()
+        if _batch_executor is None:
+            _batch_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(os.getenv("INGEST_BATCH_WORKERS", "8")), thread_name_prefix="ingest-batch")
+        return _batch_executor
+
+
+def async_enabled():
+    """Returns True when INGEST_MODE=async is configured."""
+    return os.getenv("INGEST_MODE", "sync").lower() == "async"
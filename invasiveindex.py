@@ -0,0 +1,343 @@
+import argparse
+import collections
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import geo
+import metrics
+import verdictcache
+
+# Bundled table of known invasive species by region.
+#
+# Most reports are common species whose status is settled, so before asking
+# the LLM, check_invasive_plant looks the species up here: the coordinate is
+# mapped to a region (a state) by point-in-polygon over simplified
+# boundaries, and a species listed for that region is answered from the table.
+# Species that are not listed, and coordinates outside every region, still go
+# to the verdict cache and the LLM. Being absent from the table does not mean
+# a species is native, so the table only ever answers "invasive".
+#
+# The runtime file (data/invasive_index.json) is generated from two sources
+# kept next to it: data/regions.geojson (boundaries, one feature per region
+# with "code" and "name" properties) and data/invasive_species.csv (species,
+# common_name, synonyms, regions, description; lists are ";"-separated). Its
+# version is a hash of the contents, so a rebuild from the same sources is
+# byte-for-byte identical.
+#
+# to run: python invasiveindex.py build|hitrate ...
+
+load_dotenv()
+
+FORMAT = 1
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DEFAULT_PATH = os.path.join(DATA_DIR, "invasive_index.json")
+DEFAULT_SPECIES_SOURCE = os.path.join(DATA_DIR, "invasive_species.csv")
+DEFAULT_REGIONS_SOURCE = os.path.join(DATA_DIR, "regions.geojson")
+
+# Boundary vertices are rounded to this many decimals (about 1m); the
+# simplified boundaries are far coarser than that anyway.
+COORDINATE_DECIMALS = 5
+
+Listing = collections.namedtuple("Listing", "species common_name region description")
+
+
+class InvasiveIndex:
+    """An in-memory copy of the index file."""
+
+    def __init__(self, data):
+        if data.get("format") != FORMAT:
+            raise ValueError(f"Unsupported index format {data.get('format')!r} (expected {FORMAT})")
+        self.version = data["version"]
+        self.regions = [
+            (region["code"], region["name"], tuple(region["bbox"]),
+             [[tuple(point) for point in polygon] for polygon in region["polygons"]])
+            for region in data["regions"]
+        ]
+        self._names = {code: name for code, name, _, _ in self.regions}
+        self._species = data["species"]
+        self._synonyms = data["synonyms"]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def region_at(self, lat, lng):
+        """
+        Returns the code of the region containing the coordinate, or None if it
+        is outside every region or cannot be parsed.
+        """
+        lat = geo.to_float(lat)
+        lng = geo.to_float(lng)
+        if lat is None or lng is None:
+            return None
+        for code, _, bbox, polygons in self.regions:
+            if geo.in_bbox(lat, lng, bbox) and any(geo.in_polygon(lat, lng, polygon) for polygon in polygons):
+                return code
+        return None
+
+    def species_entry(self, plant_name):
+        """Returns the table entry for a species or one of its synonyms, or None."""
+        name = verdictcache.normalize_species(plant_name)
+        return self._species.get(self._synonyms.get(name, name))
+
+    def lookup(self, plant_name, lat, lng):
+        """
+        Returns a Listing if the species is listed as invasive in the region
+        containing the coordinate, otherwise None.
+        """
+        entry = self.species_entry(plant_name)
+        if entry is None:
+            return None
+        code = self.region_at(lat, lng)
+        if code is None or code not in entry["regions"]:
+            return None
+        return Listing(entry["species"], entry["common_name"], self._names[code], entry["description"])
+
+
+def describe(listing, details=None):
+    """
+    Returns the verdict description for a listing: which species it is, where
+    it is invasive, and its harmful effects from the table (or `details`, for
+    entries without a description).
+    """
+    name = listing.species
+    if listing.common_name:
+        name = f"{listing.common_name[0].upper()}{listing.common_name[1:]} ({listing.species})"
+    text = f"{name} is invasive in {listing.region}."
+    details = listing.description or details
+    return f"{text} {details}" if details else text
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Returns the bundled index, loading it on first use, or None if it is
+    disabled or cannot be read (every plant then goes to the LLM).
+
+    Environment:
+        INVASIVE_INDEX: "on" (default) or "off".
+        INVASIVE_INDEX_PATH: Index file (default data/invasive_index.json next to this module).
+    """
+    global _index, _index_loaded
+    if os.getenv("INVASIVE_INDEX", "on").lower() == "off":
+        return None
+    with _index_lock:
+        if not _index_loaded:
+            path = os.getenv("INVASIVE_INDEX_PATH", DEFAULT_PATH)
+            try:
+                _index = InvasiveIndex.load(path)
+                print(f"Loaded invasive species index {_index.version} from {path}")
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Invasive species index unavailable ({path}): {e}")
+                _index = None
+            _index_loaded = True
+        return _index
+
+
+def lookup(plant_name, lat, lng):
+    """
+    Looks a plant up in the bundled index. Returns a Listing if the species
+    is known to be invasive at the coordinate, otherwise None.
+    """
+    index = get_index()
+    if index is None:
+        return None
+    listing = index.lookup(plant_name, lat, lng)
+    metrics.inc("invasive_index_lookups_total", result="hit" if listing is not None else "miss")
+    return listing
+
+
+# ────────────── Build ──────────────
+
+def _split(value):
+    return [part.strip() for part in (value or "").split(";") if part.strip()]
+
+
+def _read_regions(path):
+    with open(path, encoding="utf-8") as f:
+        collection = json.load(f)
+    regions = []
+    for feature in collection.get("features", []):
+        properties = feature.get("properties") or {}
+        geometry = feature.get("geometry") or {}
+        code = properties.get("code")
+        if not code or not properties.get("name"):
+            raise ValueError("Every region needs 'code' and 'name' properties")
+        if geometry.get("type") == "Polygon":
+            rings = [geometry["coordinates"][0]]
+        elif geometry.get("type") == "MultiPolygon":
+            rings = [polygon[0] for polygon in geometry["coordinates"]]
+        else:
+            raise ValueError(f"Region {code} must be a Polygon or MultiPolygon")
+        # Outer rings only; GeoJSON is [lng, lat], the index is [lat, lng].
+        polygons = [
+            geo.parse_polygon([[round(point[1], COORDINATE_DECIMALS), round(point[0], COORDINATE_DECIMALS)]
+                               for point in ring])
+            for ring in rings
+        ]
+        bboxes = [geo.polygon_bbox(polygon) for polygon in polygons]
+        regions.append({
+            "code": code,
+            "name": properties["name"],
+            "bbox": [min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+                     max(b[2] for b in bboxes), max(b[3] for b in bboxes)],
+            "polygons": [[list(point) for point in polygon] for polygon in polygons],
+        })
+    if len({region["code"] for region in regions}) != len(regions):
+        raise ValueError("Region codes must be unique")
+    return sorted(regions, key=lambda region: region["code"])
+
+
+def _read_species(path, region_codes):
+    species = {}
+    synonyms = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        for number, row in enumerate(csv.DictReader(f), start=2):
+            name = (row.get("species") or "").strip()
+            key = verdictcache.normalize_species(name)
+            if not key:
+                raise ValueError(f"Line {number}: missing species")
+            if key in species or key in synonyms:
+                raise ValueError(f"Line {number}: {name} is listed twice")
+            regions = sorted(set(_split(row.get("regions"))))
+            unknown = [code for code in regions if code not in region_codes]
+            if not regions or unknown:
+                raise ValueError(f"Line {number}: unknown or missing regions {', '.join(unknown)}")
+            species[key] = {
+                "species": name,
+                "common_name": (row.get("common_name") or "").strip(),
+                "regions": regions,
+                "description": (row.get("description") or "").strip(),
+            }
+            for synonym in _split(row.get("synonyms")):
+                synonyms[verdictcache.normalize_species(synonym)] = key
+    clashes = sorted(set(synonyms) & set(species))
+    if clashes:
+        raise ValueError(f"Synonyms that are also listed species: {', '.join(clashes)}")
+    return species, synonyms
+
+
+def build(species_path=DEFAULT_SPECIES_SOURCE, regions_path=DEFAULT_REGIONS_SOURCE):
+    """
+    Builds the index from its sources.
+
+    Returns:
+        The index as a dictionary, ready to be written as JSON.
+
+    Raises:
+        ValueError: If a source is malformed, a species is listed twice or
+            names a region that has no boundary.
+    """
+    regions = _read_regions(regions_path)
+    species, synonyms = _read_species(species_path, {region["code"] for region in regions})
+    content = {"regions": regions, "species": species, "synonyms": synonyms}
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+    return {"format": FORMAT, "version": f"{FORMAT}-{digest[:12]}", **content}
+
+
+# ────────────── Hit rate ──────────────
+
+def _rows_from_file(path):
+    # An NDJSON export from /export?format=ndjson.
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def hit_rate(index, rows):
+    """
+    Replays stored reports against the index: how many verdicts the table
+    would have answered without the LLM, how often the table agrees with the
+    stored verdicts, and which unlisted species come up most.
+
+    Returns:
+        A dictionary of counts, the lookup time per report in microseconds,
+        and a Counter of missed species.
+    """
+    counts = collections.Counter()
+    missed = collections.Counter()
+    elapsed = 0.0
+    for row in rows:
+        plant_name = row.get("plant_name")
+        if not plant_name:
+            continue
+        counts["reports"] += 1
+        started = time.perf_counter()
+        listing = index.lookup(plant_name, row.get("lat"), row.get("lng"))
+        elapsed += time.perf_counter() - started
+        if listing is not None:
+            counts["hits"] += 1
+            counts["agree" if row.get("invasive_info") is True else "disagree"] += 1
+            continue
+        if index.region_at(row.get("lat"), row.get("lng")) is None:
+            counts["outside"] += 1
+        else:
+            counts["unlisted"] += 1
+            missed[plant_name] += 1
+    return {
+        **counts,
+        "lookup_us": elapsed / counts["reports"] * 1e6 if counts["reports"] else 0.0,
+        "missed": missed,
+    }
+
+
+def print_hit_rate(index, result, top):
+    reports = result.get("reports", 0)
+    print(f"Index {index.version}: {len(index.regions)} regions")
+    if not reports:
+        print("No reports with a species name.")
+        return
+    hits = result.get("hits", 0)
+    print(f"Reports:            {reports}")
+    print(f"Answered by table:  {hits} ({hits / reports:.1%})")
+    print(f"  stored invasive:  {result.get('agree', 0)}")
+    print(f"  stored otherwise: {result.get('disagree', 0)}")
+    print(f"Outside regions:    {result.get('outside', 0)}")
+    print(f"Unlisted species:   {result.get('unlisted', 0)}")
+    print(f"Lookup time:        {result['lookup_us']:.1f}us per report")
+    if result["missed"]:
+        print("Most reported unlisted species in covered regions:")
+        for plant_name, count in result["missed"].most_common(top):
+            print(f"  {count:6d}  {plant_name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the invasive species index or measure its hit rate.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Regenerate the index from its sources")
+    build_parser.add_argument("--species", default=DEFAULT_SPECIES_SOURCE)
+    build_parser.add_argument("--regions", default=DEFAULT_REGIONS_SOURCE)
+    build_parser.add_argument("--output", default=DEFAULT_PATH)
+    hit_parser = commands.add_parser("hitrate", help="Replay stored reports against the index")
+    hit_parser.add_argument("--index", default=DEFAULT_PATH)
+    hit_parser.add_argument("--from-file", help="Read an NDJSON export instead of the configured storage")
+    hit_parser.add_argument("--top", type=int, default=20, help="Unlisted species to show")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build(args.species, args.regions)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(index, f, sort_keys=True, separators=(",", ":"))
+            f.write("\n")
+        print(f"Wrote {args.output}: version {index['version']}, {len(index['regions'])} regions, "
+              f"{len(index['species'])} species, {len(index['synonyms'])} synonyms")
+    else:
+        index = InvasiveIndex.load(args.index)
+        if args.from_file:
+            rows = _rows_from_file(args.from_file)
+        else:
+            import dataset
+            rows = dataset.iter_reports(["plant_name", "lat", "lng", "invasive_info"])
+        print_hit_rate(index, hit_rate(index, rows), args.top)
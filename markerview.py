@@ -0,0 +1,196 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from google.cloud.firestore_v1 import FieldFilter
+
+import reports as rp
+import storage
+
+# In-process materialized view of the active invasive markers.
+#
+# The active set (removed == False, invasive_info == True) is small compared to
+# the read traffic on /getMarkers, so each worker keeps it in memory, kept
+# current by a Firestore snapshot listener. The JSON body for /getMarkers (and a
+# gzipped copy) is serialized once per change instead of once per request.
+# Importing the app never blocks on Firestore: gunicorn warms the view up in
+# each worker after the fork (post_fork in gunicorn.conf.py), and otherwise a
+# worker starts its listener on its first /getMarkers request. While the
+# listener is down, callers fall back to querying Firestore directly and the
+# listener is restarted with a backoff.
+
+from firebase_client import db
+
+load_dotenv()
+
+WARMUP_TIMEOUT = float(os.getenv("MARKER_VIEW_WARMUP_TIMEOUT", "10"))
+RESTART_BACKOFF = float(os.getenv("MARKER_VIEW_RESTART_BACKOFF", "30"))
+
+
+class MarkerView:
+    def __init__(self, query):
+        self._query = query
+        self._markers = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._last_start = 0.0
+        self.version = 0
+        self.last_event_at = None
+        self._serialized = None
+        self.rebuilds = 0
+        self.restarts = 0
+        self.fallbacks = 0
+
+    def start(self):
+        """Registers the snapshot listener. The first snapshot fills the view."""
+        self._last_start = time.monotonic()
+        if self._watch is not None:
+            self.restarts += 1
+            try:
+                self._watch.unsubscribe()
+            except Exception:
+                pass
+        self._ready.clear()
+        self._watch = self._query.on_snapshot(self._on_snapshot)
+
+    def warm_up(self, timeout=WARMUP_TIMEOUT):
+        """
+        Starts the listener if needed and waits for the initial snapshot.
+
+        Returns:
+            True if the view is ready, False if it timed out (requests fall back
+            to direct queries until it catches up).
+        """
+        if self._watch is None:
+            self.start()
+        ready = self._ready.wait(timeout)
+        if ready:
+            self.snapshot()
+        return ready
+
+    def _on_snapshot(self, docs, changes, read_time):
+        # Runs on the listener's thread.
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._markers.pop(doc.id, None)
+                    continue
+                poi = rp.to_poi(doc.id, doc.to_dict())
+                if poi is None:
+                    self._markers.pop(doc.id, None)
+                else:
+                    self._markers[doc.id] = poi
+            self.version += 1
+            self.last_event_at = time.time()
+        self._ready.set()
+
+    def is_live(self):
+        """Returns True if the listener is streaming and has delivered its first snapshot."""
+        return self._watch is not None and self._watch.is_active and self._ready.is_set()
+
+    def snapshot(self):
+        """
+        Returns (json_bytes, gzip_bytes, etag) for the current marker list, or
+        None if the listener is down, in which case the caller should query
+        Firestore directly. A dead listener is restarted at most once per
+        RESTART_BACKOFF seconds.
+        """
+        if not self.is_live():
+            self.fallbacks += 1
+            if time.monotonic() - self._last_start >= RESTART_BACKOFF:
+                try:
+                    self.start()
+                except Exception as e:
+                    print(f"Error restarting marker listener: {e}")
+            return None
+
+        with self._lock:
+            if self._serialized is not None and self._serialized[0] == self.version:
+                return self._serialized[1:]
+            version = self.version
+            markers = [self._markers[key] for key in sorted(self._markers)]
+
+        # Serialize outside the lock so the listener thread is never blocked on it.
+        body = json.dumps(markers, separators=(",", ":")).encode("utf-8")
+        compressed = gzip.compress(body, compresslevel=6)
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            if self._serialized is None or self._serialized[0] < version:
+                self._serialized = (version, body, compressed, etag)
+                self.rebuilds += 1
+        return body, compressed, etag
+
+    def stats(self):
+        """Returns size, freshness and fallback counters for the view."""
+        with self._lock:
+            count = len(self._markers)
+            last_event_at = self.last_event_at
+        return {
+            "markers": count,
+            "version": self.version,
+            "live": self.is_live(),
+            "seconds_since_last_event": time.time() - last_event_at if last_event_at else None,
+            "rebuilds": self.rebuilds,
+            "restarts": self.restarts,
+            "fallbacks": self.fallbacks,
+        }
+
+
+_view = None
+_view_pid = None
+_view_lock = threading.Lock()
+
+
+def enabled():
+    """
+    Returns True unless MARKER_VIEW=off. The view needs Firestore's snapshot
+    listeners, so it is also off with STORAGE_BACKEND=sqlite, whose local
+    queries are fast enough to serve /getMarkers directly.
+    """
+    return os.getenv("MARKER_VIEW", "on").lower() != "off" and storage.backend_name() == "firestore"
+
+
+def get_view():
+    """
+    Returns this process's marker view, or None if the feature is disabled.
+    The view is created per PID so each gunicorn worker runs its own listener,
+    which is started here without waiting for its first snapshot; until it
+    arrives, snapshot() returns None and callers query Firestore directly.
+    """
+    global _view, _view_pid
+    if not enabled():
+        return None
+    with _view_lock:
+        if _view is None or _view_pid != os.getpid():
+            query = db.collection('plant_info') \
+                .where(filter=FieldFilter("removed", "==", False)) \
+                .where(filter=FieldFilter("invasive_info", "==", True))
+            _view = MarkerView(query)
+            _view_pid = os.getpid()
+            try:
+                _view.start()
+            except Exception as e:
+                # snapshot() retries after RESTART_BACKOFF.
+                print(f"Error starting marker listener: {e}")
+        return _view
+
+
+def warm_up():
+    """
+    Creates and fills this worker's view; a no-op when disabled. Called from
+    gunicorn's post_fork hook, never at import time.
+    """
+    try:
+        view = get_view()
+        if view is None:
+            return False
+        return view.warm_up()
+    except Exception as e:
+        print(f"Error warming up marker view: {e}")
+        return False
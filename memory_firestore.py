@@ -0,0 +1,662 @@
+import copy
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import BaseCompositeFilter, FieldFilter
+from google.cloud.firestore_v1.field_path import split_field_path
+from google.cloud.firestore_v1.types import StructuredQuery
+from google.cloud.firestore_v1.watch import ChangeType
+
+# A small in-memory stand-in for the Firestore client.
+#
+# It implements the subset of google-cloud-firestore that this backend uses
+# (collections, documents, filtered/ordered/paginated queries, projections,
+# write batches, transactions, field transforms and snapshot listeners) so the
+# app, the migrations and the benchmarks can run without network access or
+# credentials. Set FIRESTORE_BACKEND=memory to make firebase_client export one.
+
+DOCUMENT_ID = "__name__"
+
+_lock = threading.RLock()
+_clock = {"last": datetime.fromtimestamp(0, timezone.utc)}
+
+
+def _now():
+    """Returns a strictly increasing UTC timestamp, like server commit times."""
+    now = datetime.now(timezone.utc)
+    if now <= _clock["last"]:
+        now = _clock["last"] + timedelta(microseconds=1)
+    _clock["last"] = now
+    return now
+
+
+def _type_rank(value):
+    # Firestore orders values of different types by type first.
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    if isinstance(value, MemoryDocumentReference):
+        return 6
+    if isinstance(value, list):
+        return 8
+    return 9
+
+
+def _sort_key(value):
+    if isinstance(value, MemoryDocumentReference):
+        return (_type_rank(value), value.path)
+    if isinstance(value, (dict, list)):
+        return (_type_rank(value), repr(value))
+    return (_type_rank(value), value)
+
+
+def _get_path(data, field_path):
+    """Returns (found, value) for a dotted field path inside a document."""
+    if field_path == DOCUMENT_ID:
+        raise KeyError(field_path)
+    current = data
+    for part in split_field_path(field_path):
+        if not isinstance(current, dict) or part not in current:
+            return False, None
+        current = current[part]
+    return True, current
+
+
+def _apply_value(target, key, value, now):
+    """Writes value into target[key], resolving sentinels and transforms."""
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = now
+    elif isinstance(value, transforms.Increment):
+        current = target.get(key)
+        if not isinstance(current, (int, float)) or isinstance(current, bool):
+            current = 0
+        target[key] = current + value.value
+    elif isinstance(value, transforms.Maximum):
+        current = target.get(key)
+        target[key] = value.value if not isinstance(current, (int, float)) else max(current, value.value)
+    elif isinstance(value, transforms.Minimum):
+        current = target.get(key)
+        target[key] = value.value if not isinstance(current, (int, float)) else min(current, value.value)
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key) or [])
+        for item in value.values:
+            if item not in current:
+                current.append(item)
+        target[key] = current
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [item for item in (target.get(key) or []) if item not in value.values]
+    else:
+        target[key] = _resolve(value, now)
+
+
+def _resolve(value, now):
+    """Resolves sentinels nested inside a plain value that is written whole."""
+    if isinstance(value, dict):
+        resolved = {}
+        for key, item in value.items():
+            _apply_value(resolved, key, item, now)
+        return resolved
+    if isinstance(value, list):
+        return [copy.deepcopy(item) for item in value]
+    return copy.deepcopy(value)
+
+
+def _merge(target, data, now):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value, now)
+        else:
+            _apply_value(target, key, value, now)
+
+
+def _set_path(target, field_path, value, now):
+    parts = split_field_path(field_path)
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    _apply_value(target, parts[-1], value, now)
+
+
+def _project(data, field_paths):
+    if field_paths is None:
+        return copy.deepcopy(data)
+    projected = {}
+    for field_path in field_paths:
+        if field_path == DOCUMENT_ID:
+            # Selecting only the document ID returns no fields.
+            continue
+        found, value = _get_path(data, field_path)
+        if found:
+            _set_path(projected, field_path, value, None)
+    return projected
+
+
+def _matches(op, actual, expected):
+    if op == "==":
+        return actual == expected
+    if op == "!=":
+        return actual != expected
+    if op == "in":
+        return actual in expected
+    if op == "not-in":
+        return actual not in expected
+    if op == "array_contains":
+        return isinstance(actual, list) and expected in actual
+    if op == "array_contains_any":
+        return isinstance(actual, list) and any(item in actual for item in expected)
+    if _type_rank(actual) != _type_rank(expected):
+        return False
+    if op == "<":
+        return actual < expected
+    if op == "<=":
+        return actual <= expected
+    if op == ">":
+        return actual > expected
+    if op == ">=":
+        return actual >= expected
+    raise ValueError(f"Unsupported operator {op!r}")
+
+
+class MemoryDocumentSnapshot:
+    """Read-only view of a document at a point in time."""
+
+    def __init__(self, reference, data, create_time=None, update_time=None, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+        self._field_paths = field_paths
+        self.create_time = create_time
+        self.update_time = update_time
+        self.read_time = _clock["last"]
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        return _project(self._data, self._field_paths)
+
+    def get(self, field_path):
+        found, value = _get_path(self._data or {}, field_path)
+        if not found:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class MemoryDocumentReference:
+    def __init__(self, client, collection_name, doc_id):
+        self._client = client
+        self.id = doc_id
+        self._collection_name = collection_name
+        self.path = f"{collection_name}/{doc_id}"
+
+    @property
+    def parent(self):
+        return self._client.collection(self._collection_name)
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def _store(self):
+        return self._client._collections.setdefault(self._collection_name, {})
+
+    def get(self, field_paths=None, transaction=None):
+        with _lock:
+            record = self._store().get(self.id)
+            if record is None:
+                return MemoryDocumentSnapshot(self, None)
+            return MemoryDocumentSnapshot(
+                self, record["data"], record["create_time"], record["update_time"], field_paths
+            )
+
+    def _write(self, data, merge=False, must_exist=False, must_not_exist=False, now=None):
+        now = now or _now()
+        store = self._store()
+        record = store.get(self.id)
+        if must_exist and record is None:
+            raise NotFound(f"No document to update: {self.path}")
+        if must_not_exist and record is not None:
+            raise AlreadyExists(f"Document already exists: {self.path}")
+        if record is None:
+            record = {"data": {}, "create_time": now}
+            store[self.id] = record
+        if must_exist:
+            for field_path, value in data.items():
+                _set_path(record["data"], field_path, value, now)
+        elif merge:
+            _merge(record["data"], data, now)
+        else:
+            record["data"] = _resolve(data, now)
+        record["update_time"] = now
+        return now
+
+    def set(self, document_data, merge=False):
+        with _lock:
+            now = self._write(document_data, merge=merge)
+        self._client._notify(self._collection_name)
+        return now
+
+    def create(self, document_data):
+        with _lock:
+            now = self._write(document_data, must_not_exist=True)
+        self._client._notify(self._collection_name)
+        return now
+
+    def update(self, field_updates):
+        with _lock:
+            now = self._write(field_updates, must_exist=True)
+        self._client._notify(self._collection_name)
+        return now
+
+    def delete(self):
+        with _lock:
+            self._store().pop(self.id, None)
+            now = _now()
+        self._client._notify(self._collection_name)
+        return now
+
+
+class NotFound(Exception):
+    pass
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+class MemoryQuery:
+    def __init__(self, client, collection_name, filters=(), orders=(), limit=None,
+                 start=None, projection=None):
+        self._client = client
+        self._collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start = start
+        self._projection = projection
+
+    def _copy(self, **changes):
+        fields = dict(
+            filters=self._filters, orders=self._orders, limit=self._limit,
+            start=self._start, projection=self._projection,
+        )
+        fields.update(changes)
+        return MemoryQuery(self._client, self._collection_name, **fields)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, False))
+
+    def start_at(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, True))
+
+    def _filter_ok(self, doc_id, data, flt):
+        if isinstance(flt, BaseCompositeFilter):
+            results = [self._filter_ok(doc_id, data, inner) for inner in flt.filters]
+            is_or = flt.operator == StructuredQuery.CompositeFilter.Operator.OR
+            return any(results) if is_or else all(results)
+        if flt.field_path == DOCUMENT_ID:
+            found, actual = True, doc_id
+        else:
+            found, actual = _get_path(data, flt.field_path)
+        if not found:
+            return False
+        return _matches(flt.op_string, actual, flt.value)
+
+    def _effective_orders(self):
+        orders = list(self._orders)
+        if not orders:
+            for flt in self._filters:
+                if getattr(flt, "op_string", "==") in ("<", "<=", ">", ">=", "!=", "not-in"):
+                    orders.append((flt.field_path, "ASCENDING"))
+                    break
+        if not any(field == DOCUMENT_ID for field, _ in orders):
+            direction = orders[-1][1] if orders else "ASCENDING"
+            orders.append((DOCUMENT_ID, direction))
+        return orders
+
+    def _run(self):
+        orders = self._effective_orders()
+        store = self._client._collections.get(self._collection_name, {})
+        rows = []
+        for doc_id, record in store.items():
+            data = record["data"]
+            if not all(self._filter_ok(doc_id, data, flt) for flt in self._filters):
+                continue
+            values = []
+            missing = False
+            for field, _ in orders:
+                if field == DOCUMENT_ID:
+                    values.append(doc_id)
+                    continue
+                found, value = _get_path(data, field)
+                if not found:
+                    missing = True
+                    break
+                values.append(value)
+            if missing:
+                continue
+            rows.append((values, doc_id, record))
+
+        for index in range(len(orders) - 1, -1, -1):
+            descending = orders[index][1] in ("DESCENDING", "desc")
+            rows.sort(key=lambda row: _sort_key(row[0][index]), reverse=descending)
+
+        if self._start is not None:
+            rows = self._apply_start(rows, orders)
+        if self._limit is not None:
+            rows = rows[: self._limit]
+        return rows
+
+    def _apply_start(self, rows, orders):
+        cursor, inclusive = self._start
+        if isinstance(cursor, MemoryDocumentSnapshot):
+            data = cursor._data or {}
+            values = []
+            for field, _ in orders:
+                values.append(cursor.id if field == DOCUMENT_ID else _get_path(data, field)[1])
+        else:
+            values = []
+            for field, _ in orders:
+                if field not in cursor:
+                    break
+                value = cursor[field]
+                if isinstance(value, MemoryDocumentReference):
+                    value = value.id
+                values.append(value)
+
+        def compare(row_values):
+            for index, value in enumerate(values):
+                descending = orders[index][1] in ("DESCENDING", "desc")
+                left, right = _sort_key(row_values[index]), _sort_key(value)
+                if left == right:
+                    continue
+                result = -1 if left < right else 1
+                return -result if descending else result
+            return 0
+
+        kept = []
+        for row in rows:
+            result = compare(row[0])
+            if result > 0 or (inclusive and result == 0):
+                kept.append(row)
+        return kept
+
+    def _snapshots(self):
+        with _lock:
+            return [
+                MemoryDocumentSnapshot(
+                    MemoryDocumentReference(self._client, self._collection_name, doc_id),
+                    record["data"], record["create_time"], record["update_time"], self._projection,
+                )
+                for _, doc_id, record in self._run()
+            ]
+
+    def stream(self, transaction=None):
+        return iter(self._snapshots())
+
+    def get(self, transaction=None):
+        return self._snapshots()
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return MemoryDocumentReference(self._client, self._collection_name, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        now = ref.create(document_data)
+        return now, ref
+
+    def list_documents(self):
+        with _lock:
+            ids = list(self._client._collections.get(self._collection_name, {}))
+        return [self.document(doc_id) for doc_id in ids]
+
+
+class MemoryWriteOption:
+    """Write precondition, as returned by MemoryFirestore.write_option."""
+
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+
+class MemoryWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, document_data, merge))
+        return self
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference, document_data, False))
+        return self
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(("update", reference, field_updates, option))
+        return self
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+        return self
+
+    def commit(self):
+        touched = set()
+        with _lock:
+            now = _now()
+            # Check preconditions first so a failed batch writes nothing.
+            for kind, reference, _, option in self._writes:
+                record = reference._store().get(reference.id)
+                if kind == "update" and record is None:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if kind == "create" and record is not None:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                if isinstance(option, MemoryWriteOption) and option.last_update_time is not None \
+                        and record["update_time"] != option.last_update_time:
+                    raise FailedPrecondition(f"Document changed since it was read: {reference.path}")
+            for kind, reference, data, option in self._writes:
+                touched.add(reference._collection_name)
+                if kind == "delete":
+                    reference._store().pop(reference.id, None)
+                else:
+                    merge = option is True
+                    reference._write(data, merge=merge, must_exist=kind == "update", now=now)
+            writes = len(self._writes)
+            self._writes = []
+        for collection_name in touched:
+            self._client._notify(collection_name)
+        return [now] * writes
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    """
+    Serializes transactions behind the module lock, which is the strongest
+    form of the isolation Firestore gives. Works with @firestore.transactional.
+    """
+
+    _read_only = False
+
+    def __init__(self, client, max_attempts=5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._id = None
+        self._held = False
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        _lock.acquire()
+        self._held = True
+        self._id = uuid.uuid4().bytes
+
+    def _release(self):
+        if self._held:
+            self._held = False
+            _lock.release()
+
+    def _commit(self):
+        try:
+            return self.commit()
+        finally:
+            self._clean_up()
+            self._release()
+
+    def _rollback(self):
+        self._clean_up()
+        self._release()
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, MemoryDocumentReference):
+            return iter([ref_or_query.get()])
+        return ref_or_query.stream()
+
+    def get_all(self, references):
+        return self._client.get_all(references)
+
+
+class MemoryWatch:
+    def __init__(self, client, query, callback):
+        self._client = client
+        self._query = query
+        self._callback = callback
+        self._previous = {}
+        self._order = []
+        self._sent_initial = False
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._client._unwatch(self)
+
+    def close(self):
+        self.unsubscribe()
+
+    def _push(self):
+        snapshots = self._query._snapshots()
+        current = {snap.id: snap for snap in snapshots}
+        changes = []
+        for index, snap in enumerate(snapshots):
+            previous = self._previous.get(snap.id)
+            if previous is None:
+                changes.append(MemoryDocumentChange(ChangeType.ADDED, snap, -1, index))
+            elif previous.update_time != snap.update_time:
+                changes.append(MemoryDocumentChange(ChangeType.MODIFIED, snap, self._order.index(snap.id), index))
+        for doc_id, snap in self._previous.items():
+            if doc_id not in current:
+                changes.append(MemoryDocumentChange(ChangeType.REMOVED, snap, self._order.index(doc_id), -1))
+        self._previous = current
+        self._order = [snap.id for snap in snapshots]
+        if changes or not self._sent_initial:
+            self._sent_initial = True
+            self._callback(snapshots, changes, _clock["last"])
+
+
+class MemoryDocumentChange:
+    def __init__(self, change_type, document, old_index, new_index):
+        self.type = change_type
+        self.document = document
+        self.old_index = old_index
+        self.new_index = new_index
+
+
+class MemoryFirestore:
+    """Drop-in replacement for firestore.Client backed by dictionaries."""
+
+    def __init__(self):
+        self._collections = {}
+        self._watches = []
+        self._watch_lock = threading.Lock()
+
+    def collection(self, name):
+        return MemoryCollectionReference(self, name)
+
+    def document(self, path):
+        collection_name, doc_id = path.split("/", 1)
+        return self.collection(collection_name).document(doc_id)
+
+    def batch(self):
+        return MemoryWriteBatch(self)
+
+    def write_option(self, last_update_time=None, exists=None):
+        return MemoryWriteOption(last_update_time=last_update_time, exists=exists)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return MemoryTransaction(self, max_attempts=max_attempts)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for reference in references:
+            yield reference.get(field_paths=field_paths)
+
+    def collections(self):
+        return [self.collection(name) for name in list(self._collections)]
+
+    def reset(self):
+        with _lock:
+            self._collections.clear()
+
+    def _watch(self, query, callback):
+        watch = MemoryWatch(self, query, callback)
+        with self._watch_lock:
+            self._watches.append(watch)
+        watch._push()
+        return watch
+
+    def _unwatch(self, watch):
+        with self._watch_lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, collection_name):
+        with self._watch_lock:
+            watches = [w for w in self._watches if w._query._collection_name == collection_name]
+        for watch in watches:
+            watch._push()
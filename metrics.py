@@ -0,0 +1,381 @@
+import bisect
+import collections
+import contextvars
+import os
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+# Hot-path timing instrumentation.
+#
+# Timers around each ingestion stage, storage operation and outbound provider
+# call feed Prometheus-style histograms and counters, exposed as text on
+# /metrics, and the timings of the current request are echoed back in a
+# Server-Timing header. With METRICS_SLOW_MS set, a sampling profiler records
+# the stacks of in-flight requests and hands those slower than the threshold
+# to the slow-request hook (by default written as collapsed stacks, the input
+# format of flamegraph.pl and speedscope).
+#
+# Everything is off unless METRICS=on; then timer() returns a shared no-op and
+# init_app registers nothing, so the instrumented code pays one function call.
+
+load_dotenv()
+
+ENABLED = os.getenv("METRICS", "off").lower() == "on"
+SLOW_MS = float(os.getenv("METRICS_SLOW_MS", "0"))
+PROFILE_INTERVAL = float(os.getenv("METRICS_PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_DIR = os.getenv("METRICS_PROFILE_DIR", "slow_requests")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+HELP = {
+    "http_request_duration_seconds": "Time spent handling HTTP requests.",
+    "http_response_size_bytes": "Size of HTTP response bodies.",
+    "ingest_stage_duration_seconds": "Time spent in each report ingestion stage.",
+    "storage_operation_duration_seconds": "Time spent in report storage operations.",
+    "outbound_request_duration_seconds": "Time spent in calls to external providers, including retries.",
+    "outbound_requests_total": "Attempts sent to external providers.",
+    "outbound_errors_total": "Failed attempts to external providers.",
+    "outbound_rejected_total": "Provider calls rejected by the circuit breaker or concurrency cap.",
+    "classify_batch_size": "Plants classified per LLM request.",
+    "invasive_index_lookups_total": "Bundled invasive species index lookups, by hit or miss.",
+    "verdict_cache_lookups_total": "Invasive verdict cache lookups, by hit or miss.",
+    "tile_requests_total": "Density tile requests, by disk cache hit or miss.",
+    "tile_render_duration_seconds": "Time spent computing density tiles.",
+    "admission_requests_total": "Expensive requests by admission outcome: admitted, or why they were rejected.",
+    "admission_wait_seconds": "Time spent waiting for a pipeline slot.",
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> _Histogram
+_counters = collections.Counter()  # (name, labels) -> value
+# Per-request state. Context variables rather than thread-locals, so requests
+# served concurrently on one event loop (asgi.py) keep separate timings.
+_timings = contextvars.ContextVar("metrics_timings", default=None)
+_started = contextvars.ContextVar("metrics_started", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Records a value in a histogram."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+def inc(name, amount=1, **labels):
+    """Increments a counter."""
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+class _Timer:
+    __slots__ = ("name", "labels", "timing_name", "started")
+
+    def __init__(self, name, timing_name, labels):
+        self.name = name
+        self.timing_name = timing_name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.started, self.timing_name, **self.labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopTimer()
+
+
+def timer(name, timing_name=None, **labels):
+    """
+    Returns a context manager that records its duration in the named
+    histogram and, under timing_name, in the current request's Server-Timing.
+    """
+    if not ENABLED:
+        return _NOOP
+    return _Timer(name, timing_name, labels)
+
+
+def record(name, elapsed, timing_name=None, **labels):
+    """Records a duration measured by the caller, like a timer would."""
+    observe(name, elapsed, **labels)
+    timings = _timings.get()
+    if timings is not None and timing_name:
+        total, count = timings.get(timing_name, (0.0, 0))
+        timings[timing_name] = (total + elapsed, count + 1)
+
+
+def timed_iter(iterable, name, timing_name=None, **labels):
+    """
+    Wraps an iterator so the total time spent producing its items, not the
+    time the consumer holds them, is recorded as one duration.
+    """
+    if not ENABLED:
+        return iterable
+    return _timed_iter(iter(iterable), name, timing_name, labels)
+
+
+def _timed_iter(iterator, name, timing_name, labels):
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - started
+                return
+            elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        record(name, elapsed, timing_name, **labels)
+
+
+# ────────────── Exposition ──────────────
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format."""
+    with _lock:
+        histograms = [(key, hist.buckets, list(hist.counts), hist.sum, hist.count) for key, hist in _histograms.items()]
+        counters = list(_counters.items())
+    lines = []
+    seen = set()
+    for (name, labels), value in sorted(counters):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), buckets, counts, total, count in sorted(histograms, key=lambda item: item[0]):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Clears every metric (for tests and benchmarks)."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+# ────────────── Slow-request profiler ──────────────
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of registered request threads every `interval`
+    seconds from a background thread, counting identical stacks.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}  # thread id -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def begin(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = collections.Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+
+    def end(self, thread_id):
+        """Stops sampling a thread and returns its stack counts."""
+        with self._lock:
+            return self._active.pop(thread_id, collections.Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                thread_ids = list(self._active)
+            if not thread_ids:
+                continue
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    samples = self._active.get(thread_id)
+                    if samples is not None:
+                        samples[";".join(reversed(stack))] += 1
+
+
+def write_collapsed_stacks(request_info, duration, stacks):
+    """
+    Default slow-request hook: writes the sampled stacks in collapsed format
+    to METRICS_PROFILE_DIR.
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{int(time.time() * 1000)}-{request_info['endpoint'] or 'unknown'}-{os.getpid()}.folded"
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path, "w") as output:
+        for stack, count in stacks.most_common():
+            output.write(f"{stack} {count}\n")
+    print(f"Slow request {request_info['method']} {request_info['path']} took {duration * 1000:.0f}ms; profile in {path}")
+
+
+_profiler = SamplingProfiler(PROFILE_INTERVAL) if ENABLED and SLOW_MS > 0 else None
+_slow_request_hook = write_collapsed_stacks
+
+
+def set_slow_request_hook(hook):
+    """
+    Replaces the slow-request hook. It is called as
+    hook(request_info, duration_seconds, stacks) with request_info holding
+    method, path, endpoint and status, and stacks a Counter of collapsed stacks.
+    """
+    global _slow_request_hook
+    _slow_request_hook = hook
+
+
+# ────────────── Request timing ──────────────
+
+def begin_request():
+    """Starts timing a request in the current thread or asyncio task."""
+    _timings.set({})
+    _started.set(time.perf_counter())
+
+
+def finish_request(method, endpoint, status, size):
+    """
+    Records the request started by begin_request in the request histograms.
+
+    Returns:
+        (elapsed_seconds, server_timing_header), or None if no request was started.
+    """
+    started = _started.get()
+    if started is None:
+        return None
+    elapsed = time.perf_counter() - started
+    timings = _timings.get()
+    _timings.set(None)
+    _started.set(None)
+
+    observe("http_request_duration_seconds", elapsed, endpoint=endpoint, method=method, status=status)
+    if size is not None:
+        observe("http_response_size_bytes", size, buckets=SIZE_BUCKETS, endpoint=endpoint)
+
+    entries = [
+        f"{name};dur={total * 1000:.1f}" + (f';desc="x{count}"' if count > 1 else "")
+        for name, (total, count) in timings.items()
+    ]
+    entries.append(f"total;dur={elapsed * 1000:.1f}")
+    return elapsed, ", ".join(entries)
+
+
+# ────────────── Flask integration ──────────────
+
+def init_app(app):
+    """
+    Adds request timing, the Server-Timing header and the /metrics endpoint
+    to a Flask app. Does nothing unless METRICS=on.
+    """
+    if not ENABLED:
+        return
+
+    from flask import Response, request
+
+    @app.before_request
+    def _start_timing():
+        begin_request()
+        if _profiler is not None:
+            _profiler.begin(threading.get_ident())
+
+    @app.after_request
+    def _finish_timing(response):
+        endpoint = request.endpoint or "unknown"
+        finished = finish_request(request.method, endpoint, response.status_code,
+                                  response.calculate_content_length())
+        if finished is None:
+            return response
+        elapsed, server_timing = finished
+        response.headers["Server-Timing"] = server_timing
+
+        if _profiler is not None:
+            stacks = _profiler.end(threading.get_ident())
+            if elapsed * 1000 >= SLOW_MS and stacks:
+                request_info = {"method": request.method, "path": request.path,
+                                "endpoint": endpoint, "status": response.status_code}
+                try:
+                    _slow_request_hook(request_info, elapsed, stacks)
+                except Exception as e:
+                    print(f"Error in slow request hook: {e}")
+        return response
+
+    @app.teardown_request
+    def _stop_profiling(exc):
+        if _profiler is not None:
+            _profiler.end(threading.get_ident())
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,54 @@
+# One-off migration: stamps 'created_at' on 'plant_info' documents written
+# before it existed, so paged /getUserReportsInfo (which orders by it) returns
+# them. It is set to the document's creation time, which is when the report
+# was filed. Safe to re-run; documents that already have 'created_at' are skipped.
+#
+# to run: python migrate_created_at.py
+
+from firebase_client import db
+
+BATCH_SIZE = 400
+
+
+def backfill():
+    """
+    Walks the 'plant_info' collection in document ID order and sets
+    'created_at' to the document's create time on documents that lack it.
+
+    Returns:
+        A tuple of (updated, skipped) document counts.
+    """
+    collection = db.collection('plant_info')
+    updated = 0
+    skipped = 0
+    last_doc = None
+
+    while True:
+        query = collection.order_by('__name__').limit(BATCH_SIZE)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.select(['created_at', 'updated_at']).stream())
+        if not docs:
+            break
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            data = doc.to_dict()
+            if data.get('created_at') is not None:
+                skipped += 1
+                continue
+            batch.update(doc.reference, {'created_at': doc.create_time or data.get('updated_at')})
+            pending += 1
+        if pending:
+            batch.commit()
+            updated += pending
+        print(f"Processed {updated + skipped} documents ({updated} updated).")
+        last_doc = docs[-1]
+
+    return updated, skipped
+
+
+if __name__ == "__main__":
+    updated, skipped = backfill()
+    print(f"Done. Updated {updated}, skipped {skipped}.")
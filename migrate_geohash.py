@@ -0,0 +1,61 @@
+import geo
+
+# One-off migration: backfills 'lat_num', 'lng_num' and 'geohash' on existing
+# 'plant_info' documents, which were written with string 'lat'/'lng' only.
+# Safe to re-run; documents that already have a geohash are skipped.
+#
+# to run: python migrate_geohash.py
+
+from firebase_client import db
+
+BATCH_SIZE = 400
+
+
+def backfill():
+    """
+    Walks the 'plant_info' collection in document ID order and writes the
+    numeric coordinates and geohash used by the bbox marker queries.
+
+    Returns:
+        A tuple of (updated, skipped) document counts.
+    """
+    collection = db.collection('plant_info')
+    updated = 0
+    skipped = 0
+    last_doc = None
+
+    while True:
+        query = collection.order_by('__name__').limit(BATCH_SIZE)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            data = doc.to_dict()
+            lat = geo.to_float(data.get('lat'))
+            lng = geo.to_float(data.get('lng'))
+            if data.get('geohash') or lat is None or lng is None:
+                skipped += 1
+                continue
+            batch.update(doc.reference, {
+                'lat_num': lat,
+                'lng_num': lng,
+                'geohash': geo.encode(lat, lng),
+            })
+            pending += 1
+        if pending:
+            batch.commit()
+            updated += pending
+        print(f"Processed {updated + skipped} documents ({updated} updated).")
+        last_doc = docs[-1]
+
+    return updated, skipped
+
+
+if __name__ == "__main__":
+    updated, skipped = backfill()
+    print(f"Done. Updated {updated}, skipped {skipped}.")
@@ -0,0 +1,63 @@
+import imagestore
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+# One-off migration: moves image bytes stored inline on older 'plant_info'
+# documents into the image store and replaces them with 'image_hash'.
+# Safe to re-run; documents without inline bytes are skipped.
+#
+# to run: python migrate_images.py
+
+from firebase_client import db
+
+BATCH_SIZE = 100
+
+
+def migrate():
+    """
+    Walks the 'plant_info' collection in document ID order and externalizes
+    every inline 'image' field.
+
+    Returns:
+        A tuple of (migrated, skipped) document counts.
+    """
+    collection = db.collection('plant_info')
+    store = imagestore.get_store()
+    migrated = 0
+    skipped = 0
+    last_doc = None
+
+    while True:
+        query = collection.order_by('__name__').limit(BATCH_SIZE)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            image = doc.to_dict().get('image')
+            if not isinstance(image, bytes):
+                skipped += 1
+                continue
+            try:
+                image_hash = store.put(image)
+            except Exception as e:
+                print(f"Skipping {doc.id}: could not store image: {e}")
+                skipped += 1
+                continue
+            batch.update(doc.reference, {'image_hash': image_hash, 'image': DELETE_FIELD})
+            pending += 1
+        if pending:
+            batch.commit()
+            migrated += pending
+        print(f"Processed {migrated + skipped} documents ({migrated} migrated).")
+        last_doc = docs[-1]
+
+    return migrated, skipped
+
+
+if __name__ == "__main__":
+    migrated, skipped = migrate()
+    print(f"Done. Migrated {migrated}, skipped {skipped}.")
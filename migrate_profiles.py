@@ -0,0 +1,53 @@
+import userstats
+
+# One-off migration: moves 'users' documents written with auto-generated IDs
+# to their email key (see userstats.py), so profiles are read by ID instead of
+# with an email query, then rebuilds every user's stats from their reports.
+# Fields already on the keyed document (such as stats) are kept.
+# Safe to re-run; documents already under their email key are skipped.
+#
+# to run: python migrate_profiles.py
+
+from firebase_client import db
+
+BATCH_SIZE = 200
+
+
+def rekey():
+    """
+    Copies each 'users' document whose ID is not its email key to that key
+    and deletes the original. Documents without an email are skipped.
+
+    Returns:
+        A tuple of (moved, skipped) document counts.
+    """
+    collection = db.collection(userstats.COLLECTION)
+    moved = 0
+    skipped = 0
+    batch = db.batch()
+    pending = 0
+    for doc in collection.stream():
+        data = doc.to_dict()
+        email = data.get('email')
+        if not email or doc.id == userstats.profile_key(email):
+            skipped += 1
+            continue
+        batch.set(collection.document(userstats.profile_key(email)), data, merge=True)
+        batch.delete(doc.reference)
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            moved += pending
+            print(f"Moved {moved} profiles.")
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+        moved += pending
+    return moved, skipped
+
+
+if __name__ == "__main__":
+    moved, skipped = rekey()
+    print(f"Moved {moved} profiles, skipped {skipped}.")
+    print(f"Rebuilt stats for {userstats.rebuild()} users.")
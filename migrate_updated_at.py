@@ -0,0 +1,54 @@
+from firebase_admin import firestore
+
+# One-off migration: stamps 'updated_at' on 'plant_info' documents written
+# before the sync feed existed, so /getMarkers?since=0 returns them.
+# Safe to re-run; documents that already have 'updated_at' are skipped.
+#
+# to run: python migrate_updated_at.py
+
+from firebase_client import db
+
+BATCH_SIZE = 400
+
+
+def backfill():
+    """
+    Walks the 'plant_info' collection in document ID order and sets
+    'updated_at' to the server time on documents that lack it.
+
+    Returns:
+        A tuple of (updated, skipped) document counts.
+    """
+    collection = db.collection('plant_info')
+    updated = 0
+    skipped = 0
+    last_doc = None
+
+    while True:
+        query = collection.order_by('__name__').limit(BATCH_SIZE)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.select(['updated_at']).stream())
+        if not docs:
+            break
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            if doc.to_dict().get('updated_at') is not None:
+                skipped += 1
+                continue
+            batch.update(doc.reference, {'updated_at': firestore.SERVER_TIMESTAMP})
+            pending += 1
+        if pending:
+            batch.commit()
+            updated += pending
+        print(f"Processed {updated + skipped} documents ({updated} updated).")
+        last_doc = docs[-1]
+
+    return updated, skipped
+
+
+if __name__ == "__main__":
+    updated, skipped = backfill()
+    print(f"Done. Updated {updated}, skipped {skipped}.")
@@ -0,0 +1,470 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Shared outbound clients for the providers this backend calls (PlantNet and
+# OpenAI).
+#
+# Each provider gets one process-wide client with a keep-alive connection pool,
+# a cap on concurrent calls, connect and read timeouts, jittered exponential
+# retry, and a circuit breaker that fails fast while the provider is down.
+# Everything is configured per provider through environment variables prefixed
+# with the provider name, e.g. PLANTNET_READ_TIMEOUT or OPENAI_MAX_CONCURRENCY.
+# PLANTNET_URL and OPENAI_BASE_URL point the clients at a local stub server.
+#
+# The ASGI app (asgi.py) uses the asyncio clients from get_async_provider
+# instead: httpx.AsyncClient for PlantNet and AsyncOpenAI, with the same
+# limits, awaiting instead of blocking a thread per call.
+
+load_dotenv()
+
+# Defaults per provider; each one can be overridden by <PROVIDER>_<KEY>.
+DEFAULTS = {
+    "plantnet": {
+        "URL": "https://my-api.plantnet.org",
+        "CONNECT_TIMEOUT": 3.05,
+        "READ_TIMEOUT": 15.0,
+        "MAX_CONCURRENCY": 8,
+        "POOL_SIZE": 8,
+        "RETRIES": 2,
+        "BACKOFF": 0.25,
+        "BREAKER_THRESHOLD": 5,
+        "BREAKER_RESET": 30.0,
+        "ACQUIRE_TIMEOUT": 10.0,
+    },
+    "openai": {
+        "BASE_URL": None,
+        "CONNECT_TIMEOUT": 3.05,
+        "READ_TIMEOUT": 30.0,
+        "MAX_CONCURRENCY": 8,
+        "POOL_SIZE": 8,
+        "RETRIES": 2,
+        "BACKOFF": 0.5,
+        "BREAKER_THRESHOLD": 5,
+        "BREAKER_RESET": 30.0,
+        "ACQUIRE_TIMEOUT": 10.0,
+    },
+}
+
+# Status codes worth retrying: throttling and transient server errors.
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ProviderUnavailable(Exception):
+    """Raised without calling the provider when its breaker is open or it is saturated."""
+
+
+class RetryableStatus(Exception):
+    """Raised for a retryable HTTP status so the retry loop can handle it."""
+
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+def load_config(name):
+    """
+    Returns the configuration dictionary for a provider, applying any
+    <PROVIDER>_<KEY> environment overrides to the defaults.
+    """
+    config = {}
+    for key, default in DEFAULTS[name].items():
+        raw = os.getenv(f"{name.upper()}_{key}")
+        if raw is None:
+            config[key] = default
+        elif isinstance(default, int):
+            config[key] = int(raw)
+        elif isinstance(default, float):
+            config[key] = float(raw)
+        else:
+            config[key] = raw
+    return config
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for
+    `reset_seconds`. After that it lets a single trial call through (half-open)
+    and closes again if the trial succeeds.
+    """
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Returns True if a call may go ahead, "trial" if it is the single
+        half-open trial call, and False if it must be rejected. A trial that
+        ends without recording an outcome must be handed back with release_trial.
+        """
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return "trial"
+            return False
+
+    def release_trial(self):
+        """Lets another call take the half-open trial, e.g. after a rejected or cancelled trial."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class Provider:
+    """
+    Runs calls to one provider with a concurrency cap, retries and a breaker.
+    """
+
+    def __init__(self, name, config, retryable=()):
+        self.name = name
+        self.config = config
+        self.retryable = (RetryableStatus,) + tuple(retryable)
+        self.breaker = CircuitBreaker(config["BREAKER_THRESHOLD"], config["BREAKER_RESET"])
+        self._slots = threading.BoundedSemaphore(config["MAX_CONCURRENCY"])
+        self._async_slots = asyncio.BoundedSemaphore(config["MAX_CONCURRENCY"])
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self._counter_lock = threading.Lock()
+
+    # Local counter -> exported counter.
+    _METRICS = {
+        "calls": "outbound_requests_total",
+        "errors": "outbound_errors_total",
+        "rejected": "outbound_rejected_total",
+    }
+
+    def _count(self, name):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+        metrics.inc(self._METRICS[name], provider=self.name)
+
+    def _backoff(self, attempt):
+        # Full jitter: sleep a random time up to the exponential backoff.
+        return random.uniform(0, self.config["BACKOFF"] * (2 ** attempt))
+
+    def call(self, fn):
+        """
+        Calls fn() under this provider's limits and returns its result.
+
+        Retryable exceptions are retried up to RETRIES times with jittered
+        backoff; anything else propagates immediately.
+
+        Raises:
+            ProviderUnavailable: If the breaker is open or no slot frees up in time.
+        """
+        with metrics.timer("outbound_request_duration_seconds", self.name, provider=self.name):
+            return self._call(fn)
+
+    def _call(self, fn):
+        permit = self.breaker.allow()
+        if not permit:
+            self._count("rejected")
+            raise ProviderUnavailable(f"{self.name} is unavailable (circuit open)")
+        settled = False
+        try:
+            if not self._slots.acquire(timeout=self.config["ACQUIRE_TIMEOUT"]):
+                self._count("rejected")
+                raise ProviderUnavailable(f"{self.name} is saturated")
+            try:
+                attempt = 0
+                while True:
+                    self._count("calls")
+                    try:
+                        result = fn()
+                    except self.retryable as e:
+                        self._count("errors")
+                        if attempt >= self.config["RETRIES"]:
+                            settled = True
+                            self.breaker.record_failure()
+                            if isinstance(e, RetryableStatus):
+                                return e.response
+                            raise
+                        time.sleep(self._backoff(attempt))
+                        attempt += 1
+                        continue
+                    except Exception:
+                        self._count("errors")
+                        settled = True
+                        self.breaker.record_failure()
+                        raise
+                    settled = True
+                    self.breaker.record_success()
+                    return result
+            finally:
+                self._slots.release()
+        finally:
+            # A trial that never reached an outcome (no slot, interrupted)
+            # must not hold the half-open breaker shut for good.
+            if permit == "trial" and not settled:
+                self.breaker.release_trial()
+
+    async def acall(self, fn):
+        """
+        Like call(), for a coroutine function fn. Waiting for a slot, the
+        provider and the backoff all yield to the event loop.
+        """
+        with metrics.timer("outbound_request_duration_seconds", self.name, provider=self.name):
+            return await self._acall(fn)
+
+    async def _acall(self, fn):
+        permit = self.breaker.allow()
+        if not permit:
+            self._count("rejected")
+            raise ProviderUnavailable(f"{self.name} is unavailable (circuit open)")
+        settled = False
+        try:
+            try:
+                await asyncio.wait_for(self._async_slots.acquire(), self.config["ACQUIRE_TIMEOUT"])
+            except asyncio.TimeoutError:
+                self._count("rejected")
+                raise ProviderUnavailable(f"{self.name} is saturated")
+            try:
+                attempt = 0
+                while True:
+                    self._count("calls")
+                    try:
+                        result = await fn()
+                    except self.retryable as e:
+                        self._count("errors")
+                        if attempt >= self.config["RETRIES"]:
+                            settled = True
+                            self.breaker.record_failure()
+                            if isinstance(e, RetryableStatus):
+                                return e.response
+                            raise
+                        await asyncio.sleep(self._backoff(attempt))
+                        attempt += 1
+                        continue
+                    except Exception:
+                        self._count("errors")
+                        settled = True
+                        self.breaker.record_failure()
+                        raise
+                    settled = True
+                    self.breaker.record_success()
+                    return result
+            finally:
+                self._async_slots.release()
+        finally:
+            # Also covers cancellation, which is not an Exception.
+            if permit == "trial" and not settled:
+                self.breaker.release_trial()
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "breaker": self.breaker.state,
+        }
+
+
+class HTTPProvider(Provider):
+    """A provider reached with `requests` through a pooled keep-alive session."""
+
+    def __init__(self, name, config):
+        super().__init__(name, config, retryable=(requests.ConnectionError, requests.Timeout))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config["POOL_SIZE"], max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request with the provider's timeouts, retries and breaker.
+        Returns the final response; a retryable status is returned once retries run out.
+        """
+        kwargs.setdefault("timeout", (self.config["CONNECT_TIMEOUT"], self.config["READ_TIMEOUT"]))
+
+        def send():
+            # File-like bodies are consumed by each attempt, so rewind them first.
+            for _, value in (kwargs.get("files") or {}).items():
+                if isinstance(value, tuple) and hasattr(value[1], "seek"):
+                    value[1].seek(0)
+            response = self.session.request(method, url, **kwargs)
+            if response.status_code in RETRYABLE_STATUSES:
+                raise RetryableStatus(response)
+            return response
+
+        return self.call(send)
+
+
+class OpenAIProvider(Provider):
+    """Wraps one shared OpenAI client with pooled connections and timeouts."""
+
+    def __init__(self, name, config):
+        import httpx
+        import openai
+
+        super().__init__(name, config, retryable=(
+            openai.APIConnectionError,
+            openai.APITimeoutError,
+            openai.RateLimitError,
+            openai.InternalServerError,
+        ))
+        self.client = openai.OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=config["BASE_URL"],
+            timeout=httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"]),
+            # Retries are handled by Provider.call so they share the breaker.
+            max_retries=0,
+            http_client=httpx.Client(limits=httpx.Limits(
+                max_connections=config["POOL_SIZE"],
+                max_keepalive_connections=config["POOL_SIZE"],
+            )),
+        )
+
+    def chat(self, **kwargs):
+        """Runs client.chat.completions.create(**kwargs) under the provider's limits."""
+        return self.call(lambda: self.client.chat.completions.create(**kwargs))
+
+
+class AsyncHTTPProvider(Provider):
+    """A provider reached with a pooled httpx.AsyncClient."""
+
+    def __init__(self, name, config):
+        import httpx
+
+        super().__init__(name, config, retryable=(httpx.TransportError,))
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"]),
+            limits=httpx.Limits(max_connections=config["POOL_SIZE"], max_keepalive_connections=config["POOL_SIZE"]),
+        )
+
+    async def request(self, method, url, **kwargs):
+        """
+        Sends a request with the provider's timeouts, retries and breaker.
+        Returns the final httpx.Response; a retryable status is returned once
+        retries run out. Pass file contents as bytes so every attempt can resend them.
+        """
+        async def send():
+            response = await self.client.request(method, url, **kwargs)
+            if response.status_code in RETRYABLE_STATUSES:
+                raise RetryableStatus(response)
+            return response
+
+        return await self.acall(send)
+
+
+class AsyncOpenAIProvider(Provider):
+    """Wraps one shared AsyncOpenAI client with pooled connections and timeouts."""
+
+    def __init__(self, name, config):
+        import httpx
+        import openai
+
+        super().__init__(name, config, retryable=(
+            openai.APIConnectionError,
+            openai.APITimeoutError,
+            openai.RateLimitError,
+            openai.InternalServerError,
+        ))
+        self.client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=config["BASE_URL"],
+            timeout=httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"]),
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=config["POOL_SIZE"],
+                max_keepalive_connections=config["POOL_SIZE"],
+            )),
+        )
+
+    async def chat(self, **kwargs):
+        """Awaits client.chat.completions.create(**kwargs) under the provider's limits."""
+        return await self.acall(lambda: self.client.chat.completions.create(**kwargs))
+
+
+_PROVIDER_CLASSES = {
+    "plantnet": HTTPProvider,
+    "openai": OpenAIProvider,
+}
+_ASYNC_PROVIDER_CLASSES = {
+    "plantnet": AsyncHTTPProvider,
+    "openai": AsyncOpenAIProvider,
+}
+_providers = {}
+_async_providers = {}
+_providers_pid = None
+_providers_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _providers_pid
+    if _providers_pid != os.getpid():
+        _providers.clear()
+        _async_providers.clear()
+        _providers_pid = os.getpid()
+
+
+def get_provider(name):
+    """
+    Returns the process-wide client for a provider, creating it on first use.
+    Clients are rebuilt after a fork so gunicorn workers never share sockets.
+    """
+    with _providers_lock:
+        _reset_after_fork()
+        if name not in _providers:
+            _providers[name] = _PROVIDER_CLASSES[name](name, load_config(name))
+        return _providers[name]
+
+
+def get_async_provider(name):
+    """
+    Returns the process-wide asyncio client for a provider, creating it on
+    first use. Use it from a single event loop (the ASGI server's).
+    """
+    with _providers_lock:
+        _reset_after_fork()
+        if name not in _async_providers:
+            _async_providers[name] = _ASYNC_PROVIDER_CLASSES[name](name, load_config(name))
+        return _async_providers[name]
+
+
+def stats():
+    """Returns call, error and breaker counters for every provider created so far."""
+    with _providers_lock:
+        result = {name: provider.stats() for name, provider in _providers.items()}
+        result.update({f"{name}_async": provider.stats() for name, provider in _async_providers.items()})
+        return result
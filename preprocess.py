@@ -0,0 +1,187 @@
+import os
+import tempfile
+from io import BytesIO
+
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+# Bounded-memory preprocessing for uploaded report images.
+#
+# Phone photos are often 12+ megapixels and several megabytes, far more than
+# PlantNet needs and more than a Firestore document can hold. Uploads are
+# spooled to disk past a small threshold, decoded at reduced size with PIL's
+# JPEG draft mode, rotated according to their EXIF orientation, stripped of
+# metadata and re-encoded under a byte budget. Hard caps on upload bytes and
+# source pixels reject anything that would blow up memory while decoding.
+
+load_dotenv()
+
+MAX_UPLOAD_BYTES = int(os.getenv("PREPROCESS_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_SOURCE_PIXELS = int(os.getenv("PREPROCESS_MAX_PIXELS", str(50_000_000)))
+MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", "1600"))
+TARGET_BYTES = int(os.getenv("PREPROCESS_TARGET_BYTES", str(400 * 1024)))
+OUTPUT_FORMAT = os.getenv("PREPROCESS_FORMAT", "JPEG").upper()
+
+# Uploads up to this size stay in memory; larger ones are spooled to a temp file.
+SPOOL_THRESHOLD = 1024 * 1024
+_CHUNK = 64 * 1024
+_QUALITIES = (85, 75, 65, 55, 45)
+_GPS_IFD = 0x8825
+_MIN_EDGE = 320
+
+
+class ImageRejected(Exception):
+    """Raised when an upload is not a usable image or exceeds the caps."""
+
+
+class PreparedImage:
+    """The re-encoded image that is identified and stored."""
+
+    def __init__(self, data, mime, width, height):
+        self.data = data
+        self.mime = mime
+        self.width = width
+        self.height = height
+
+    @property
+    def filename(self):
+        return "capture.webp" if self.mime == "image/webp" else "capture.jpg"
+
+
+def spool_upload(stream, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Copies an upload stream into a spooled temporary file, in chunks.
+
+    Returns:
+        A file object positioned at the start. The caller closes it.
+
+    Raises:
+        ImageRejected: If the upload is larger than max_bytes.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+    total = 0
+    while True:
+        chunk = stream.read(_CHUNK)
+        if not chunk:
+            break
+        total += len(chunk)
+        if total > max_bytes:
+            spooled.close()
+            raise ImageRejected("Image is too large")
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def check_header(fileobj):
+    """
+    Reads only the image header and checks format and pixel count.
+
+    Raises:
+        ImageRejected: If the file is not an image or has too many pixels.
+    """
+    # PIL's own decompression bomb limit is left as it is; the explicit check
+    # below is what enforces MAX_SOURCE_PIXELS.
+    try:
+        img = Image.open(fileobj)
+        width, height = img.size
+    except Image.DecompressionBombError:
+        raise ImageRejected("Image has too many pixels")
+    except Exception:
+        raise ImageRejected("Invalid image file")
+    finally:
+        fileobj.seek(0)
+    if width * height > MAX_SOURCE_PIXELS:
+        raise ImageRejected("Image has too many pixels")
+
+
+def _degrees(value, ref, negative_ref):
+    # EXIF stores a coordinate as (degrees, minutes, seconds) rationals plus an N/S or E/W reference.
+    if not value or len(value) != 3:
+        return None
+    degrees = float(value[0]) + float(value[1]) / 60.0 + float(value[2]) / 3600.0
+    if isinstance(ref, bytes):
+        ref = ref.decode("ascii", errors="ignore")
+    return -degrees if (ref or "").strip().upper() == negative_ref else degrees
+
+
+def gps_coordinates(fileobj):
+    """
+    Reads the GPS position from an image's EXIF data without decoding it.
+
+    Returns:
+        (lat, lng) as floats, or None if the image has no usable GPS tags.
+    """
+    try:
+        gps = Image.open(fileobj).getexif().get_ifd(_GPS_IFD)
+        lat = _degrees(gps.get(2), gps.get(1), "S")
+        lng = _degrees(gps.get(4), gps.get(3), "W")
+    except Exception:
+        return None
+    finally:
+        fileobj.seek(0)
+    if lat is None or lng is None or (lat == 0.0 and lng == 0.0):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return None
+    return lat, lng
+
+
+def _encode(img, quality):
+    output = BytesIO()
+    if OUTPUT_FORMAT == "WEBP":
+        img.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def prepare_image(fileobj, max_edge=MAX_EDGE, target_bytes=TARGET_BYTES):
+    """
+    Decodes, downscales, orients and re-encodes an uploaded image.
+
+    Parameters:
+        fileobj: A seekable file object holding the upload.
+        max_edge (int): Longest edge of the output, in pixels.
+        target_bytes (int): Size budget for the encoded output.
+
+    Returns:
+        A PreparedImage. No EXIF or other metadata is carried over.
+
+    Raises:
+        ImageRejected: If the upload is not a usable image or exceeds the caps.
+    """
+    check_header(fileobj)
+    try:
+        img = Image.open(fileobj)
+        # For JPEGs this makes the decoder scale by 1/2, 1/4 or 1/8 while
+        # decoding, so the full-resolution bitmap is never materialized.
+        img.draft("RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # Flatten transparency onto white instead of letting it turn black.
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+    except ImageRejected:
+        raise
+    except Exception:
+        raise ImageRejected("Invalid image file")
+
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    # Step quality down, then size, until the encoding fits the budget.
+    while True:
+        for quality in _QUALITIES:
+            data = _encode(img, quality)
+            if len(data) <= target_bytes:
+                break
+        if len(data) <= target_bytes or max(img.size) <= _MIN_EDGE:
+            break
+        img = img.resize((max(1, int(img.width * 0.75)), max(1, int(img.height * 0.75))), Image.LANCZOS)
+
+    mime = "image/webp" if OUTPUT_FORMAT == "WEBP" else "image/jpeg"
+    return PreparedImage(data, mime, img.width, img.height)
+
@@ -1,5 +1,8 @@
 import os
 import json
+import threading
+import time
+from collections import OrderedDict
 import firebase_admin
 from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
@@ -8,11 +11,55 @@ from flask import Flask, request, jsonify
 #load environment variables from .env file
 load_dotenv()
 
-#initialize the Firebase Admin SDK with a service account key.
-from firebase_client import db
+import storage
+import userstats
 
 app = Flask(__name__)
 
+# Profiles are read by their email key (see userstats.py) through a small
+# per-process TTL cache, so repeated profile views skip the storage read.
+# Writes in this process drop the entry (see invalidate); other processes see
+# them once it expires.
+CACHE_TTL_SECONDS = float(os.getenv("PROFILE_CACHE_TTL", "30"))
+CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+
+_cache = OrderedDict()  # email -> (expires_at, profile or None)
+_cache_lock = threading.Lock()
+
+def _cached(email):
+    # Returns (hit, profile).
+    with _cache_lock:
+        entry = _cache.get(email)
+        if entry is None:
+            return False, None
+        if entry[0] <= time.monotonic():
+            del _cache[email]
+            return False, None
+        _cache.move_to_end(email)
+        return True, entry[1]
+
+def _remember(email, profile):
+    if CACHE_TTL_SECONDS <= 0:
+        return profile
+    with _cache_lock:
+        _cache[email] = (time.monotonic() + CACHE_TTL_SECONDS, profile)
+        _cache.move_to_end(email)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return profile
+
+def invalidate(emails):
+    """
+    Drops cached profiles after their stats changed in this process.
+
+    Environment:
+        PROFILE_CACHE_TTL: Seconds a profile is cached, 0 to disable (default 30).
+        PROFILE_CACHE_SIZE: Most profiles cached per process (default 10000).
+    """
+    with _cache_lock:
+        for email in emails:
+            _cache.pop(email, None)
+
 def getProfileInfo(email):
     """
     Retrieves user profile information based on their email.
@@ -21,18 +68,40 @@ def getProfileInfo(email):
         email (str): The email of the user.
 
     Returns:
-        JSON response with user profile data or an error message.
+        JSON response with user profile data or an error message. The
+        profile's stats hold the user's report, invasive and removed counts,
+        the number of species they reported and their last report time.
     """
-    users_ref = db.collection('users') 
-    query = users_ref.where('email', '==', email).stream()
-
-    user_data = None
-    for doc in query:
-        user_data = doc.to_dict()
-        user_data["id"] = doc.id  
-        break  
+    hit, user_data = _cached(email)
+    if not hit:
+        user_data = _remember(email, _profile_data(storage.get_storage().get_profile(email)))
 
     if user_data:
         return jsonify(user_data)
     else:
-        return jsonify({'error': 'User not found'}), 404
\ No newline at end of file
+        return jsonify({'error': 'User not found'}), 404
+
+async def getProfileAsync(email):
+    """
+    Profile lookup for the ASGI app, through the async storage backend.
+
+    Returns:
+        The profile dictionary, or None if there is no user with this email.
+    """
+    # _cached and _remember take a threading.Lock on the event loop. That is
+    # only acceptable because the critical sections are a few dictionary
+    # operations; never do I/O while holding _cache_lock.
+    hit, user_data = _cached(email)
+    if not hit:
+        user_data = _remember(email, _profile_data(await storage.get_async_storage().get_profile(email)))
+    return user_data
+
+def _profile_data(profile):
+    # stats holds the summary of the stored 'stats' map (see userstats.summary).
+    user_data = None
+    if profile is not None:
+        # Copied: the result is cached, and the backend may hand out its own dictionary.
+        user_data = dict(profile[1])
+        user_data["id"] = profile[0]
+        user_data["stats"] = userstats.summary(user_data.get("stats"))
+    return user_data
@@ -1,89 +1,267 @@
+import asyncio
 import os
 import json
 import firebase_admin 
 from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
-from google.cloud.firestore_v1 import FieldFilter
 import base64
+from datetime import datetime
+import geo
+import imagestore
+import prof
+import sightings
+import storage
+import tiles
 
 # Load environment variables from .env file.
 load_dotenv()
 
-# Initialize the Firebase Admin SDK with a service account key.
-from firebase_client import db
-
-def storeInfo(User_Email, plant_name, image_data, lat, lng, description, invasive_info, is_removed=False):
+def storeInfo(User_Email, plant_name, image_data, lat, lng, description, invasive_info, is_removed=False, image_pixels=None):
     """
     Stores plant information in Firestore under the 'plant_info' collection.
+    An invasive report near an active report of the same species is merged
+    into it as another sighting instead (see sightings.py).
 
     Parameters:
         User_Email (str): Email of the user who submitted the report.
         plant_name (str): The identified name of the plant.
-        image_data (binary): The binary data of the plant image.
+        image_data (binary): The binary data of the plant image. It is written to the
+            image store and only its content hash is kept on the document.
         lat (str or float): The latitude coordinate.
         lng (str or float): The longitude coordinate.
         description (str): A description of the plant/report.
         invasive_info (str): Additional invasive plant information (e.g. risk level).
         is_removed (bool): Whether the marker is marked as removed.
+        image_pixels (int): Width times height of the image; a merged sighting
+            keeps whichever image has more pixels.
 
     Returns:
         None
+
+    Raises:
+        ValueError: If lat or lng is not a number. Image store and storage
+            errors propagate as well; nothing is stored then.
     """
-    try:
-        
-        plant_data = {
-            'userEmail': User_Email,
-            'plant_name': plant_name,
-            'image': image_data,  # Store the Firestore Blob in the document.
-            'lat': str(lat),      # Storing as string; conversion happens on retrieval.
-            'lng': str(lng),
-            'description': description,
-            'invasive_info': invasive_info,
-            'removed': is_removed,
-        }
-        
-        # Add a new document with an auto-generated ID in the 'plant_info' collection.
-        db.collection('plant_info').add(plant_data)
+    image_hash = imagestore.get_store().put(image_data)
+    plant_data = buildReport(User_Email, plant_name, image_hash, lat, lng, description, invasive_info, is_removed, image_pixels)
+
+    backend = storage.get_storage()
+    merged = False
+    if sightings.enabled() and sightings.mergeable(plant_data):
+        report_id, merged = backend.add_sighting(plant_data, sightings.RADIUS_M)
+        _print_stored(report_id, merged)
+    else:
+        # Add a new report with an auto-generated ID (see storage.py).
+        backend.add_reports([(None, plant_data)])
         print("Plant information stored successfully.")
-        
-    except Exception as e:
-        print(f"Error storing plant information: {e}")
+    invalidateCaches([plant_data], [not merged and not plant_data['removed']])
 
-def getUserReportsInfo(email):
+async def storeInfoAsync(User_Email, plant_name, image_data, lat, lng, description, invasive_info, is_removed=False, image_pixels=None):
     """
-    Retrieves user reports (plant info) based on the user's email.
+    storeInfo for the ASGI app: the image store write runs on a worker thread
+    and the report is written through the async storage backend. Errors
+    propagate like in storeInfo.
+    """
+    image_hash = await asyncio.to_thread(imagestore.get_store().put, image_data)
+    plant_data = buildReport(User_Email, plant_name, image_hash, lat, lng, description, invasive_info, is_removed, image_pixels)
+    backend = storage.get_async_storage()
+    merged = False
+    if sightings.enabled() and sightings.mergeable(plant_data):
+        report_id, merged = await backend.add_sighting(plant_data, sightings.RADIUS_M)
+        _print_stored(report_id, merged)
+    else:
+        await backend.add_reports([(None, plant_data)])
+        print("Plant information stored successfully.")
+    await asyncio.to_thread(invalidateCaches, [plant_data], [not merged and not plant_data['removed']])
+
+def storeReports(reports):
+    """
+    Stores many reports built by buildReport with one commit (see
+    ingest.run_batch). Invasive reports near an active report of the same
+    species, stored or earlier in the batch, are merged into it as sightings.
+
+    Parameters:
+        reports (list): 'plant_info' documents, their images already in the image store.
+
+    Returns:
+        One (report_id, merged) pair per report, in order. Raises if the
+        commit fails, in which case nothing was stored.
+    """
+    backend = storage.get_storage()
+    if sightings.enabled():
+        results = backend.add_sightings(reports, sightings.RADIUS_M)
+    else:
+        results = [(report_id, False) for report_id in backend.add_reports([(None, plant_data) for plant_data in reports])]
+    invalidateCaches(reports, [not merged and not plant_data['removed'] for plant_data, (_, merged) in zip(reports, results)])
+    print(f"Stored {len(reports)} reports ({sum(merged for _, merged in results)} merged as sightings).")
+    return results
+
+def invalidateCaches(reports, markers_changed):
+    """
+    Drops the state cached from stored reports once a write to them has
+    committed: the profiles of their owners and reporters, and the density
+    tiles under every marker the write added or removed. Every write path
+    (storeInfo, storeReports, marker removal and dataset.import_ndjson)
+    goes through here.
+
+    Parameters:
+        reports (list): The written 'plant_info' documents.
+        markers_changed (list): One flag per report, True if the write added
+            or removed its marker; False for a sighting merged into an
+            existing report or a report stored as already removed.
+    """
+    emails = set()
+    for plant_data in reports:
+        emails.add(plant_data.get('userEmail'))
+        emails.update(plant_data.get('reporters') or [])
+    prof.invalidate(emails)
+    for plant_data, changed in zip(reports, markers_changed):
+        # Only invasive reports are drawn on the density tiles.
+        if changed and plant_data.get('invasive_info') is True:
+            tiles.invalidate(plant_data.get('lat_num', plant_data.get('lat')),
+                             plant_data.get('lng_num', plant_data.get('lng')), plant_data.get('plant_name'))
+
+def _print_stored(report_id, merged):
+    if merged:
+        print(f"Plant information merged into report {report_id} as another sighting.")
+    else:
+        print("Plant information stored successfully.")
+
+def buildReport(User_Email, plant_name, image_hash, lat, lng, description, invasive_info, is_removed=False, image_pixels=None):
+    """
+    Returns the 'plant_info' document for a report, with the derived fields
+    (numeric coordinates, geohash, updated_at, created_at) filled in.
+    Raises ValueError if lat or lng is not a number.
+    """
+    lat_num = float(lat)
+    lng_num = float(lng)
+    report = {
+        'userEmail': User_Email,
+        'plant_name': plant_name,
+        'image_hash': image_hash,  # Bytes live in the image store.
+        'lat': str(lat),      # Storing as string; conversion happens on retrieval.
+        'lng': str(lng),
+        'lat_num': lat_num,   # Numeric copies and geohash back the bbox queries.
+        'lng_num': lng_num,
+        'geohash': geo.encode(lat_num, lng_num),
+        'description': description,
+        'invasive_info': invasive_info,
+        'removed': is_removed,
+        'updated_at': firestore.SERVER_TIMESTAMP,  # Drives the incremental sync feed.
+        'created_at': firestore.SERVER_TIMESTAMP,  # Orders a user's report history.
+        'sightings': 1,               # Reports merged into this one, itself included.
+        'reporters': [User_Email],
+    }
+    if image_pixels:
+        report['image_pixels'] = image_pixels
+    return report
+
+# Fields /getUserReportsInfo can return, with the stored fields each is built from.
+REPORT_FIELDS = {
+    'id': [],
+    'userEmail': ['userEmail'],
+    'plant_name': ['plant_name'],
+    'lat': ['lat'],
+    'lng': ['lng'],
+    'description': ['description'],
+    'invasive_info': ['invasive_info'],
+    'removed': ['removed'],
+    'created_at': ['created_at'],
+    'updated_at': ['updated_at'],
+    'image': ['image_hash', 'image'],  # 'image' holds the bytes of older reports.
+    'thumb': ['image_hash'],
+}
+REPORTS_PAGE_SIZE = 50
+
+def parseReportFields(fields):
+    """
+    Parses a comma-separated field list for getUserReportsInfo.
+    Returns None (every field) for an empty value; raises ValueError for unknown fields.
+    """
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in REPORT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+def getUserReportsInfo(email, fields=None, cursor=None, limit=None):
+    """
+    Retrieves user reports (plant info) based on the user's email, newest first.
 
     Parameters:
         email (str): The user's email.
+        fields (list): Names from REPORT_FIELDS to return; None returns every stored field.
+            Only the stored fields behind them are read, so list views that leave
+            out image never load the image bytes of older reports.
+        cursor (str): Opaque cursor returned by a previous page, or None.
+        limit (int): Page size. Without limit and cursor every report is returned.
 
     Returns:
-        A JSON response containing a list of plant information dictionaries.
+        A list of plant information dictionaries when neither limit nor cursor
+        is given, otherwise {"reports": [...], "next_cursor": <string or None>}.
+        Raises ValueError for a malformed cursor.
     """
-    users_ref = db.collection('plant_info')
-    # Filter by userEmail.
-    query = users_ref.where(filter=FieldFilter("userEmail", "==", email)).stream()
+    query = _user_reports_query(fields, cursor, limit)
+    reports, position = storage.get_storage().reports_by_email(email, query["field_paths"], after=query["after"], limit=query["limit"])
+    return _user_reports_payload(reports, position, fields, query["paged"])
 
+async def getUserReportsInfoAsync(email, fields=None, cursor=None, limit=None):
+    """getUserReportsInfo for the ASGI app, reading through the async storage backend."""
+    query = _user_reports_query(fields, cursor, limit)
+    reports, position = await storage.get_async_storage().reports_by_email(
+        email, query["field_paths"], after=query["after"], limit=query["limit"])
+    return _user_reports_payload(reports, position, fields, query["paged"])
+
+def _user_reports_query(fields, cursor, limit):
+    # Turns getUserReportsInfo's arguments into reports_by_email's.
+    after = None
+    if cursor:
+        try:
+            timestamp, doc_id = _decode_cursor(cursor)
+            after = (datetime.fromisoformat(timestamp), doc_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+    paged = cursor is not None or limit is not None
+    if paged and limit is None:
+        limit = REPORTS_PAGE_SIZE
+
+    field_paths = None
+    if fields is not None:
+        field_paths = sorted({path for name in fields for path in REPORT_FIELDS[name]}) or ['userEmail']
+    return {"after": after, "limit": limit, "paged": paged, "field_paths": field_paths}
+
+def _user_reports_payload(reports, position, fields, paged):
     user_data = []
-    for doc in query:
-        data = doc.to_dict()
-        data["id"] = doc.id
+    for report_id, data in reports:
+        data["id"] = report_id
 
-        # Convert any bytes fields to a base64 encoded string.
+        if data.get('image_hash'):
+            data['image'] = imagestore.image_url(data['image_hash'], 'medium')
+            data['thumb'] = imagestore.image_url(data['image_hash'], 'thumb')
+
+        # Convert any bytes fields (images on older reports) to a base64 encoded string.
         for key, value in data.items():
             if isinstance(value, bytes):
                 # If the field is an image (assumed to be stored in 'img_path'),
                 # prepend the data URL header (adjust MIME type as necessary).
                 if key == 'image':
-                    print("i found an image")
                     data[key] = "data:image/jpeg;base64," + base64.b64encode(value).decode('utf-8')
                 else:
                     data[key] = base64.b64encode(value).decode('utf-8')
 
+        if fields is not None:
+            data = {name: data.get(name) for name in fields}
         user_data.append(data)
 
-    # Return the data as a JSON response with a 200 status code.
-    return jsonify(user_data), 200
+    if not paged:
+        return user_data
+    next_cursor = None
+    if position:
+        next_cursor = _encode_cursor(position[0].isoformat(), position[1])
+    return {"reports": user_data, "next_cursor": next_cursor}
 
 
 def getMarkerInfo(lat, lng, NameOfPlant):
@@ -99,16 +277,9 @@ def getMarkerInfo(lat, lng, NameOfPlant):
         A list of matching marker data dictionaries if found, otherwise a JSON error response.
     """
     try:
-        markers_ref = db.collection('plant_info')
-        query = markers_ref.where('lat', '==', str(lat)) \
-                           .where('lng', '==', str(lng)) \
-                           .where('plant_name', '==', NameOfPlant) \
-                           .stream()
-        
         marker_data = []
-        for doc in query:
-            data = doc.to_dict()
-            data['id'] = doc.id
+        for report_id, data in storage.get_storage().reports_at(lat, lng, NameOfPlant):
+            data['id'] = report_id
             marker_data.append(data)
         
         if marker_data:
@@ -119,9 +290,43 @@ def getMarkerInfo(lat, lng, NameOfPlant):
         print(f"Error retrieving marker information: {e}")
         return jsonify({'error': f"Error retrieving marker information: {e}"}), 500
 
+def to_poi(doc_id, data):
+    """
+    Formats a 'plant_info' document as a map POI dictionary.
+    Returns None if the document has no usable coordinates.
+    """
+    # Use 'plant_name' if available, otherwise fall back to document ID.
+    key = data.get('plant_name', doc_id)
+    lat = data.get('lat_num', data.get('lat'))
+    lng = data.get('lng_num', data.get('lng'))
+    image = data.get('image')
+    desc = data.get('description')
+
+    # Skip if coordinates are missing.
+    if lat is None or lng is None:
+        return None
+
+    if data.get('image_hash'):
+        image = imagestore.image_url(data['image_hash'], 'medium')
+    # Older reports still carry the image bytes; convert them to a base64 string.
+    elif isinstance(image, bytes):
+        image = "data:image/jpeg;base64," + base64.b64encode(image).decode('utf-8')
+
+    return {
+        "id": doc_id,
+        "key": key,
+        "vars": {
+            "lat": float(lat),
+            "lng": float(lng),
+            "image": image,
+            "desc": desc,
+            "sightings": data.get('sightings', 1)
+        }
+    }
+
 def getMarkers():
     """
-    Queries the 'plant_info' collection in Firestore and returns a list of POI dictionaries for invasive markers
+    Queries the stored reports and returns a list of POI dictionaries for invasive markers
     that are not marked as removed.
 
     Each POI dictionary is in the form:
@@ -130,49 +335,21 @@ def getMarkers():
           "vars": {
               "lat": <float>,    # Latitude value
               "lng": <float>,    # Longitude value
-              "image": <string>, # Base64-encoded image data
-              "desc": <string>   # Description
+              "image": <string>, # Image URL (base64 data URL for older reports)
+              "desc": <string>,  # Description
+              "sightings": <int> # Reports merged into this marker (see sightings.py)
           }
       }
 
     Only documents with a non-empty 'invasive_info' field and 'removed' == False are returned.
     """
     try:
-        markers_ref = db.collection('plant_info')
-        # If invasive_info is stored as a boolean, use True. If it is a string, adjust accordingly.
-        query = markers_ref.where(filter=FieldFilter("removed", "==", False)) \
-                           .where(filter=FieldFilter("invasive_info", "==", True))
-        docs = query.stream()
         poi_list = []
 
-        for doc in docs:
-            data = doc.to_dict()
-
-            # Use 'plant_name' if available, otherwise fall back to document ID.
-            key = data.get('plant_name', doc.id)
-            lat = data.get('lat')
-            lng = data.get('lng')
-            image = data.get('image')
-            desc = data.get('description')
-
-            # Skip if coordinates are missing.
-            if lat is None or lng is None:
-                continue
-
-            # If the image data is in bytes, convert it to a base64 string.
-            if isinstance(image, bytes):
-                image = "data:image/jpeg;base64," + base64.b64encode(image).decode('utf-8')
-
-            poi = {
-                "key": key,
-                "vars": {
-                    "lat": float(lat),
-                    "lng": float(lng),
-                    "image": image,
-                    "desc": desc
-                }
-            }
-            poi_list.append(poi)
+        for report_id, data in storage.get_storage().active_markers():
+            poi = to_poi(report_id, data)
+            if poi is not None:
+                poi_list.append(poi)
         
         return poi_list
 
@@ -180,24 +357,167 @@ def getMarkers():
         print(f"Error retrieving markers: {e}")
         return {"error": f"Error retrieving markers: {e}"}
 
-   
+def _encode_cursor(key, doc_id):
+    # Cursors are (sort key, document ID) pairs, opaque to clients.
+    raw = json.dumps([key, doc_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def _decode_cursor(cursor):
+    key, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return key, doc_id
+
+def getMarkersInBBox(bbox, species=None, cursor=None, limit=200):
+    """
+    Returns the active invasive markers inside a bounding box, one page at a time.
+
+    Only reports near the viewport are read: through the geohash index on
+    Firestore, through the R-tree on SQLite. Results are ordered by
+    (geohash, document ID), which is also what the cursor encodes.
+
+    Parameters:
+        bbox (tuple): (south, west, north, east) in degrees.
+        species (str): Optional plant name to filter on.
+        cursor (str): Opaque cursor returned by a previous call, or None.
+        limit (int): Maximum number of markers to return.
+
+    Returns:
+        A dictionary {"markers": [...], "next_cursor": <string or None>}.
+        Raises ValueError for a malformed cursor.
+    """
+    after = None
+    if cursor:
+        try:
+            after = _decode_cursor(cursor)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    docs, position = storage.get_storage().markers_in_bbox(bbox, species=species, after=after, limit=limit)
+    markers = []
+    for doc_id, data in docs:
+        poi = to_poi(doc_id, data)
+        if poi is not None:
+            markers.append(poi)
+    return {"markers": markers, "next_cursor": _encode_cursor(*position) if position else None}
+
+
+def _is_active(data):
+    return data.get('removed') is False and data.get('invasive_info') is True
+
+def getMarkerChanges(since=None, limit=500):
+    """
+    Returns the markers that changed after a sync cursor.
+
+    Every write to a report stamps 'updated_at' with the commit time, so
+    clients that keep a local copy of the map only need the documents with a
+    later 'updated_at' than the last one they saw. Documents that are no longer
+    active markers (removed, or not invasive) are returned as tombstones.
+
+    Parameters:
+        since (str): Cursor from a previous call, or None/"0" to start from the beginning.
+        limit (int): Maximum number of changed documents to read.
+
+    Returns:
+        A dictionary {"markers": [...], "removed": [<id>, ...], "cursor": <string>,
+        "has_more": <bool>}. Pass cursor back as since; when has_more is true,
+        call again straight away to fetch the rest.
+        Raises ValueError for a malformed cursor.
+    """
+    after = None
+    if since and since != "0":
+        try:
+            timestamp, doc_id = _decode_cursor(since)
+            after = (datetime.fromisoformat(timestamp), doc_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    markers = []
+    removed = []
+    last = None
+    docs = storage.get_storage().changes(after, limit=limit)
+    for doc_id, data in docs:
+        last = (data['updated_at'].isoformat(), doc_id)
+        if _is_active(data):
+            poi = to_poi(doc_id, data)
+            if poi is not None:
+                markers.append(poi)
+                continue
+        removed.append(doc_id)
+
+    return {
+        "markers": markers,
+        "removed": removed,
+        "cursor": _encode_cursor(*last) if last else (since or "0"),
+        "has_more": len(docs) == limit,
+    }
 
 def markMarkerAsRemoved(marker_id, is_removed=True):
     """
-    Updates the 'removed' status of a marker in Firestore.
+    Updates the 'removed' status of a marker.
 
     Parameters:
-        marker_id (str): The Firestore document ID of the marker.
+        marker_id (str): The document ID of the marker.
         is_removed (bool): True if the marker is removed; False otherwise.
 
     Returns:
         A dictionary with a success message or an error message.
     """
     try:
-        marker_ref = db.collection('plant_info').document(marker_id)
-        marker_ref.update({'removed': is_removed})
+        backend = storage.get_storage()
+        backend.set_removed(marker_id, is_removed)
+        _after_removal(backend, [marker_id])
         print("Marker updated successfully.")
         return {"message": "Marker updated successfully"}
     except Exception as e:
         print(f"Error updating marker: {e}")
-        return {"error": f"Error updating marker: {e}"}
\ No newline at end of file
+        return {"error": f"Error updating marker: {e}"}
+
+def findMarkersInRegion(bbox=None, polygon=None, species=None):
+    """
+    Returns the IDs of active invasive markers inside a bounding box or polygon.
+
+    Parameters:
+        bbox (tuple): (south, west, north, east) in degrees.
+        polygon (list): (lat, lng) vertices; used instead of bbox when given.
+        species (str): Optional plant name to filter on.
+
+    Returns:
+        A list of document IDs.
+    """
+    if polygon:
+        bbox = geo.polygon_bbox(polygon)
+    ids = []
+    for doc_id, data in storage.get_storage().active_in_region(bbox, species):
+        if polygon:
+            lat = geo.to_float(data.get('lat_num', data.get('lat')))
+            lng = geo.to_float(data.get('lng_num', data.get('lng')))
+            if not geo.in_polygon(lat, lng, polygon):
+                continue
+        ids.append(doc_id)
+    return ids
+
+def bulkRemoveMarkers(marker_ids):
+    """
+    Marks many markers as removed in batched writes.
+
+    Parameters:
+        marker_ids (list): Document IDs of the markers.
+
+    Returns:
+        A dictionary {"results": {<id>: <outcome>}, "removed": <count>} where
+        outcome is "removed", "already_removed", "not_found" or an error message.
+    """
+    backend = storage.get_storage()
+    results = backend.remove_many(list(dict.fromkeys(marker_ids)))
+    removed = [marker_id for marker_id, outcome in results.items() if outcome == "removed"]
+    _after_removal(backend, removed)
+    return {"results": results, "removed": len(removed)}
+
+def _after_removal(backend, marker_ids):
+    # Drops the cached profiles of the markers' owners and marks the density
+    # tiles under them as stale, after their removed flag just changed.
+    if not marker_ids or (tiles.get_cache() is None and prof.CACHE_TTL_SECONDS <= 0):
+        return
+    # Removals count against the owner only (see userstats.py), so reporters are not read.
+    fields = ['userEmail', 'plant_name', 'invasive_info', 'lat', 'lng', 'lat_num', 'lng_num']
+    markers = list(backend.get_reports(marker_ids, fields).values())
+    invalidateCaches(markers, [True] * len(markers))
@@ -0,0 +1,142 @@
+import hashlib
+import os
+
+from dotenv import load_dotenv
+
+import geo
+
+# Ingest-time deduplication of repeat sightings.
+#
+# Hikers on the same trail keep reporting the same patch. When a new invasive
+# report has an active report of the same species within SIGHTING_RADIUS_M,
+# storeInfo merges it into that report (the "site") instead of writing a new
+# document: the sighting counter goes up, the reporter is added to the site's
+# reporters, and the site keeps whichever image has more pixels. The site's
+# position, species and cluster contribution do not change, so stored
+# documents and the marker payload grow with distinct sites, not reports.
+#
+# The search reads the active reports of the species in the geohash cells
+# around the new report, at a fixed precision whose cells are at least twice
+# the radius, and picks the nearest one within the radius. Each backend runs
+# the search and the write in one transaction (see add_sighting in
+# firestore_storage.py and sqlite_storage.py). On Firestore, a transaction
+# that creates a new site also writes a lock document for its (species, cell)
+# in the 'sighting_cells' collection, and every search reads the lock
+# documents of the cells it looks at, so two reports of the same new patch
+# committed at the same time conflict and the second is retried and merged.
+
+load_dotenv()
+
+RADIUS_M = float(os.getenv("SIGHTING_RADIUS_M", "25"))
+LOCK_COLLECTION = 'sighting_cells'
+
+
+def enabled():
+    """Returns False when SIGHTING_RADIUS_M is 0, which stores every report on its own."""
+    return RADIUS_M > 0
+
+
+def mergeable(plant_data):
+    """Returns True if a new report may be merged: an active invasive marker with coordinates."""
+    return (plant_data.get('invasive_info') is True and plant_data.get('removed') is False
+            and plant_data.get('lat_num') is not None and plant_data.get('lng_num') is not None)
+
+
+def search_area(lat, lng, radius_m):
+    """
+    Returns (bbox, cells): the box around the search circle and the geohash
+    cells covering it at the lock precision for this radius.
+    """
+    bbox = geo.radius_bbox(lat, lng, radius_m)
+    return bbox, geo.cells_covering(bbox, geo.precision_for_radius(radius_m))
+
+
+def lock_cell(lat, lng, radius_m):
+    """Returns the lock cell a new site at this coordinate is created in."""
+    return geo.encode(lat, lng, geo.precision_for_radius(radius_m))
+
+
+def lock_id(species, cell):
+    """Returns the 'sighting_cells' document ID for a species in a cell."""
+    return f"{cell}:{hashlib.sha1(species.encode('utf-8')).hexdigest()[:16]}"
+
+
+def nearest(candidates, lat, lng, radius_m):
+    """
+    Returns the (id, data) pair of the candidate closest to the coordinate
+    within radius_m, or None. Ties go to the lowest ID, so every writer picks
+    the same site.
+    """
+    best = None
+    for site_id, data in candidates:
+        site_lat = geo.to_float(data.get('lat_num', data.get('lat')))
+        site_lng = geo.to_float(data.get('lng_num', data.get('lng')))
+        if site_lat is None or site_lng is None:
+            continue
+        distance = geo.distance_m(lat, lng, site_lat, site_lng)
+        if distance <= radius_m and (best is None or (distance, site_id) < best[0]):
+            best = ((distance, site_id), (site_id, data))
+    return best[1] if best else None
+
+
+def merge(site, report):
+    """
+    Returns the fields to update on a stored site to record a new report as
+    another sighting of it. When 'image_hash' is among them the new image
+    replaces the site's, and any inline 'image' bytes should be dropped.
+    """
+    reporters = list(site.get('reporters') or [site.get('userEmail')])
+    updates = {'sightings': site.get('sightings', 1) + 1}
+    if report.get('userEmail') not in reporters:
+        updates['reporters'] = reporters + [report.get('userEmail')]
+    if report.get('image_hash') and report.get('image_pixels', 0) > site.get('image_pixels', 0):
+        updates['image_hash'] = report['image_hash']
+        updates['image_pixels'] = report['image_pixels']
+    return updates
+
+
+def plan(reports, candidates, radius_m, new_id):
+    """
+    Decides how a batch of new reports is written in one commit, for
+    backends whose transactions cannot read their own writes. Reports are
+    taken in order; each one may merge into a stored site or into a site
+    created earlier in the same batch.
+
+    Parameters:
+        reports (list): New reports built by reports.buildReport.
+        candidates (list): For each report, the (id, data) pairs of the
+            stored active sites of its species around it (ignored for
+            reports that cannot be merged).
+        radius_m (float): Merge radius.
+        new_id (callable): Returns an ID for a new report.
+
+    Returns:
+        (results, creates, updates): results holds one (report_id, merged)
+        pair per report, creates maps new IDs to their documents, and
+        updates maps stored site IDs to the fields to update on them.
+    """
+    results = []
+    creates = {}
+    updates = {}
+    merged_sites = {}  # Stored sites as they are after this batch's merges.
+    for report, found in zip(reports, candidates):
+        site = None
+        if mergeable(report):
+            pool = [(site_id, merged_sites.get(site_id, data)) for site_id, data in found]
+            pool += [(site_id, data) for site_id, data in creates.items()
+                     if mergeable(data) and data['plant_name'] == report['plant_name']]
+            site = nearest(pool, report['lat_num'], report['lng_num'], radius_m)
+        if site is None:
+            report_id = new_id()
+            creates[report_id] = report
+            results.append((report_id, False))
+            continue
+        site_id, data = site
+        changes = merge(data, report)
+        if site_id in creates:
+            creates[site_id] = dict(data, **changes)
+        else:
+            merged_sites[site_id] = dict(data, **changes)
+            updates.setdefault(site_id, {}).update(changes)
+        results.append((site_id, True))
+    return results, creates, updates
@@ -0,0 +1,502 @@
+import json
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import clusters
+import geo
+import sightings
+import userstats
+
+# Report storage in a local SQLite file, for self-hosted and edge deployments,
+# offline benchmarks and tests without network access.
+#
+# Each report is a row holding its fields as JSON, with the fields queries
+# filter on copied into indexed columns (email, species, active flag, geohash,
+# updated_at). Coordinates are also kept in an R-tree, so a bounding box query
+# only visits the reports inside it. Cluster aggregates are computed on the
+# fly with GROUP BY instead of being maintained like on Firestore. User stats
+# are maintained in 'user_stats', in the transaction of each write that
+# changes them (see userstats.py).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    rid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    user_email TEXT,
+    plant_name TEXT,
+    lat TEXT,
+    lng TEXT,
+    lat_num REAL,
+    lng_num REAL,
+    geohash TEXT,
+    active INTEGER NOT NULL,
+    removed INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reports_species ON reports (plant_name, active);
+CREATE INDEX IF NOT EXISTS reports_active_geohash ON reports (active, geohash, id);
+CREATE INDEX IF NOT EXISTS reports_updated_at ON reports (updated_at, id);
+CREATE INDEX IF NOT EXISTS reports_location ON reports (lat, lng, plant_name);
+CREATE VIRTUAL TABLE IF NOT EXISTS reports_rtree USING rtree (rid, min_lat, max_lat, min_lng, max_lng);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE TABLE IF NOT EXISTS user_stats (
+    email TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+# Columns and indexes added after the first release of this schema.
+MIGRATIONS = [
+    ("reports", "created_at", "ALTER TABLE reports ADD COLUMN created_at TEXT"),
+]
+INDEXES = """
+UPDATE reports SET created_at = updated_at WHERE created_at IS NULL;
+DROP INDEX IF EXISTS reports_user_email;
+CREATE INDEX IF NOT EXISTS reports_user_created ON reports (user_email, created_at, id);
+"""
+
+_COLUMNS = "r.id, r.data, r.updated_at, r.created_at"
+
+
+def _now():
+    # Fixed-width UTC timestamps, so text order is time order.
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+
+def _is_active(data):
+    return data.get('removed') is False and data.get('invasive_info') is True
+
+
+def _load(row):
+    # Turns an (id, data, updated_at, created_at) row into an (id, data) pair.
+    data = json.loads(row[1])
+    data['updated_at'] = datetime.fromisoformat(row[2])
+    if row[3]:
+        data['created_at'] = datetime.fromisoformat(row[3])
+    return row[0], data
+
+
+def _bbox_clause(bbox):
+    # R-tree candidates for each half of an antimeridian-crossing box, then an
+    # exact check, since the R-tree stores rounded 32-bit bounds.
+    clauses = []
+    params = []
+    for south, west, north, east in geo.split_bbox(bbox):
+        clauses.append(
+            "(r.rid IN (SELECT rid FROM reports_rtree WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?)"
+            " AND r.lat_num BETWEEN ? AND ? AND r.lng_num BETWEEN ? AND ?)"
+        )
+        params += [south, north, west, east, south, north, west, east]
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+class SqliteStorage:
+    name = "sqlite"
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        conn = self._connect()
+        fresh_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_stats'").fetchone() is None
+        conn.executescript(SCHEMA)
+        for table, column, statement in MIGRATIONS:
+            if column not in [info[1] for info in conn.execute(f"PRAGMA table_info({table})")]:
+                conn.execute(statement)
+        conn.executescript(INDEXES)
+        if fresh_stats:
+            self._rebuild_user_stats()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a read-then-write
+        # cannot be interleaved with another writer.
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # ────────────── Writes ──────────────
+
+    def _write(self, conn, report_id, data, rid=None):
+        # Every write stamps updated_at, like SERVER_TIMESTAMP does on Firestore;
+        # created_at is stamped on insert and kept on updates.
+        data = dict(data)
+        data.pop('updated_at', None)
+        data.pop('created_at', None)
+        now = _now()
+        lat, lng = geo.to_float(data.get('lat_num', data.get('lat'))), geo.to_float(data.get('lng_num', data.get('lng')))
+        values = (
+            report_id, data.get('userEmail'), data.get('plant_name'),
+            None if data.get('lat') is None else str(data.get('lat')),
+            None if data.get('lng') is None else str(data.get('lng')),
+            lat, lng, data.get('geohash'),
+            1 if _is_active(data) else 0, 1 if data.get('removed') is True else 0,
+            now, json.dumps(data),
+        )
+        if rid is None:
+            rid = conn.execute(
+                "INSERT INTO reports (id, user_email, plant_name, lat, lng, lat_num, lng_num, geohash,"
+                " active, removed, updated_at, data, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                values + (now,),
+            ).lastrowid
+            if lat is not None and lng is not None:
+                conn.execute("INSERT INTO reports_rtree VALUES (?, ?, ?, ?, ?)", (rid, lat, lat, lng, lng))
+        else:
+            conn.execute(
+                "UPDATE reports SET id = ?, user_email = ?, plant_name = ?, lat = ?, lng = ?, lat_num = ?,"
+                " lng_num = ?, geohash = ?, active = ?, removed = ?, updated_at = ?, data = ? WHERE rid = ?",
+                values + (rid,),
+            )
+
+    def _apply_user_stats(self, conn, deltas):
+        now = _now()
+        for email, total in deltas.items():
+            row = conn.execute("SELECT data FROM user_stats WHERE email = ?", (email,)).fetchone()
+            stats = userstats.add_totals(json.loads(row[0]) if row else None, total, now)
+            conn.execute("INSERT OR REPLACE INTO user_stats (email, data) VALUES (?, ?)", (email, json.dumps(stats)))
+
+    def _rebuild_user_stats(self):
+        # Counts the reports stored before user_stats existed.
+        deltas = {}
+        latest = {}
+        for _, data in self.iter_reports():
+            userstats.accumulate(deltas, data)
+            created_at = data.get('created_at', data['updated_at']).isoformat(timespec="microseconds")
+            for email in [data.get('userEmail')] + list(data.get('reporters') or []):
+                if email and created_at > latest.get(email, ""):
+                    latest[email] = created_at
+        with self._transaction() as conn:
+            for email, total in deltas.items():
+                stats = userstats.add_totals(None, total, latest.get(email))
+                conn.execute("INSERT OR REPLACE INTO user_stats (email, data) VALUES (?, ?)", (email, json.dumps(stats)))
+
+    def add_reports(self, reports):
+        """
+        Writes new reports built by reports.buildReport in one transaction.
+
+        Parameters:
+            reports (list): (doc_id, plant_data) pairs; doc_id None means auto-generated.
+
+        Returns:
+            The list of report IDs written.
+        """
+        ids = []
+        deltas = {}
+        with self._transaction() as conn:
+            for report_id, plant_data in reports:
+                report_id = report_id or uuid.uuid4().hex
+                self._write(conn, report_id, plant_data)
+                userstats.accumulate(deltas, plant_data)
+                ids.append(report_id)
+            self._apply_user_stats(conn, deltas)
+        return ids
+
+    def _add_sighting(self, conn, plant_data, radius_m):
+        if not sightings.mergeable(plant_data):
+            report_id = uuid.uuid4().hex
+            self._write(conn, report_id, plant_data)
+            return report_id, False
+
+        lat, lng = plant_data['lat_num'], plant_data['lng_num']
+        bbox, _ = sightings.search_area(lat, lng, radius_m)
+        where, params = _bbox_clause(bbox)
+        candidates = self._select("r.active = 1 AND r.plant_name = ? AND " + where,
+                                  [plant_data['plant_name']] + params)
+        site = sightings.nearest(candidates, lat, lng, radius_m)
+        if site is None:
+            report_id = uuid.uuid4().hex
+            self._write(conn, report_id, plant_data)
+            return report_id, False
+
+        site_id, data = site
+        updates = sightings.merge(data, plant_data)
+        data.update(updates)
+        if 'image_hash' in updates:
+            data.pop('image', None)
+        rid = conn.execute("SELECT rid FROM reports WHERE id = ?", (site_id,)).fetchone()[0]
+        self._write(conn, site_id, data, rid=rid)
+        return site_id, True
+
+    def add_sighting(self, plant_data, radius_m):
+        """
+        Writes a new report built by reports.buildReport, or merges it into the
+        nearest active report of the same species within radius_m (see
+        sightings.py). The search and the write share one BEGIN IMMEDIATE
+        transaction, so concurrent reports of one patch are serialized.
+
+        Returns:
+            (report_id, merged): the ID of the report written or merged into,
+            and whether the new report was merged.
+        """
+        deltas = {}
+        userstats.accumulate(deltas, plant_data)
+        with self._transaction() as conn:
+            self._apply_user_stats(conn, deltas)
+            return self._add_sighting(conn, plant_data, radius_m)
+
+    def add_sightings(self, reports, radius_m):
+        """
+        add_sighting for a batch, in one transaction. Later reports can merge
+        into sites created earlier in the batch.
+
+        Returns:
+            One (report_id, merged) pair per report, in order.
+        """
+        deltas = {}
+        for plant_data in reports:
+            userstats.accumulate(deltas, plant_data)
+        with self._transaction() as conn:
+            self._apply_user_stats(conn, deltas)
+            return [self._add_sighting(conn, plant_data, radius_m) for plant_data in reports]
+
+    def _set_removed(self, conn, report_id, is_removed):
+        row = conn.execute("SELECT rid, data FROM reports WHERE id = ?", (report_id,)).fetchone()
+        if row is None:
+            return "not_found"
+        data = json.loads(row[1])
+        if data.get('removed') == is_removed:
+            return "already_removed" if is_removed else "unchanged"
+        data['removed'] = is_removed
+        self._write(conn, report_id, data, rid=row[0])
+        deltas = {}
+        userstats.count_removed(deltas, data.get('userEmail'), 1 if is_removed else -1)
+        self._apply_user_stats(conn, deltas)
+        return "removed" if is_removed else "restored"
+
+    def set_removed(self, report_id, is_removed):
+        """
+        Sets a report's removed flag. Raises ValueError if the report does not exist.
+        """
+        with self._transaction() as conn:
+            if self._set_removed(conn, report_id, is_removed) == "not_found":
+                raise ValueError(f"Marker {report_id} not found")
+
+    def remove_many(self, marker_ids):
+        """
+        Marks many markers as removed in a single transaction.
+
+        Returns:
+            A dictionary {<id>: <outcome>} where outcome is "removed",
+            "already_removed" or "not_found".
+        """
+        with self._transaction() as conn:
+            return {marker_id: self._set_removed(conn, marker_id, True) for marker_id in marker_ids}
+
+    # ────────────── Reads ──────────────
+
+    def _select(self, where="1", params=(), order="r.id", limit=None):
+        sql = f"SELECT {_COLUMNS} FROM reports r WHERE {where} ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [_load(row) for row in self._connect().execute(sql, params)]
+
+    def existing_ids(self, report_ids):
+        """Returns the subset of report_ids that already exist."""
+        report_ids = list(report_ids)
+        found = set()
+        for start in range(0, len(report_ids), 500):
+            chunk = report_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._connect().execute(f"SELECT id FROM reports WHERE id IN ({placeholders})", chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def get_report(self, report_id):
+        """Returns a report's fields, or None if it does not exist."""
+        rows = self._select("r.id = ?", (report_id,))
+        return rows[0][1] if rows else None
+
+    def get_reports(self, report_ids, field_paths=None):
+        """Returns {id: data} for the reports that exist, with only field_paths if given."""
+        report_ids = list(report_ids)
+        found = {}
+        for start in range(0, len(report_ids), 500):
+            chunk = report_ids[start:start + 500]
+            for report_id, data in self._select(f"r.id IN ({','.join('?' * len(chunk))})", chunk):
+                if field_paths:
+                    data = {key: value for key, value in data.items() if key in field_paths}
+                found[report_id] = data
+        return found
+
+    def reports_by_email(self, email, field_paths=None, after=None, limit=None):
+        """
+        Returns one page of a user's reports, newest first.
+
+        Parameters:
+            email (str): The reporter's email.
+            field_paths (list): Stored fields to return; None returns all.
+            after (tuple): (created_at, id) of the last report of the previous page.
+            limit (int): Page size; None returns every report in one page.
+
+        Returns:
+            ([(id, data), ...], next_position) where next_position is the
+            (created_at, id) of the last report when the page is full, else None.
+        """
+        where, params = "r.user_email = ?", [email]
+        if after:
+            where += " AND (r.created_at, r.id) < (?, ?)"
+            params += [after[0].astimezone(timezone.utc).isoformat(timespec="microseconds"), after[1]]
+        reports = self._select(where, params, order="r.created_at DESC, r.id DESC", limit=limit)
+        if field_paths:
+            keep = set(field_paths) | {'created_at'}
+            reports = [(report_id, {key: value for key, value in data.items() if key in keep})
+                       for report_id, data in reports]
+        if limit is None or len(reports) < limit:
+            return reports, None
+        last_id, last = reports[-1]
+        return reports, (last['created_at'], last_id)
+
+    def reports_at(self, lat, lng, plant_name):
+        """Returns (id, data) pairs whose stored lat/lng strings and plant name match exactly."""
+        return self._select("r.lat = ? AND r.lng = ? AND r.plant_name = ?", (str(lat), str(lng), plant_name))
+
+    def active_markers(self):
+        """Returns (id, data) pairs for every invasive report not marked as removed."""
+        return self._select("r.active = 1")
+
+    def markers_in_bbox(self, bbox, species=None, after=None, limit=200):
+        """
+        Returns up to limit active markers inside a bounding box, in
+        (geohash, id) order, starting after the given position.
+
+        Returns:
+            ([(id, data), ...], next_position) where next_position is the
+            (geohash, id) of the last marker when the page is full, else None.
+        """
+        where, params = _bbox_clause(bbox)
+        where = "r.active = 1 AND " + where
+        if species:
+            where += " AND r.plant_name = ?"
+            params.append(species)
+        if after:
+            where += " AND (r.geohash, r.id) > (?, ?)"
+            params += [after[0], after[1]]
+        markers = self._select(where, params, order="r.geohash, r.id", limit=limit)
+        if len(markers) < limit:
+            return markers, None
+        last_id, last = markers[-1]
+        return markers, (last.get('geohash'), last_id)
+
+    def active_in_region(self, bbox, species=None):
+        """Yields (id, data) for the active invasive markers inside a bounding box."""
+        where, params = _bbox_clause(bbox)
+        where = "r.active = 1 AND " + where
+        if species:
+            where += " AND r.plant_name = ?"
+            params.append(species)
+        yield from self._select(where, params)
+
+    def changes(self, after=None, limit=500):
+        """
+        Returns up to limit (id, data) pairs in (updated_at, id) order,
+        starting after the given (datetime, id) position.
+        """
+        if not after:
+            return self._select(order="r.updated_at, r.id", limit=limit)
+        timestamp = after[0].astimezone(timezone.utc).isoformat(timespec="microseconds")
+        return self._select("(r.updated_at, r.id) > (?, ?)", (timestamp, after[1]), order="r.updated_at, r.id", limit=limit)
+
+    def iter_reports(self, field_paths=None, page_size=500):
+        """
+        Yields (id, data) for every report in ID order, reading one page at a
+        time. field_paths limits the fields returned.
+        """
+        last_id = ""
+        while True:
+            page = self._select("r.id > ?", (last_id,), limit=page_size)
+            for report_id, data in page:
+                if field_paths:
+                    data = {key: value for key, value in data.items() if key in field_paths}
+                yield report_id, data
+            if len(page) < page_size:
+                return
+            last_id = page[-1][0]
+
+    def clusters(self, bbox, zoom):
+        """
+        Returns marker clusters for a viewport, in the same shape as
+        clusters.getClusters, aggregated with GROUP BY over geohash prefixes.
+        """
+        precision = clusters.precision_for_zoom(zoom)
+        # Count whole cells: widen the box by one cell so markers in cells that
+        # overhang it are included, then keep the cells whose centroid is inside.
+        lat_step, lng_step = geo.cell_size(precision)
+        south, west, north, east = bbox
+        if east - west + 2 * lng_step >= 360.0 or west > east:
+            wide_west, wide_east = -180.0, 180.0
+        else:
+            wide_west, wide_east = max(-180.0, west - lng_step), min(180.0, east + lng_step)
+        wide = (max(-90.0, south - lat_step), wide_west, min(90.0, north + lat_step), wide_east)
+        where, params = _bbox_clause(wide)
+        rows = self._connect().execute(
+            "SELECT substr(r.geohash, 1, ?) AS cell, r.plant_name, COUNT(*), SUM(r.lat_num), SUM(r.lng_num), MAX(r.id)"
+            f" FROM reports r WHERE r.active = 1 AND {where} GROUP BY cell, r.plant_name",
+            [precision] + params,
+        )
+        cells = {}
+        for cell, plant_name, count, sum_lat, sum_lng, rep_id in rows:
+            total = cells.setdefault(cell, {"count": 0, "sum_lat": 0.0, "sum_lng": 0.0, "species": {}, "rep_id": rep_id})
+            total["count"] += count
+            total["sum_lat"] += sum_lat
+            total["sum_lng"] += sum_lng
+            total["species"][plant_name] = count
+            total["rep_id"] = max(total["rep_id"], rep_id)
+
+        result = []
+        for cell, total in sorted(cells.items()):
+            lat = total["sum_lat"] / total["count"]
+            lng = total["sum_lng"] / total["count"]
+            if not geo.in_bbox(lat, lng, bbox):
+                continue
+            species = sorted(total["species"].items(), key=lambda item: -item[1])[:clusters.TOP_SPECIES]
+            result.append({
+                "cell": cell,
+                "lat": lat,
+                "lng": lng,
+                "count": total["count"],
+                "top_species": [{"name": name, "count": n} for name, n in species],
+                "marker_id": total["rep_id"],
+            })
+        return {"precision": precision, "clusters": result}
+
+    # ────────────── Profiles ──────────────
+
+    def get_profile(self, email):
+        """
+        Returns (id, data) for the user with this email, or None. data holds
+        the user's 'stats' (see userstats.py) if they have any reports.
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT id, data FROM users WHERE email = ? LIMIT 1", (email,)).fetchone()
+        stats_row = conn.execute("SELECT data FROM user_stats WHERE email = ?", (email,)).fetchone()
+        if row is None and stats_row is None:
+            return None
+        profile_id, data = (row[0], json.loads(row[1])) if row else (userstats.profile_key(email), {'email': email})
+        if stats_row:
+            data['stats'] = json.loads(stats_row[0])
+            if data['stats'].get('last_report_at'):
+                data['stats']['last_report_at'] = datetime.fromisoformat(data['stats']['last_report_at'])
+        return profile_id, data
@@ -0,0 +1,154 @@
+import asyncio
+import inspect
+import os
+import threading
+
+from dotenv import load_dotenv
+
+import firebase_client
+import metrics
+
+# Selects where reports and profiles are stored.
+#
+# reports.py, prof.py and app.py go through get_storage() instead of calling
+# Firestore directly. Both backends offer the same methods, taking and
+# returning plain dictionaries and (id, data) pairs:
+#
+#   firestore_storage.FirestoreStorage  'plant_info' and 'users' collections
+#                                       (FIRESTORE_BACKEND=memory for an in-process stand-in)
+#   sqlite_storage.SqliteStorage        a local SQLite file with an R-tree spatial index
+#
+# The Firestore-only extras (cluster aggregates, the snapshot
+# listener behind the marker view, the migrate_*.py scripts) stay on Firestore.
+#
+# The ASGI app (asgi.py) uses get_async_storage(), which offers the same
+# methods as coroutines: on Firestore the request path runs on the AsyncClient
+# (firestore_storage.AsyncFirestoreStorage); everything else runs the
+# synchronous backend on a worker thread.
+
+load_dotenv()
+
+BACKENDS = ("firestore", "sqlite")
+
+class _TimedStorage:
+    """
+    Wraps a backend so every method call is timed in
+    storage_operation_duration_seconds and the request's Server-Timing.
+    Generators are timed over their whole iteration.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, operation):
+        method = getattr(self._backend, operation)
+        if not callable(method):
+            return method
+        timing_name = f"db-{operation}"
+
+        if inspect.iscoroutinefunction(method):
+            async def timed_async(*args, **kwargs):
+                with metrics.timer("storage_operation_duration_seconds", timing_name,
+                                   backend=self.name, operation=operation):
+                    return await method(*args, **kwargs)
+
+            return timed_async
+
+        def timed(*args, **kwargs):
+            if inspect.isgeneratorfunction(method):
+                return metrics.timed_iter(method(*args, **kwargs), "storage_operation_duration_seconds",
+                                          timing_name, backend=self.name, operation=operation)
+            with metrics.timer("storage_operation_duration_seconds", timing_name,
+                               backend=self.name, operation=operation):
+                return method(*args, **kwargs)
+
+        return timed
+
+
+class ThreadedStorage:
+    """
+    Async view of a synchronous backend: every method becomes a coroutine that
+    runs the call on a worker thread. Generators are read to a list there.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, operation):
+        method = getattr(self._backend, operation)
+        if not callable(method):
+            return method
+
+        def run(*args, **kwargs):
+            result = method(*args, **kwargs)
+            return list(result) if inspect.isgenerator(result) else result
+
+        async def threaded(*args, **kwargs):
+            return await asyncio.to_thread(run, *args, **kwargs)
+
+        return threaded
+
+
+_backend = None
+_storage = None
+_async_storage = None
+_storage_pid = None
+_storage_lock = threading.Lock()
+
+
+def backend_name():
+    """Returns the configured STORAGE_BACKEND, "firestore" (default) or "sqlite"."""
+    name = os.getenv("STORAGE_BACKEND", "firestore").lower()
+    if name not in BACKENDS:
+        raise ValueError(f"STORAGE_BACKEND must be one of {', '.join(BACKENDS)}")
+    return name
+
+
+def _ensure_backend():
+    # Called with _storage_lock held.
+    global _backend, _storage, _async_storage, _storage_pid
+    if _backend is None or _storage_pid != os.getpid():
+        if backend_name() == "sqlite":
+            from sqlite_storage import SqliteStorage
+            _backend = SqliteStorage(os.getenv("STORAGE_SQLITE_PATH", "reports.db"))
+        else:
+            from firestore_storage import FirestoreStorage
+            _backend = FirestoreStorage()
+        _storage = _TimedStorage(_backend) if metrics.ENABLED else _backend
+        _async_storage = None
+        _storage_pid = os.getpid()
+
+
+def get_storage():
+    """
+    Returns this process's storage backend, creating it on first use.
+
+    Environment:
+        STORAGE_BACKEND: "firestore" (default) or "sqlite".
+        STORAGE_SQLITE_PATH: Database file for the sqlite backend (default reports.db).
+    """
+    with _storage_lock:
+        _ensure_backend()
+        return _storage
+
+
+def get_async_storage():
+    """
+    Returns this process's storage backend with coroutine methods, for the
+    ASGI app. Firestore (but not its in-memory stand-in) uses the AsyncClient.
+    """
+    global _async_storage
+    with _storage_lock:
+        _ensure_backend()
+        if _async_storage is None:
+            threaded = ThreadedStorage(_backend)
+            if _backend.name == "firestore" and not firebase_client.uses_memory_backend():
+                from firestore_storage import AsyncFirestoreStorage
+                _async_storage = AsyncFirestoreStorage(threaded)
+            else:
+                _async_storage = threaded
+            if metrics.ENABLED:
+                _async_storage = _TimedStorage(_async_storage)
+        return _async_storage
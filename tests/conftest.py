@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+from io import BytesIO
+
+import pytest
+
+# Tests run against the in-process backends (FIRESTORE_BACKEND=memory and
+# STORAGE_BACKEND=sqlite) with PlantNet and OpenAI replaced by the servers in
+# fakeproviders.py, so they need neither credentials nor network access.
+#
+# to run: python -m pytest -q
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakeproviders  # noqa: E402
+
+# Tests read .requests on these to check whether a provider was called.
+PLANTNET = fakeproviders.FakeBehaviour()
+OPENAI = fakeproviders.FakeBehaviour()
+
+# Set before any app module is imported, since several read their settings at import.
+_env, _servers = fakeproviders.start_all(PLANTNET, OPENAI)
+os.environ.update(_env)
+os.environ.update(
+    FIRESTORE_BACKEND="memory",
+    MARKER_VIEW="off",
+    METRICS="off",
+    ID_CACHE="off",
+    VERDICT_CACHE="off",
+    INVASIVE_INDEX="off",
+    IMAGE_STORE_DIR=tempfile.mkdtemp(),
+    TILE_CACHE_DIR=tempfile.mkdtemp(),
+    ADMISSION_DB=os.path.join(tempfile.mkdtemp(), "admission.db"),
+)
+
+import admission  # noqa: E402
+import bench  # noqa: E402
+import firebase_client  # noqa: E402
+import imagestore  # noqa: E402
+import prof  # noqa: E402
+import storage  # noqa: E402
+import tiles  # noqa: E402
+
+BACKENDS = ("memory", "sqlite")
+
+
+def use_backend(monkeypatch, name, directory):
+    """
+    Points the storage layer at a fresh, empty backend ("memory" or "sqlite")
+    with its image store, tile cache and admission state under directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    monkeypatch.setenv("STORAGE_BACKEND", "sqlite" if name == "sqlite" else "firestore")
+    monkeypatch.setenv("STORAGE_SQLITE_PATH", os.path.join(directory, "reports.db"))
+    monkeypatch.setenv("IMAGE_STORE_DIR", os.path.join(directory, "images"))
+    monkeypatch.setenv("TILE_CACHE_DIR", os.path.join(directory, "tiles"))
+    monkeypatch.setenv("ADMISSION_DB", os.path.join(directory, "admission.db"))
+    monkeypatch.setattr(storage, "_backend", None)
+    monkeypatch.setattr(firebase_client.db, "_client", None)
+    monkeypatch.setattr(imagestore, "_store", None)
+    monkeypatch.setattr(tiles, "_cache", None)
+    monkeypatch.setattr(admission, "_control", None)
+    prof._cache.clear()
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch, tmp_path):
+    """Runs the test once on each backend; the value is the backend name."""
+    use_backend(monkeypatch, request.param, tmp_path)
+    return request.param
+
+
+@pytest.fixture
+def memory_backend(monkeypatch, tmp_path):
+    use_backend(monkeypatch, "memory", tmp_path)
+    return "memory"
+
+
+@pytest.fixture
+def client():
+    import app
+    return app.app.test_client()
+
+
+def post_report(client, email="a@example.com", lat="35.99", lng="-78.9", ip="127.0.0.1", query=""):
+    """Posts one report to /create_report and returns the closed response."""
+    data = {"email": email, "lat": lat, "lng": lng, "image": (BytesIO(bench.make_image(1, (64, 48))), "capture.jpg")}
+    response = client.post("/create_report" + query, data=data, content_type="multipart/form-data",
+                           environ_base={"REMOTE_ADDR": ip})
+    # Closing the response frees its admission slot, as the server would.
+    response.close()
+    return response
@@ -0,0 +1,86 @@
+from io import BytesIO
+
+import pytest
+
+import admission
+import bench
+from conftest import PLANTNET, post_report
+
+
+@pytest.fixture
+def limits(monkeypatch, backend):
+    monkeypatch.setenv("ADMISSION_USER_RATE", "1")
+    monkeypatch.setenv("ADMISSION_USER_BURST", "2")
+    monkeypatch.setenv("ADMISSION_IP_RATE", "1")
+    monkeypatch.setenv("ADMISSION_IP_BURST", "3")
+
+
+def test_user_over_burst_gets_429_with_retry_after(limits, client):
+    assert [post_report(client).status_code for _ in range(2)] == [302, 302]
+    calls = PLANTNET.requests
+
+    response = post_report(client)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["retry_after"] > 0
+    # Rejected before the upload reached the providers.
+    assert PLANTNET.requests == calls
+
+    # Other users from another address are not affected.
+    assert post_report(client, email="b@example.com", ip="10.0.0.2").status_code == 302
+
+
+def test_ip_bucket_limits_many_users_from_one_address(limits, client):
+    codes = [post_report(client, email=f"user{i}@example.com", ip="10.0.0.9").status_code for i in range(4)]
+    assert codes == [302, 302, 302, 429]
+
+
+def test_batch_costs_one_token_per_image(limits, client):
+    files = [(BytesIO(bench.make_image(i, (64, 48))), f"{i}.jpg") for i in range(3)]
+    data = {"email": "batch@example.com", "lat": ["35.99"] * 3, "lng": ["-78.9"] * 3, "images": files}
+    response = client.post("/create_reports", data=data, content_type="multipart/form-data")
+    response.get_data()
+    response.close()
+    # A batch above the burst is let through on a full bucket, leaving it in debt.
+    assert response.status_code == 200
+
+    response = post_report(client, email="batch@example.com", ip="10.0.0.3")
+    assert response.status_code == 429
+    # One token short plus the debt of one, at one token per minute.
+    assert response.headers["Retry-After"] == "120"
+
+
+def test_request_slots_are_released(monkeypatch, memory_backend):
+    monkeypatch.setenv("ADMISSION_REQUEST_SLOTS", "1")
+    ticket = admission.admit("test", "a@example.com", "10.0.0.1")
+    with pytest.raises(admission.Rejected) as rejected:
+        admission.admit("test", "b@example.com", "10.0.0.2")
+    assert rejected.value.reason == "busy"
+    assert rejected.value.retry_after == admission.RETRY_AFTER
+
+    ticket.release()
+    ticket.release()  # A second release is a no-op.
+    admission.admit("test", "b@example.com", "10.0.0.2").release()
+
+
+def test_pipeline_slots_shed_when_full(monkeypatch, memory_backend, client):
+    monkeypatch.setenv("ADMISSION_MAX_PIPELINES", "1")
+    monkeypatch.setenv("ADMISSION_MAX_WAITING", "0")
+    with admission.pipeline_slot():
+        with pytest.raises(admission.Rejected) as rejected:
+            with admission.pipeline_slot():
+                pass
+        assert rejected.value.reason == "overloaded"
+
+        response = post_report(client)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == str(int(admission.RETRY_AFTER))
+
+    with admission.pipeline_slot():
+        pass
+
+
+def test_client_ip_behind_trusted_proxies(monkeypatch):
+    assert admission.client_ip("10.0.0.1", "1.2.3.4, 5.6.7.8") == "10.0.0.1"
+    monkeypatch.setenv("ADMISSION_TRUSTED_PROXIES", "1")
+    assert admission.client_ip("10.0.0.1", "1.2.3.4, 5.6.7.8") == "5.6.7.8"
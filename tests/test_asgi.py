@@ -0,0 +1,71 @@
+import time
+from io import BytesIO
+
+import pytest
+from starlette.testclient import TestClient
+
+import bench
+import checkinvasive as ci
+import outbound
+import storage
+
+EMAIL = "a@example.com"
+
+
+@pytest.fixture
+def asgi_client(monkeypatch, backend):
+    import asgi
+
+    # The asyncio clients belong to the event loop that created them.
+    monkeypatch.setattr(outbound, "_async_providers", {})
+    monkeypatch.setattr(ci, "_async_batcher", None)
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def post_report(client, lat="35.99", query=""):
+    files = {"image": ("capture.jpg", BytesIO(bench.make_image(1, (64, 48))), "image/jpeg")}
+    data = {"email": EMAIL, "lat": lat, "lng": "-78.9"}
+    return client.post("/create_report" + query, data=data, files=files, follow_redirects=False)
+
+
+def test_report_is_ingested_on_the_event_loop(asgi_client):
+    response = post_report(asgi_client)
+    assert response.status_code == 302
+    [(_, data)] = storage.get_storage().iter_reports()
+    assert data["userEmail"] == EMAIL
+
+    reports = asgi_client.get(f"/getUserReportsInfo?email={EMAIL}&fields=id,plant_name").json()
+    assert [report["plant_name"] for report in reports] == [data["plant_name"]]
+    assert asgi_client.get(f"/getProfileInfo?email={EMAIL}").json()["stats"]["reports"] == 1
+
+
+def test_async_job_is_polled_to_completion(asgi_client):
+    response = post_report(asgi_client, query="?async=1")
+    assert response.status_code == 202
+    status_url = response.json()["status_url"]
+    for _ in range(100):
+        job = asgi_client.get(status_url).json()
+        if job["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done"
+    assert asgi_client.get("/report_status/nope").status_code == 404
+
+
+def test_bad_requests_match_the_flask_app(asgi_client):
+    assert post_report(asgi_client, lat="91").status_code == 400
+    assert asgi_client.post("/create_report", data={"email": EMAIL}).status_code == 400
+    assert asgi_client.get("/getUserReportsInfo").status_code == 400
+    assert asgi_client.get(f"/getUserReportsInfo?email={EMAIL}&cursor=bogus").status_code == 400
+
+
+def test_weak_etag_and_flask_fallthrough(asgi_client):
+    post_report(asgi_client)
+    url = f"/getUserReportsInfo?email={EMAIL}&limit=5"
+    etag = asgi_client.get(url).headers["etag"]
+    assert etag.startswith("W/")
+    assert asgi_client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    # Routes without a native handler are served by the Flask app.
+    assert asgi_client.get("/getMarkerViewStats").json() == {"enabled": False}
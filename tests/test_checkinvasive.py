@@ -0,0 +1,98 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import checkinvasive as ci
+
+
+def completion(verdicts=None, choices=None):
+    if choices is None:
+        content = json.dumps({"verdicts": verdicts})
+        choices = [SimpleNamespace(finish_reason="stop", message=SimpleNamespace(content=content, refusal=None))]
+    return SimpleNamespace(choices=choices)
+
+
+class StubClient:
+    """Stands in for the shared OpenAI provider, answering every chat with reply(items)."""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.requests = []
+
+    def chat(self, messages, **kwargs):
+        plants = json.loads(messages[1]["content"].split("\n", 1)[1])
+        self.requests.append(plants)
+        return self.reply(plants)
+
+
+def invasive_reply(plants):
+    return completion([{"index": p["index"], "invasive": True, "description": p["species"]} for p in plants])
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    def install(reply):
+        client = StubClient(reply)
+        monkeypatch.setattr(ci.outbound, "get_provider", lambda name: client)
+        return client
+    return install
+
+
+def classify_concurrently(batcher, plants):
+    results = [None] * len(plants)
+
+    def run(i):
+        try:
+            results[i] = batcher.classify(*plants[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(plants))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    return results
+
+
+def test_concurrent_plants_share_one_request(stub):
+    client = stub(invasive_reply)
+    plants = [("Pueraria montana", 35.99, -78.9), ("Hedera helix", 35.99, -78.9), ("pueraria  montana", 35.991, -78.9)]
+    results = classify_concurrently(ci.VerdictBatcher(0.2, 16), plants)
+    assert results == [(True, "Pueraria montana"), (True, "Hedera helix"), (True, "Pueraria montana")]
+    assert len(client.requests) == 1
+    assert len(client.requests[0]) == 2
+
+
+def test_reply_without_choices_fails_every_caller(stub):
+    stub(lambda plants: completion(choices=[]))
+    results = classify_concurrently(ci.VerdictBatcher(0.2, 16),
+                                    [("Pueraria montana", 35.99, -78.9), ("Hedera helix", 35.99, -78.9)])
+    assert all(isinstance(result, ci.ClassificationFailed) for result in results)
+
+
+def test_reply_missing_a_plant_fails(stub):
+    stub(lambda plants: completion([{"index": 0, "invasive": False, "description": ""}]))
+    results = classify_concurrently(ci.VerdictBatcher(0.2, 16),
+                                    [("Pueraria montana", 35.99, -78.9), ("Hedera helix", 35.99, -78.9)])
+    assert all(isinstance(result, ci.ClassificationFailed) for result in results)
+
+
+def test_cancelled_async_leader_fails_its_followers():
+    batcher = ci.AsyncVerdictBatcher(10, 16)
+
+    async def scenario():
+        leader = asyncio.ensure_future(batcher.classify("Pueraria montana", 35.99, -78.9))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(batcher.classify("Hedera helix", 35.99, -78.9))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(ci.ClassificationFailed):
+            await asyncio.wait_for(follower, 1)
+        assert batcher._pending is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import json
+import time
+from io import BytesIO
+
+import pytest
+
+import bench
+import reports as rp
+import storage
+from conftest import OPENAI, PLANTNET, post_report
+
+
+def wait_for_job(client, status_url):
+    for _ in range(100):
+        job = client.get(status_url).get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job still {job['status']}")
+
+
+def test_report_is_identified_and_stored(backend, client):
+    response = post_report(client)
+    assert response.status_code == 302
+    [(_, data)] = storage.get_storage().iter_reports()
+    assert data["userEmail"] == "a@example.com"
+    assert data["lat_num"] == 35.99
+
+
+@pytest.mark.parametrize("lat, lng", [("abc", "-78.9"), ("35.99", ""), ("91", "0"), ("0", "-180.5"), ("nan", "0")])
+def test_bad_coordinates_are_rejected_before_any_provider_call(backend, client, lat, lng):
+    calls = (PLANTNET.requests, OPENAI.requests)
+    assert post_report(client, lat=lat, lng=lng).status_code == 400
+    assert post_report(client, lat=lat, lng=lng, query="?async=1").status_code == 400
+    assert (PLANTNET.requests, OPENAI.requests) == calls
+    assert list(storage.get_storage().iter_reports()) == []
+
+
+def test_batch_item_with_bad_coordinates_is_rejected(backend, client):
+    files = [(BytesIO(bench.make_image(i, (64, 48))), f"{i}.jpg") for i in range(2)]
+    data = {"email": "a@example.com", "lat": ["abc", "35.99"], "lng": ["-78.9", "-78.9"], "images": files}
+    response = client.post("/create_reports", data=data, content_type="multipart/form-data")
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    outcomes = {outcome["filename"]: outcome for outcome in lines[:-1]}
+    assert outcomes["0.jpg"]["status"] == "rejected"
+    assert outcomes["1.jpg"]["status"] == "identified"
+    assert len(list(storage.get_storage().iter_reports())) == 1
+
+
+def test_storeInfo_raises_for_bad_coordinates(backend):
+    with pytest.raises(ValueError):
+        rp.storeInfo("a@example.com", "Pueraria montana", bench.make_image(1, (64, 48)), "abc", "1", "desc", True)
+
+
+@pytest.fixture
+def failing_storage(monkeypatch, backend):
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    backend = storage.get_storage()
+    monkeypatch.setattr(backend, "add_reports", fail)
+    monkeypatch.setattr(backend, "add_sighting", fail)
+
+
+def test_storage_failure_is_a_server_error(failing_storage, client):
+    response = post_report(client)
+    assert response.status_code == 503
+
+
+def test_storage_failure_fails_the_job(failing_storage, client):
+    response = post_report(client, query="?async=1")
+    assert response.status_code == 202
+    job = wait_for_job(client, response.get_json()["status_url"])
+    assert job["status"] == "failed"
+    assert "disk full" in job["error"]
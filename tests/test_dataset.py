@@ -0,0 +1,85 @@
+import base64
+import csv
+import io
+import json
+
+import bench
+import dataset
+import reports as rp
+import storage
+
+
+def ndjson(*records):
+    return [json.dumps(record) + "\n" for record in records]
+
+
+def run_import(lines, batch_size=2):
+    return list(dataset.import_ndjson(lines, batch_size=batch_size))
+
+
+def test_import_writes_reports_and_skips_known_ids(backend):
+    records = [{"id": f"r{i}", "plant_name": "Pueraria montana", "lat": 35.9 + i * 0.01, "lng": -78.9,
+                "invasive_info": True} for i in range(3)]
+    results = run_import(ndjson(*records))
+    assert results[-1] == {"processed": 3, "imported": 3, "skipped": 0, "errors": 0, "done": True}
+
+    results = run_import(ndjson(*records))
+    assert results[-1]["skipped"] == 3
+    assert sorted(doc_id for doc_id, _ in storage.get_storage().iter_reports()) == ["r0", "r1", "r2"]
+
+
+def test_bad_lines_are_reported_and_the_rest_imported(backend):
+    photo = base64.b64encode(bench.make_image(1, (64, 48))).decode("ascii")
+    lines = ndjson(
+        {"plant_name": "Pueraria montana", "lat": 35.9, "lng": -78.9, "image": photo},
+        {"plant_name": "Pueraria montana", "lat": 35.9, "lng": -78.9, "image": base64.b64encode(b"not an image").decode()},
+        {"plant_name": "Pueraria montana", "lat": 35.9, "lng": -78.9, "image": "***"},
+        {"plant_name": "Pueraria montana", "lat": 35.9, "lng": -78.9, "removed": "false"},
+        {"plant_name": "Pueraria montana", "lat": 95, "lng": -78.9},
+        {"lat": 35.9, "lng": -78.9},
+    ) + ["{not json\n", json.dumps({"plant_name": "Hedera helix", "lat": 36.0, "lng": -79.0, "removed": True}) + "\n"]
+
+    results = run_import(lines)
+    errors = {result["line"]: result["error"] for result in results if "line" in result}
+    assert sorted(errors) == [2, 3, 4, 5, 6, 7]
+    assert errors[2].startswith("image:")
+    assert errors[4] == "removed must be true or false"
+    assert results[-1] == {"processed": 8, "imported": 2, "skipped": 0, "errors": 6, "done": True}
+
+    stored = {data["plant_name"]: data for _, data in storage.get_storage().iter_reports()}
+    assert stored["Hedera helix"]["removed"] is True
+    assert stored["Pueraria montana"]["image_hash"]
+
+
+def test_import_endpoint_streams_progress(memory_backend, client):
+    body = "".join(ndjson({"plant_name": "Pueraria montana", "lat": 35.9, "lng": -78.9}))
+    response = client.post("/import", data=body, content_type="application/x-ndjson")
+    assert json.loads(response.get_data(as_text=True).splitlines()[-1])["imported"] == 1
+
+
+def test_export_formats(memory_backend, client):
+    report = rp.buildReport("a@example.com", "Pueraria montana", "0" * 64, "35.99", "-78.9", "desc", True)
+    [(report_id, _)] = rp.storeReports([report])
+
+    [row] = [json.loads(line) for line in client.get("/export").get_data(as_text=True).splitlines()]
+    assert row["id"] == report_id
+    assert (row["lat"], row["lng"]) == (35.99, -78.9)
+    assert set(row) == set(dataset.DEFAULT_FIELDS)
+
+    rows = list(csv.reader(io.StringIO(client.get("/export?format=csv&fields=id,plant_name").get_data(as_text=True))))
+    assert rows == [["id", "plant_name"], [report_id, "Pueraria montana"]]
+
+    collection = client.get("/export?format=geojson&fields=plant_name").get_json()
+    [feature] = collection["features"]
+    assert feature["geometry"]["coordinates"] == [-78.9, 35.99]
+    assert feature["properties"] == {"plant_name": "Pueraria montana"}
+
+    assert client.get("/export?format=xml").status_code == 400
+    assert client.get("/export?fields=nope").status_code == 400
+
+
+def test_reporter_emails_are_not_exportable(memory_backend, client):
+    rp.storeReports([rp.buildReport("a@example.com", "Pueraria montana", "0" * 64, "35.99", "-78.9", "desc", True)])
+    for fields in ("userEmail", "reporters", "id,userEmail"):
+        assert client.get(f"/export?fields={fields}").status_code == 400
+    assert "a@example.com" not in client.get("/export?fields=" + ",".join(dataset.FIELDS)).get_data(as_text=True)
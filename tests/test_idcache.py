@@ -0,0 +1,68 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import bench
+import idcache
+import idplant
+from conftest import PLANTNET
+
+
+def reencode(image_data, size=None, quality=60):
+    img = Image.open(BytesIO(image_data))
+    if size:
+        img = img.resize(size)
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return idcache.IdentificationCache(str(tmp_path / "ids.db"), ttl_seconds=3600, max_entries=100, max_distance=4)
+
+
+def test_exact_and_near_duplicates_hit(cache):
+    photo = bench.make_image(1, (320, 240))
+    cache.store(photo, "Pueraria montana")
+    assert cache.lookup(photo) == "Pueraria montana"
+    assert cache.lookup(reencode(photo, size=(160, 120))) == "Pueraria montana"
+    assert cache.lookup(bench.make_image(2, (320, 240))) is None
+    assert (cache.exact_hits, cache.near_hits, cache.misses) == (1, 1, 1)
+
+
+def test_near_matching_can_be_disabled(tmp_path):
+    cache = idcache.IdentificationCache(str(tmp_path / "ids.db"), ttl_seconds=3600, max_entries=100, max_distance=-1)
+    photo = bench.make_image(1, (320, 240))
+    cache.store(photo, "Pueraria montana")
+    assert cache.lookup(reencode(photo)) is None
+
+
+def test_expired_and_evicted_entries_miss(tmp_path):
+    cache = idcache.IdentificationCache(str(tmp_path / "ttl.db"), ttl_seconds=-1, max_entries=100, max_distance=4)
+    photo = bench.make_image(1, (320, 240))
+    cache.store(photo, "Pueraria montana")
+    assert cache.lookup(photo) is None
+
+    cache = idcache.IdentificationCache(str(tmp_path / "lru.db"), ttl_seconds=3600, max_entries=2, max_distance=-1)
+    for seed in range(3):
+        cache.store(bench.make_image(seed, (64, 48)), f"Species {seed}")
+    assert cache.stats()["entries"] == 2
+
+
+def test_undecodable_bytes_only_match_exactly(cache):
+    cache.store(b"not an image", "Pueraria montana")
+    assert idcache.dhash(b"not an image") is None
+    assert cache.lookup(b"not an image") == "Pueraria montana"
+
+
+def test_repeat_upload_skips_plantnet(monkeypatch, cache):
+    monkeypatch.setattr(idcache, "get_cache", lambda: cache)
+    photo = bench.make_image(3, (320, 240))
+    first = idplant.getPlant(BytesIO(photo))
+    assert first[0]
+    calls = PLANTNET.requests
+    assert idplant.getPlant(BytesIO(photo)) == first
+    assert idplant.getPlant(BytesIO(reencode(photo))) == first
+    assert PLANTNET.requests == calls
@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import checkinvasive as ci
+import invasiveindex
+import reports as rp
+
+DURHAM = (35.99, -78.9)
+ATLANTA = (33.75, -84.39)
+SEATTLE = (47.6, -122.3)
+
+
+@pytest.fixture(scope="module")
+def index():
+    return invasiveindex.InvasiveIndex.load(invasiveindex.DEFAULT_PATH)
+
+
+@pytest.fixture
+def bundled(monkeypatch):
+    monkeypatch.setenv("INVASIVE_INDEX", "on")
+    monkeypatch.delenv("INVASIVE_INDEX_PATH", raising=False)
+    monkeypatch.setattr(invasiveindex, "_index_loaded", False)
+
+
+def test_bundled_index_matches_its_sources():
+    with open(invasiveindex.DEFAULT_PATH, encoding="utf-8") as f:
+        assert json.load(f) == invasiveindex.build()
+
+
+def test_regions(index):
+    assert index.region_at(*DURHAM) == "NC"
+    assert index.region_at(*ATLANTA) == "GA"
+    assert index.region_at(*SEATTLE) is None
+    assert index.region_at("abc", "-78.9") is None
+
+
+def test_lookup_by_species_synonym_and_region(index):
+    listing = index.lookup("Pueraria lobata", *DURHAM)
+    assert (listing.species, listing.region) == ("Pueraria montana", "North Carolina")
+    assert invasiveindex.describe(listing).startswith("Kudzu (Pueraria montana) is invasive in North Carolina. ")
+    assert index.lookup("pueraria  MONTANA", *SEATTLE) is None
+    # Listed for Georgia and South Carolina only.
+    assert index.lookup("Imperata cylindrica", *ATLANTA) is not None
+    assert index.lookup("Imperata cylindrica", *DURHAM) is None
+    assert index.lookup("Quercus alba", *DURHAM) is None
+
+
+def test_listed_species_skip_the_llm(monkeypatch, bundled):
+    def llm(*args):
+        raise AssertionError("the LLM was asked")
+
+    monkeypatch.setattr(ci.get_batcher(), "classify", llm)
+    invasive, description = ci.check_invasive_plant("Pueraria montana", *DURHAM)
+    assert invasive is True
+    assert "smothers trees" in description
+
+    monkeypatch.setattr(ci.get_batcher(), "classify", lambda *args: (False, "Not Invasive"))
+    assert ci.check_invasive_plant("Quercus alba", *DURHAM) == (False, "Not Invasive")
+
+
+def test_listing_without_description_takes_the_llm_details():
+    listing = invasiveindex.Listing("Pueraria montana", "", "North Carolina", "")
+    assert ci._listed_verdict(listing, (True, "Smothers trees.")) == \
+        (True, "Pueraria montana is invasive in North Carolina. Smothers trees.")
+    # The table's verdict stands even when the LLM disagrees.
+    assert ci._listed_verdict(listing, (False, "Not Invasive")) == \
+        (True, "Pueraria montana is invasive in North Carolina.")
+
+
+def test_hit_rate_replays_an_export(index, memory_backend, client, tmp_path):
+    rp.storeReports([
+        rp.buildReport("a@example.com", "Pueraria montana", "0" * 64, *map(str, DURHAM), "desc", True),
+        rp.buildReport("a@example.com", "Quercus alba", "0" * 64, *map(str, DURHAM), "Not Invasive", False),
+        rp.buildReport("a@example.com", "Hedera helix", "0" * 64, *map(str, SEATTLE), "desc", True),
+    ])
+    path = tmp_path / "reports.ndjson"
+    path.write_bytes(client.get("/export?format=ndjson").get_data())
+
+    result = invasiveindex.hit_rate(index, invasiveindex._rows_from_file(str(path)))
+    assert (result["reports"], result["hits"], result["agree"]) == (3, 1, 1)
+    assert (result["outside"], result["unlisted"]) == (1, 1)
+    assert result["missed"] == {"Quercus alba": 1}
@@ -0,0 +1,152 @@
+import pytest
+
+import reports as rp
+import storage
+
+
+def store(plant_name, lat, lng, email="a@example.com", invasive=True):
+    """Stores one report and returns its ID."""
+    report = rp.buildReport(email, plant_name, "0" * 64, lat, lng, "desc", invasive)
+    [(report_id, merged)] = rp.storeReports([report])
+    assert not merged
+    return report_id
+
+
+def all_pages(bbox, limit, species=None):
+    ids = []
+    cursor = None
+    while True:
+        page = rp.getMarkersInBBox(bbox, species=species, cursor=cursor, limit=limit)
+        assert len(page["markers"]) <= limit
+        ids += [marker["id"] for marker in page["markers"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            return ids
+
+
+def test_bbox_pages_cover_every_marker_once(backend):
+    inside = [store("Pueraria montana", 35.5 + i * 0.01, -78.5 + (i % 5) * 0.01) for i in range(23)]
+    store("Pueraria montana", 37.0, -78.5)
+    store("Quercus alba", 35.6, -78.45, invasive=False)
+    removed = store("Pueraria montana", 35.7, -78.45)
+    rp.markMarkerAsRemoved(removed)
+
+    ids = all_pages((35.0, -79.0, 36.0, -78.0), limit=4)
+    assert len(ids) == len(set(ids))
+    assert sorted(ids) == sorted(inside)
+
+
+def test_bbox_species_filter(backend):
+    kudzu = store("Pueraria montana", 35.5, -78.5)
+    store("Hedera helix", 35.6, -78.5)
+    assert all_pages((35.0, -79.0, 36.0, -78.0), limit=10, species="Pueraria montana") == [kudzu]
+
+
+def test_bbox_rejects_malformed_cursor(backend):
+    with pytest.raises(ValueError):
+        rp.getMarkersInBBox((35.0, -79.0, 36.0, -78.0), cursor="not-a-cursor")
+
+
+def test_bbox_route_pages(backend, client):
+    for i in range(5):
+        store("Pueraria montana", 35.5 + i * 0.01, -78.5)
+    first = client.get("/getMarkers?bbox=35,-79,36,-78&limit=3").get_json()
+    assert len(first["markers"]) == 3 and first["next_cursor"]
+    second = client.get(f"/getMarkers?bbox=35,-79,36,-78&limit=3&cursor={first['next_cursor']}").get_json()
+    assert len(second["markers"]) == 2 and second["next_cursor"] is None
+    assert client.get("/getMarkers?bbox=35,-79,36&limit=3").status_code == 400
+
+
+def test_sync_feed_returns_changes_and_tombstones(backend):
+    first = store("Pueraria montana", 35.5, -78.5)
+    second = store("Pueraria montana", 35.6, -78.5)
+    not_invasive = store("Quercus alba", 35.7, -78.5, invasive=False)
+
+    feed = rp.getMarkerChanges("0")
+    assert sorted(marker["id"] for marker in feed["markers"]) == sorted([first, second])
+    assert feed["removed"] == [not_invasive]
+    assert feed["has_more"] is False
+
+    # Nothing changed since the cursor.
+    assert rp.getMarkerChanges(feed["cursor"]) == {
+        "markers": [], "removed": [], "cursor": feed["cursor"], "has_more": False,
+    }
+
+    rp.markMarkerAsRemoved(first)
+    later = rp.getMarkerChanges(feed["cursor"])
+    assert later["markers"] == []
+    assert later["removed"] == [first]
+
+    rp.markMarkerAsRemoved(first, False)
+    restored = rp.getMarkerChanges(later["cursor"])
+    assert [marker["id"] for marker in restored["markers"]] == [first]
+    assert restored["removed"] == []
+
+
+def test_sync_feed_pages_with_has_more(backend):
+    ids = [store("Pueraria montana", 35.5 + i * 0.01, -78.5) for i in range(5)]
+    seen = []
+    cursor = "0"
+    while True:
+        feed = rp.getMarkerChanges(cursor, limit=2)
+        seen += [marker["id"] for marker in feed["markers"]]
+        cursor = feed["cursor"]
+        if not feed["has_more"]:
+            break
+    assert seen == ids
+
+
+def test_sync_feed_rejects_malformed_cursor(backend):
+    with pytest.raises(ValueError):
+        rp.getMarkerChanges("garbage")
+
+
+def cluster_counts(bbox=(35.0, -79.0, 36.0, -78.0), zoom=4):
+    return sum(cluster["count"] for cluster in storage.get_storage().clusters(bbox, zoom)["clusters"])
+
+
+def test_clusters_follow_adds_and_removals(backend):
+    ids = [store("Pueraria montana", 35.5 + i * 0.01, -78.5) for i in range(3)]
+    store("Hedera helix", 35.5, -78.4)
+    store("Quercus alba", 35.5, -78.3, invasive=False)
+    assert cluster_counts() == 4
+
+    rp.markMarkerAsRemoved(ids[0])
+    assert cluster_counts() == 3
+    top = storage.get_storage().clusters((35.0, -79.0, 36.0, -78.0), 4)["clusters"][0]["top_species"]
+    assert {"name": "Pueraria montana", "count": 2} in top
+
+    rp.markMarkerAsRemoved(ids[0], False)
+    assert cluster_counts() == 4
+
+    rp.bulkRemoveMarkers(ids)
+    assert cluster_counts() == 1
+
+
+def test_bulk_removal_reports_each_outcome(backend):
+    ids = [store("Pueraria montana", 35.5 + i * 0.01, -78.5) for i in range(3)]
+    rp.markMarkerAsRemoved(ids[0])
+
+    result = rp.bulkRemoveMarkers(ids + [ids[1], "missing"])
+    assert result["removed"] == 2
+    assert result["results"] == {
+        ids[0]: "already_removed", ids[1]: "removed", ids[2]: "removed", "missing": "not_found",
+    }
+    assert rp.getMarkers() == []
+    assert rp.findMarkersInRegion(bbox=(35.0, -79.0, 36.0, -78.0)) == []
+
+
+def test_bulk_removal_route_by_region(backend, client):
+    inside = [store("Pueraria montana", 35.5 + i * 0.01, -78.5) for i in range(3)]
+    outside = store("Pueraria montana", 37.0, -78.5)
+
+    response = client.post("/bulk_remove_markers", json={"bbox": [35.0, -79.0, 36.0, -78.0]})
+    assert response.status_code == 200
+    assert response.get_json()["removed"] == 3
+    assert sorted(response.get_json()["results"]) == sorted(inside)
+    assert [marker["id"] for marker in rp.getMarkers()] == [outside]
+
+    polygon = [[36.9, -78.6], [37.1, -78.6], [37.0, -78.4]]
+    response = client.post("/bulk_remove_markers", json={"polygon": polygon, "species": "Pueraria montana"})
+    assert response.get_json() == {"results": {outside: "removed"}, "removed": 1}
+    assert client.post("/bulk_remove_markers", json={}).status_code == 400
@@ -0,0 +1,55 @@
+import gzip
+import os
+
+import pytest
+
+import markerview
+import reports as rp
+from conftest import ROOT
+
+
+@pytest.fixture
+def view(monkeypatch, memory_backend):
+    monkeypatch.setenv("MARKER_VIEW", "on")
+    monkeypatch.setattr(markerview, "_view", None)
+    assert markerview.warm_up()
+    return markerview.get_view()
+
+
+def test_warm_up_is_a_no_op_when_disabled(memory_backend):
+    assert markerview.warm_up() is False
+
+
+def test_writes_reach_getMarkers_through_the_view(view, client):
+    assert client.get("/getMarkers").get_json() == []
+    report = rp.buildReport("a@example.com", "Pueraria montana", "0" * 64, "35.99", "-78.9", "desc", True)
+    [(report_id, _)] = rp.storeReports([report])
+
+    response = client.get("/getMarkers")
+    assert [marker["id"] for marker in response.get_json()] == [report_id]
+    assert client.get("/getMarkerViewStats").get_json()["live"] is True
+    assert view.fallbacks == 0
+
+    assert client.get("/getMarkers", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    response = client.get("/getMarkers", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert len(gzip.decompress(response.get_data())) > 0
+
+    rp.markMarkerAsRemoved(report_id)
+    assert client.get("/getMarkers").get_json() == []
+
+
+def test_gunicorn_warms_the_view_after_fork(monkeypatch, memory_backend):
+    monkeypatch.setenv("MARKER_VIEW", "on")
+    monkeypatch.setattr(markerview, "_view", None)
+    config = {}
+    with open(os.path.join(ROOT, "gunicorn.conf.py")) as f:
+        exec(f.read(), config)
+
+    class Log:
+        def info(self, *args):
+            pass
+
+    server = type("Server", (), {"log": Log()})()
+    config["post_fork"](server, type("Worker", (), {"pid": 1})())
+    assert markerview.get_view().is_live()
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+from flask import Flask
+
+import metrics
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+@pytest.fixture
+def client(enabled):
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    @app.route("/work")
+    def work():
+        for _ in range(2):
+            with metrics.timer("storage_operation_duration_seconds", "storage", op="read"):
+                time.sleep(0.002)
+        return "done"
+
+    return app.test_client()
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    metrics.reset()
+    with metrics.timer("storage_operation_duration_seconds", op="read"):
+        pass
+    metrics.inc("outbound_requests_total", provider="plantnet")
+    assert metrics.render() == "\n"
+    app = Flask(__name__)
+    metrics.init_app(app)
+    assert "Server-Timing" not in app.test_client().get("/metrics").headers
+
+
+def test_render_counters_and_histograms(enabled):
+    metrics.inc("outbound_requests_total", provider="plantnet")
+    metrics.inc("outbound_requests_total", 2, provider="plantnet")
+    metrics.observe("classify_batch_size", 3, buckets=metrics.BATCH_BUCKETS)
+    text = metrics.render()
+    assert "# TYPE outbound_requests_total counter" in text
+    assert 'outbound_requests_total{provider="plantnet"} 3' in text
+    assert 'classify_batch_size_bucket{le="2"} 0' in text
+    assert 'classify_batch_size_bucket{le="4"} 1' in text
+    assert 'classify_batch_size_bucket{le="+Inf"} 1' in text
+    assert "classify_batch_size_sum 3" in text
+
+
+def test_timed_iter_counts_only_production_time(enabled):
+    def produce():
+        yield 1
+        time.sleep(0.01)
+        yield 2
+
+    for _ in metrics.timed_iter(produce(), "tile_render_duration_seconds"):
+        time.sleep(0.05)
+    histogram = metrics._histograms[("tile_render_duration_seconds", ())]
+    assert histogram.count == 1
+    assert 0.01 <= histogram.sum < 0.05
+
+
+def test_server_timing_and_metrics_endpoint(client):
+    response = client.get("/work")
+    entries = response.headers["Server-Timing"].split(", ")
+    assert entries[0].startswith("storage;dur=") and entries[0].endswith(';desc="x2"')
+    assert entries[-1].startswith("total;dur=")
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'storage_operation_duration_seconds_count{op="read"} 2' in text
+    assert 'http_request_duration_seconds_count{endpoint="work",method="GET",status="200"} 1' in text
+
+
+def test_slow_requests_reach_the_hook(monkeypatch, enabled):
+    monkeypatch.setattr(metrics, "_profiler", metrics.SamplingProfiler(0.001))
+    monkeypatch.setattr(metrics, "SLOW_MS", 10)
+    slow = []
+    monkeypatch.setattr(metrics, "_slow_request_hook", lambda info, duration, stacks: slow.append((info, stacks)))
+
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    @app.route("/slow")
+    def slow_route():
+        time.sleep(0.05)
+        return "done"
+
+    @app.route("/fast")
+    def fast_route():
+        return "done"
+
+    client = app.test_client()
+    client.get("/fast")
+    client.get("/slow")
+    [(info, stacks)] = slow
+    assert info["endpoint"] == "slow_route"
+    assert any("slow_route" in stack for stack in stacks)
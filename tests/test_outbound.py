@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+import outbound
+
+
+class Flaky(Exception):
+    pass
+
+
+def provider(**overrides):
+    config = dict(outbound.load_config("plantnet"), RETRIES=2, BACKOFF=0, BREAKER_THRESHOLD=2,
+                  BREAKER_RESET=30.0, MAX_CONCURRENCY=1, ACQUIRE_TIMEOUT=0.05)
+    config.update(overrides)
+    return outbound.Provider("stub", config, retryable=(Flaky,))
+
+
+def failing(times, result="ok"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= times:
+            raise Flaky()
+        return result
+
+    fn.calls = calls
+    return fn
+
+
+def half_open(stub):
+    stub.breaker.failures = stub.breaker.threshold
+    stub.breaker.opened_at = -stub.breaker.reset_seconds
+    assert stub.breaker.state == "half-open"
+
+
+def test_retryable_errors_are_retried():
+    stub = provider()
+    fn = failing(2)
+    assert stub.call(fn) == "ok"
+    assert len(fn.calls) == 3
+    assert stub.stats() == {"calls": 3, "errors": 2, "rejected": 0, "breaker": "closed"}
+
+
+def test_breaker_opens_and_fails_fast():
+    stub = provider()
+    for _ in range(2):
+        with pytest.raises(Flaky):
+            stub.call(failing(10))
+    assert stub.breaker.state == "open"
+
+    fn = failing(0)
+    with pytest.raises(outbound.ProviderUnavailable):
+        stub.call(fn)
+    assert fn.calls == []
+    assert stub.rejected == 1
+
+
+def test_half_open_trial_closes_the_breaker():
+    stub = provider()
+    half_open(stub)
+    assert stub.call(failing(0)) == "ok"
+    assert stub.breaker.state == "closed"
+
+
+def test_saturated_trial_is_handed_back():
+    stub = provider()
+    half_open(stub)
+    stub._slots.acquire()
+    with pytest.raises(outbound.ProviderUnavailable, match="saturated"):
+        stub.call(failing(0))
+    stub._slots.release()
+
+    assert stub.call(failing(0)) == "ok"
+    assert stub.breaker.state == "closed"
+
+
+def test_interrupted_trial_is_handed_back():
+    stub = provider()
+    half_open(stub)
+
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        stub.call(interrupted)
+    assert stub.call(failing(0)) == "ok"
+
+
+def test_cancelled_async_trial_is_handed_back():
+    stub = provider()
+    half_open(stub)
+
+    async def hang():
+        await asyncio.Event().wait()
+
+    async def ok():
+        return "ok"
+
+    async def scenario():
+        task = asyncio.ensure_future(stub.acall(hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return await stub.acall(ok)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert stub.breaker.state == "closed"
+
+
+def test_async_saturated_trial_is_handed_back():
+    stub = provider()
+    half_open(stub)
+
+    async def ok():
+        return "ok"
+
+    async def scenario():
+        await stub._async_slots.acquire()
+        with pytest.raises(outbound.ProviderUnavailable, match="saturated"):
+            await stub.acall(ok)
+        stub._async_slots.release()
+        return await stub.acall(ok)
+
+    assert asyncio.run(scenario()) == "ok"
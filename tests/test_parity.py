@@ -0,0 +1,72 @@
+import json
+
+import reports as rp
+import storage
+from conftest import BACKENDS, use_backend
+
+BBOX = (35.0, -79.0, 37.0, -77.0)
+USERS = ("a@example.com", "b@example.com", "c@example.com")
+
+
+def scenario():
+    """Writes the same reports, merges and removals, and returns what the read paths see."""
+    species = ("Pueraria montana", "Hedera helix", "Ailanthus altissima")
+    reports = []
+    for i in range(30):
+        lat = f"{35.5 + (i % 10) * 0.05:.5f}"
+        lng = f"{-78.5 + (i // 10) * 0.3:.5f}"
+        reports.append(rp.buildReport(USERS[i % 3], species[i % 3], "0" * 64, lat, lng, "desc", True))
+    # A repeat sighting of the first patch, and a report that is never a marker.
+    reports.append(rp.buildReport("b@example.com", "Pueraria montana", "0" * 64, "35.50001", "-78.5", "desc", True))
+    reports.append(rp.buildReport("c@example.com", "Quercus alba", "0" * 64, "35.6", "-78.4", "Not Invasive", False))
+    rp.storeReports(reports)
+
+    rp.markMarkerAsRemoved(rp.findMarkersInRegion(bbox=(35.79, -78.51, 35.81, -78.49))[0])
+    rp.bulkRemoveMarkers(rp.findMarkersInRegion(bbox=(35.0, -78.3, 36.0, -78.1), species="Hedera helix"))
+
+    def place(marker):
+        return (marker["key"], round(marker["vars"]["lat"], 6), round(marker["vars"]["lng"], 6), marker["vars"]["sightings"])
+
+    pages = []
+    cursor = None
+    while True:
+        page = rp.getMarkersInBBox(BBOX, cursor=cursor, limit=7)
+        pages += [place(marker) for marker in page["markers"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    feed = rp.getMarkerChanges("0", limit=1000)
+    backend = storage.get_storage()
+    clusters = {
+        zoom: sorted((c["count"], round(c["lat"], 6), round(c["lng"], 6), json.dumps(c["top_species"]))
+                     for c in backend.clusters(BBOX, zoom)["clusters"])
+        for zoom in (3, 9)
+    }
+    profiles = {}
+    for email in USERS:
+        _, data = backend.get_profile(email)
+        stats = dict(data["stats"])
+        stats.pop("last_report_at")
+        profiles[email] = stats
+    return {
+        "markers": sorted(place(marker) for marker in rp.getMarkers()),
+        "pages": pages,
+        "feed": (len(feed["markers"]), len(feed["removed"])),
+        "clusters": clusters,
+        "profiles": profiles,
+        "user_reports": sorted(report["plant_name"] for report in rp.getUserReportsInfo("a@example.com")),
+    }
+
+
+def test_sqlite_and_memory_backends_agree(monkeypatch, tmp_path):
+    results = {}
+    for name in BACKENDS:
+        use_backend(monkeypatch, name, str(tmp_path / name))
+        results[name] = scenario()
+
+    memory, sqlite = results["memory"], results["sqlite"]
+    assert len(memory["markers"]) == 25
+    assert sorted(memory["pages"]) == memory["markers"]
+    for key in memory:
+        assert memory[key] == sqlite[key], key
@@ -0,0 +1,71 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import bench
+import preprocess
+from conftest import post_report
+
+_ORIENTATION = 0x0112
+
+
+def jpeg(size=(400, 200), exif=None, color=(40, 120, 40)):
+    output = BytesIO()
+    Image.new("RGB", size, color).save(output, format="JPEG", exif=exif or Image.Exif())
+    return BytesIO(output.getvalue())
+
+
+def test_upload_over_the_byte_cap_is_rejected():
+    data = b"x" * 1000
+    assert preprocess.spool_upload(BytesIO(data), max_bytes=1000).read() == data
+    with pytest.raises(preprocess.ImageRejected, match="too large"):
+        preprocess.spool_upload(BytesIO(data), max_bytes=999)
+
+
+def test_header_check_rejects_non_images_and_huge_sources(monkeypatch):
+    with pytest.raises(preprocess.ImageRejected, match="Invalid"):
+        preprocess.check_header(BytesIO(b"not an image"))
+
+    upload = jpeg((400, 200))
+    monkeypatch.setattr(preprocess, "MAX_SOURCE_PIXELS", 400 * 200 - 1)
+    with pytest.raises(preprocess.ImageRejected, match="too many pixels"):
+        preprocess.check_header(upload)
+    assert upload.tell() == 0
+
+
+def test_orientation_is_applied_and_metadata_dropped():
+    exif = Image.Exif()
+    exif[_ORIENTATION] = 6
+    image = preprocess.prepare_image(jpeg((400, 200), exif))
+    assert (image.width, image.height) == (200, 400)
+    assert image.mime == "image/jpeg"
+    assert len(Image.open(BytesIO(image.data)).getexif()) == 0
+
+
+def test_gps_position_is_read_from_exif():
+    exif = Image.Exif()
+    exif[0x8825] = {1: "N", 2: (35.0, 59.0, 24.0), 3: "W", 4: (78.0, 54.0, 0.0)}
+    lat, lng = preprocess.gps_coordinates(jpeg(exif=exif))
+    assert (round(lat, 2), round(lng, 2)) == (35.99, -78.9)
+    assert preprocess.gps_coordinates(jpeg()) is None
+
+
+def test_output_fits_the_edge_and_byte_budget():
+    upload = BytesIO(bench.make_image(1, (2000, 1500), quality=95))
+    image = preprocess.prepare_image(upload, max_edge=800, target_bytes=30 * 1024)
+    assert max(image.width, image.height) <= 800
+    assert len(image.data) <= 30 * 1024
+
+
+def test_transparency_is_flattened_onto_white():
+    output = BytesIO()
+    Image.new("RGBA", (64, 64), (0, 0, 0, 0)).save(output, format="PNG")
+    image = preprocess.prepare_image(BytesIO(output.getvalue()))
+    assert Image.open(BytesIO(image.data)).getpixel((32, 32)) > (240, 240, 240)
+
+
+def test_oversized_upload_is_a_413(monkeypatch, memory_backend, client):
+    spool_upload = preprocess.spool_upload
+    monkeypatch.setattr(preprocess, "spool_upload", lambda stream: spool_upload(stream, max_bytes=10))
+    assert post_report(client).status_code == 413
@@ -0,0 +1,87 @@
+import prof
+import reports as rp
+import storage
+import userstats
+
+
+def store(email, plant_name, lat, invasive=True):
+    report = rp.buildReport(email, plant_name, "0" * 64, str(lat), "-78.9", "desc", invasive)
+    [(report_id, merged)] = rp.storeReports([report])
+    return report_id, merged
+
+
+def stats(client, email):
+    response = client.get(f"/getProfileInfo?email={email}")
+    assert response.status_code == 200
+    data = response.get_json()["stats"]
+    data.pop("last_report_at")
+    return data
+
+
+def test_stats_follow_reports_sightings_and_removals(backend, client):
+    kudzu, _ = store("a@example.com", "Pueraria montana", 35.0)
+    store("a@example.com", "Hedera helix", 35.5)
+    store("a@example.com", "Quercus alba", 36.0, invasive=False)
+    assert stats(client, "a@example.com") == {"reports": 3, "invasive": 2, "removed": 0, "species": 3}
+
+    # A sighting merged into a's report counts for b as well.
+    _, merged = store("b@example.com", "Pueraria montana", 35.0)
+    assert merged
+    assert stats(client, "b@example.com") == {"reports": 1, "invasive": 1, "removed": 0, "species": 1}
+
+    # Removals count against the owner only, and the cached profile is dropped.
+    rp.markMarkerAsRemoved(kudzu)
+    assert stats(client, "a@example.com")["removed"] == 1
+    assert stats(client, "b@example.com")["removed"] == 0
+    assert client.get("/getProfileInfo?email=nobody@example.com").status_code == 404
+
+
+def test_profiles_are_cached_without_sharing_the_backend_dict(monkeypatch, memory_backend, client):
+    store("a@example.com", "Pueraria montana", 35.0)
+    backend = storage.get_storage()
+    stored = backend.get_profile("a@example.com")
+    reads = []
+
+    def get_profile(email):
+        reads.append(email)
+        return stored
+
+    monkeypatch.setattr(backend, "get_profile", get_profile)
+    first = client.get("/getProfileInfo?email=a@example.com").get_json()
+    assert client.get("/getProfileInfo?email=a@example.com").get_json() == first
+    assert reads == ["a@example.com"]
+    # The cached profile is a copy; the backend's dictionary is left as it was.
+    assert "id" not in stored[1]
+    assert stored[1]["stats"]["species"] == {"Pueraria montana": 1}
+
+    prof.invalidate(["a@example.com"])
+    client.get("/getProfileInfo?email=a@example.com")
+    assert len(reads) == 2
+
+
+def test_cache_can_be_disabled_and_is_bounded(monkeypatch, memory_backend):
+    monkeypatch.setattr(prof, "CACHE_TTL_SECONDS", 0)
+    prof._remember("a@example.com", {"id": "a"})
+    assert prof._cached("a@example.com") == (False, None)
+
+    monkeypatch.setattr(prof, "CACHE_TTL_SECONDS", 30)
+    monkeypatch.setattr(prof, "CACHE_SIZE", 2)
+    for email in ("a", "b", "c"):
+        prof._remember(email, {"id": email})
+    assert list(prof._cache) == ["b", "c"]
+
+
+def test_rebuild_matches_the_incremental_stats(memory_backend):
+    store("a@example.com", "Pueraria montana", 35.0)
+    store("b@example.com", "Pueraria montana", 35.0)
+    store("a@example.com", "Quercus alba", 36.0, invasive=False)
+
+    def counts():
+        # last_report_at is left out: a rebuild dates a sighting by the report it was merged into.
+        backend = storage.get_storage()
+        return {email: dict(backend.get_profile(email)[1]["stats"], last_report_at=None)
+                for email in ("a@example.com", "b@example.com")}
+
+    before = counts()
+    assert userstats.rebuild() == 2
+    assert counts() == before
@@ -0,0 +1,76 @@
+import bench
+import reports as rp
+import storage
+
+
+def report(email, plant_name, lat, lng, image_pixels=None, invasive=True):
+    return rp.buildReport(email, plant_name, "0" * 64, lat, lng, "desc", invasive, image_pixels=image_pixels)
+
+
+def stored():
+    return dict(storage.get_storage().iter_reports())
+
+
+def test_repeat_sighting_merges_into_nearest_site(backend):
+    small = bench.make_image(1, (64, 48))
+    large = bench.make_image(2, (320, 240))
+    rp.storeInfo("a@example.com", "Pueraria montana", small, "35.99", "-78.9", "desc", True, image_pixels=64 * 48)
+    # About 14m away: the same patch, with a larger image.
+    rp.storeInfo("b@example.com", "Pueraria montana", large, "35.9901", "-78.9001", "desc", True, image_pixels=320 * 240)
+    # Same spot, smaller image again.
+    rp.storeInfo("a@example.com", "Pueraria montana", small, "35.99005", "-78.9", "desc", True, image_pixels=64 * 48)
+
+    [(site_id, site)] = stored().items()
+    assert site["sightings"] == 3
+    assert site["reporters"] == ["a@example.com", "b@example.com"]
+    assert site["image_pixels"] == 320 * 240
+    # The site keeps its original position.
+    assert site["lat"] == "35.99"
+    [marker] = rp.getMarkers()
+    assert marker["id"] == site_id and marker["vars"]["sightings"] == 3
+
+
+def test_distant_other_species_and_non_invasive_reports_are_not_merged(backend):
+    results = rp.storeReports([
+        report("a@example.com", "Pueraria montana", "35.99", "-78.9"),
+        report("b@example.com", "Pueraria montana", "35.991", "-78.9"),  # about 111m away
+        report("b@example.com", "Hedera helix", "35.99", "-78.9"),
+        report("c@example.com", "Quercus alba", "35.99", "-78.9", invasive=False),
+        report("c@example.com", "Quercus alba", "35.99", "-78.9", invasive=False),
+    ])
+    assert [merged for _, merged in results] == [False] * 5
+    assert len(stored()) == 5
+
+
+def test_batch_merges_into_stored_and_earlier_sites(backend):
+    [(site_id, _)] = rp.storeReports([report("a@example.com", "Pueraria montana", "35.99", "-78.9")])
+    results = rp.storeReports([
+        report("b@example.com", "Pueraria montana", "35.99001", "-78.9"),
+        report("b@example.com", "Pueraria montana", "36.5", "-78.9"),
+        report("c@example.com", "Pueraria montana", "36.50001", "-78.9", image_pixels=9),
+    ])
+    assert results[0] == (site_id, True)
+    assert results[1][1] is False
+    assert results[2] == (results[1][0], True)
+
+    reports = stored()
+    assert len(reports) == 2
+    assert reports[site_id]["sightings"] == 2
+    assert reports[results[1][0]]["reporters"] == ["b@example.com", "c@example.com"]
+
+
+def test_removed_site_is_not_merged_into(backend):
+    [(site_id, _)] = rp.storeReports([report("a@example.com", "Pueraria montana", "35.99", "-78.9")])
+    rp.markMarkerAsRemoved(site_id)
+    [(report_id, merged)] = rp.storeReports([report("b@example.com", "Pueraria montana", "35.99", "-78.9")])
+    assert not merged and report_id != site_id
+
+
+def test_merged_sightings_count_for_every_reporter(backend, client):
+    rp.storeReports([
+        report("a@example.com", "Pueraria montana", "35.99", "-78.9"),
+        report("b@example.com", "Pueraria montana", "35.99001", "-78.9"),
+    ])
+    for email in ("a@example.com", "b@example.com"):
+        stats = client.get(f"/getProfileInfo?email={email}").get_json()["stats"]
+        assert stats["reports"] == 1 and stats["species"] == 1
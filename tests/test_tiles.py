@@ -0,0 +1,66 @@
+import json
+
+import dataset
+import reports as rp
+import tiles
+
+DURHAM = (35.99, -78.9)
+ZOOM = 10
+
+
+def tile_url(species="all", lat=DURHAM[0], lng=DURHAM[1], tile_format="json"):
+    x, y = tiles.tile_for(lat, lng, ZOOM)
+    return f"/tiles/{species}/{ZOOM}/{x}/{y}.{tile_format}"
+
+
+def store(lat=DURHAM[0], lng=DURHAM[1], plant_name="Pueraria montana", email="a@example.com", invasive=True):
+    report = rp.buildReport(email, plant_name, "0" * 64, str(lat), str(lng), "desc", invasive)
+    [(report_id, merged)] = rp.storeReports([report])
+    return report_id, merged
+
+
+def fetch(client, url=None):
+    response = client.get(url or tile_url())
+    assert response.status_code == 200
+    return response
+
+
+def test_tiles_are_cached_and_revalidated(backend, client):
+    store()
+    first = fetch(client)
+    assert json.loads(first.get_data())["total"] == 1
+    assert fetch(client).headers["ETag"] == first.headers["ETag"]
+    assert client.get(tile_url(), headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert fetch(client, tile_url(tile_format="png")).mimetype == "image/png"
+    assert client.get(f"/tiles/all/{tiles.MAX_ZOOM + 1}/0/0.png").status_code == 400
+
+
+def test_stores_and_removals_change_the_tile(backend, client):
+    etag = fetch(client).headers["ETag"]
+    report_id, _ = store()
+    after_store = fetch(client).headers["ETag"]
+    assert after_store != etag
+
+    # Neither a non-invasive report nor a report in another tile changes it.
+    store(plant_name="Quercus alba", invasive=False)
+    store(lat=47.6, lng=-122.3)
+    assert fetch(client).headers["ETag"] == after_store
+
+    rp.markMarkerAsRemoved(report_id)
+    response = fetch(client)
+    assert response.headers["ETag"] != after_store
+    assert json.loads(response.get_data())["total"] == 0
+
+
+def test_imports_change_the_tile_and_profiles(backend, client):
+    etag = fetch(client).headers["ETag"]
+    assert client.get("/getProfileInfo?email=a@example.com").status_code == 404
+
+    record = {"plant_name": "Pueraria montana", "lat": DURHAM[0], "lng": DURHAM[1],
+              "invasive_info": True, "userEmail": "a@example.com"}
+    assert list(dataset.import_ndjson([json.dumps(record)]))[-1]["imported"] == 1
+
+    response = fetch(client)
+    assert response.headers["ETag"] != etag
+    assert json.loads(response.get_data())["total"] == 1
+    assert client.get("/getProfileInfo?email=a@example.com").get_json()["stats"]["reports"] == 1
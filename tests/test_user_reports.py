@@ -0,0 +1,61 @@
+import gzip
+import json
+
+import reports as rp
+
+EMAIL = "a@example.com"
+
+
+def store_reports(count, email=EMAIL):
+    reports = [rp.buildReport(email, f"Species {i}", "0" * 64, f"{35.0 + i:.2f}", "-78.9", "desc " * 50, True)
+               for i in range(count)]
+    return [report_id for report_id, _ in rp.storeReports(reports)]
+
+
+def test_pages_cover_every_report_once_newest_first(backend, client):
+    ids = store_reports(7)
+    store_reports(2, email="b@example.com")
+    full = client.get(f"/getUserReportsInfo?email={EMAIL}").get_json()
+    assert sorted(report["id"] for report in full) == sorted(ids)
+    created = [report["created_at"] for report in full]
+    assert created == sorted(created, reverse=True)
+
+    paged = []
+    cursor = ""
+    while True:
+        page = client.get(f"/getUserReportsInfo?email={EMAIL}&limit=3&fields=id{cursor}").get_json()
+        assert len(page["reports"]) <= 3
+        paged += [report["id"] for report in page["reports"]]
+        if not page["next_cursor"]:
+            break
+        cursor = "&cursor=" + page["next_cursor"]
+    assert paged == [report["id"] for report in full]
+
+
+def test_fields_limit_the_response(backend, client):
+    store_reports(1)
+    [report] = client.get(f"/getUserReportsInfo?email={EMAIL}&fields=id,plant_name,thumb").get_json()
+    assert set(report) == {"id", "plant_name", "thumb"}
+    assert report["thumb"] == "/image/" + "0" * 64 + "?size=thumb"
+
+    assert client.get(f"/getUserReportsInfo?email={EMAIL}&fields=password").status_code == 400
+    assert client.get(f"/getUserReportsInfo?email={EMAIL}&cursor=bogus").status_code == 400
+    assert client.get("/getUserReportsInfo").status_code == 400
+
+
+def test_etag_and_compression(memory_backend, client):
+    store_reports(5)
+    url = f"/getUserReportsInfo?email={EMAIL}&limit=5"
+    plain = client.get(url)
+    etag = plain.headers["ETag"]
+    assert etag.startswith("W/")
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    compressed = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["ETag"] == etag
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+
+    # Small bodies are sent as they are.
+    small = client.get("/getUserReportsInfo?email=nobody@example.com", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import checkinvasive as ci
+import verdictcache
+from conftest import ROOT
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return verdictcache.VerdictCache(str(tmp_path / "verdicts.db"), ttl_seconds=3600, max_entries=3)
+
+
+def test_verdicts_are_cached_by_species_and_region(cache):
+    cache.put("Pueraria  MONTANA", "35.99", "-78.9", (True, "Smothers trees."))
+    assert cache.get("pueraria montana", 35.991, -78.901) == (True, "Smothers trees.")
+    # Another region, another species.
+    assert cache.get("Pueraria montana", 47.6, -122.3) is None
+    assert cache.get("Hedera helix", 35.99, -78.9) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_expired_and_least_recently_used_entries_are_dropped(tmp_path):
+    cache = verdictcache.VerdictCache(str(tmp_path / "verdicts.db"), ttl_seconds=-1, max_entries=10)
+    cache.put("Pueraria montana", 35.99, -78.9, (True, "d"))
+    assert cache.get("Pueraria montana", 35.99, -78.9) is None
+
+    cache = verdictcache.VerdictCache(str(tmp_path / "lru.db"), ttl_seconds=3600, max_entries=2)
+    for name in ("A a", "B b", "C c"):
+        cache.put(name, 35.99, -78.9, (False, "Not Invasive"))
+    assert cache.stats()["entries"] == 2
+    assert cache.get("A a", 35.99, -78.9) is None
+
+
+def test_invalidate(cache):
+    cache.put("Pueraria montana", 35.99, -78.9, (True, "d"))
+    cache.put("Pueraria montana", 47.6, -122.3, (True, "d"))
+    cache.put("Hedera helix", 35.99, -78.9, (True, "d"))
+    assert cache.invalidate(["pueraria montana"]) == 2
+    assert cache.invalidate() == 1
+
+
+def test_lookups_do_not_wait_for_a_writer(cache):
+    cache.put("Pueraria montana", 35.99, -78.9, (True, "d"))
+    writer = sqlite3.connect(cache.path)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        assert cache.get("Pueraria montana", 35.99, -78.9) == (True, "d")
+        assert cache.get("Hedera helix", 35.99, -78.9) is None
+    finally:
+        writer.rollback()
+
+
+def test_counters_reach_the_stats_command(cache):
+    cache.put("Pueraria montana", 35.99, -78.9, (True, "d"))
+    cache.get("Pueraria montana", 35.99, -78.9)
+    cache.get("Hedera helix", 35.99, -78.9)
+    cache.flush_counters()
+
+    env = dict(os.environ, VERDICT_CACHE="on", VERDICT_CACHE_DB=cache.path)
+    output = subprocess.run([sys.executable, "verdictcache.py", "stats"], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    assert "'hits': 1, 'misses': 1" in output
+
+
+def test_unreadable_cache_is_a_miss(monkeypatch, cache):
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(cache, "_connect", locked)
+    assert cache.get("Pueraria montana", 35.99, -78.9) is None
+    cache.put("Pueraria montana", 35.99, -78.9, (True, "d"))
+
+    # create_report still gets a verdict from the classifier.
+    monkeypatch.setattr(verdictcache, "get_cache", lambda: cache)
+    monkeypatch.setattr(ci.get_batcher(), "classify", lambda plant_name, lat, lng: (True, "From the LLM."))
+    assert ci.check_invasive_plant("Pueraria montana", 35.99, -78.9) == (True, "From the LLM.")
+
+
+def test_corrupt_cache_file_disables_the_cache(monkeypatch, tmp_path):
+    path = tmp_path / "verdicts.db"
+    path.write_bytes(b"not a database" * 100)
+    monkeypatch.setenv("VERDICT_CACHE", "on")
+    monkeypatch.setenv("VERDICT_CACHE_DB", str(path))
+    monkeypatch.setattr(verdictcache, "_cache", None)
+    assert verdictcache.get_cache() is None
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+from io import BytesIO
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+import geo
+import metrics
+import storage
+
+# Density heatmap tiles of active invasive markers.
+#
+# /tiles/<species>/<z>/<x>/<y> serves a Web Mercator (slippy map) tile for one
+# species, or for every species with species "all", as a PNG heatmap or a
+# compact JSON grid. A tile is computed by reading the active markers inside
+# it through the storage backend's spatial index and binning their projected
+# coordinates into a GRID x GRID histogram with NumPy.
+#
+# Rendered tiles are cached on disk under TILE_CACHE_DIR. The files are named
+# by a hash of their content, which is also their ETag, and a SQLite index
+# maps each (species, z, x, y, format) to its current file. storeInfo and
+# markMarkerAsRemoved call invalidate() with the marker's coordinates, which
+# marks only the tiles containing it (one per zoom level, for its species and
+# for "all") as stale; they are recomputed on their next request. Each tile
+# row carries a generation that invalidate() bumps, and a computed tile is
+# only recorded if the generation it started from is still current, so a
+# write that lands while a tile is being computed is never lost. Every
+# gunicorn worker on the host shares the same directory.
+
+load_dotenv()
+
+TILE_SIZE = 256
+GRID = int(os.getenv("TILE_GRID", "64"))
+MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "16"))
+# Markers per bin that render at full intensity; the ramp is logarithmic.
+DENSITY_SCALE = float(os.getenv("TILE_DENSITY_SCALE", "50"))
+ALL_SPECIES = "all"
+FORMATS = {"png": "image/png", "json": "application/json"}
+# Latitude limit of the Web Mercator projection.
+MAX_LAT = 85.0511287798
+
+
+def tile_bbox(z, x, y):
+    """Returns the (south, west, north, east) box covered by a tile."""
+    n = 1 << z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return lat(y + 1), x / n * 360.0 - 180.0, lat(y), (x + 1) / n * 360.0 - 180.0
+
+
+def tile_for(lat, lng, z):
+    """Returns the (x, y) of the tile containing a coordinate at zoom z."""
+    n = 1 << z
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def density_grid(lats, lngs, z, x, y):
+    """
+    Bins coordinates into the GRID x GRID histogram of a tile. Row 0 is the
+    tile's northern edge, column 0 its western edge. Points outside the tile
+    are ignored.
+    """
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -MAX_LAT, MAX_LAT)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    scale = (1 << z) * GRID
+    cols = np.floor((lngs + 180.0) / 360.0 * scale).astype(np.int64) - x * GRID
+    rows = np.floor((1 - np.arcsinh(np.tan(np.radians(lats))) / np.pi) / 2 * scale).astype(np.int64) - y * GRID
+    keep = (cols >= 0) & (cols < GRID) & (rows >= 0) & (rows < GRID)
+    counts = np.bincount(rows[keep] * GRID + cols[keep], minlength=GRID * GRID)
+    return counts.reshape(GRID, GRID)
+
+
+def _palette():
+    # 256 RGBA colors: transparent for empty bins, then pale yellow to deep red.
+    ramp = np.linspace(0.0, 1.0, 255)[:, None]
+    low = np.array([255, 237, 160, 90])
+    high = np.array([189, 0, 38, 230])
+    colors = np.vstack([[0, 0, 0, 0], low + (high - low) * ramp])
+    return colors.round().astype(np.uint8)
+
+
+_PALETTE = _palette()
+
+
+def render_png(grid):
+    """Renders a density grid as a TILE_SIZE x TILE_SIZE RGBA PNG."""
+    level = np.log1p(grid) / math.log1p(DENSITY_SCALE)
+    index = np.where(grid > 0, 1 + np.minimum(level, 1.0) * 254, 0).astype(np.uint8)
+    img = Image.fromarray(_PALETTE[index], "RGBA").resize((TILE_SIZE, TILE_SIZE), Image.NEAREST)
+    buffer = BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def render_json(grid, z, x, y):
+    """
+    Renders a density grid as compact JSON: {"z", "x", "y", "size", "total",
+    "max", "cells"}, where cells is a flat [column, row, count, ...] list of
+    the non-empty bins.
+    """
+    rows, cols = np.nonzero(grid)
+    cells = np.column_stack([cols, rows, grid[rows, cols]]).ravel().tolist()
+    payload = {"z": z, "x": x, "y": y, "size": GRID, "total": int(grid.sum()),
+               "max": int(grid.max()) if grid.size else 0, "cells": cells}
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def compute_tile(species, z, x, y, tile_format):
+    """Reads the markers inside a tile and returns the rendered tile."""
+    coords = []
+    for _, data in storage.get_storage().active_in_region(tile_bbox(z, x, y), None if species == ALL_SPECIES else species):
+        lat = geo.to_float(data.get('lat_num', data.get('lat')))
+        lng = geo.to_float(data.get('lng_num', data.get('lng')))
+        if lat is not None and lng is not None:
+            coords.append((lat, lng))
+    lats, lngs = zip(*coords) if coords else ((), ())
+    grid = density_grid(lats, lngs, z, x, y)
+    if tile_format == "png":
+        return render_png(grid)
+    return render_json(grid, z, x, y)
+
+
+class TileCache:
+    def __init__(self, root):
+        self.root = root
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles ("
+                " species TEXT NOT NULL,"
+                " z INTEGER NOT NULL,"
+                " x INTEGER NOT NULL,"
+                " y INTEGER NOT NULL,"
+                " format TEXT NOT NULL,"
+                " gen INTEGER NOT NULL DEFAULT 0,"
+                " built_gen INTEGER,"
+                " etag TEXT,"
+                " PRIMARY KEY (species, z, x, y, format))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tiles_etag ON tiles (etag)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "tiles.db"), timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _path(self, etag, tile_format):
+        return os.path.join(self.root, etag[:2], f"{etag}.{tile_format}")
+
+    def lookup(self, key):
+        """
+        Returns (gen, etag) for a tile, where etag is None unless the cached
+        file is current. Registers the tile first, so an invalidation that
+        lands while the caller computes it bumps its generation.
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO tiles (species, z, x, y, format) VALUES (?, ?, ?, ?, ?)", key)
+            gen, built_gen, etag = conn.execute(
+                "SELECT gen, built_gen, etag FROM tiles WHERE species = ? AND z = ? AND x = ? AND y = ? AND format = ?",
+                key,
+            ).fetchone()
+        return gen, etag if built_gen == gen else None
+
+    def read(self, etag, tile_format):
+        """Returns a cached file's content, or None if it is missing."""
+        try:
+            with open(self._path(etag, tile_format), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, gen, body):
+        """
+        Writes a computed tile and records it as current if its tile is still
+        at generation gen. Returns the tile's ETag.
+        """
+        tile_format = key[4]
+        etag = hashlib.sha1(body).hexdigest()
+        path = self._path(etag, tile_format)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, path)
+
+        with self._connect() as conn:
+            previous = conn.execute(
+                "SELECT etag FROM tiles WHERE species = ? AND z = ? AND x = ? AND y = ? AND format = ?", key,
+            ).fetchone()
+            updated = conn.execute(
+                "UPDATE tiles SET built_gen = ?, etag = ? WHERE species = ? AND z = ? AND x = ? AND y = ?"
+                " AND format = ? AND gen = ?",
+                (gen, etag) + tuple(key) + (gen,),
+            ).rowcount
+            # Files are shared by every tile with the same content (empty tiles
+            # especially), so the old one is only deleted once nothing uses it.
+            orphan = None
+            if updated and previous and previous[0] and previous[0] != etag:
+                if conn.execute("SELECT 1 FROM tiles WHERE etag = ? LIMIT 1", (previous[0],)).fetchone() is None:
+                    orphan = previous[0]
+        if orphan:
+            try:
+                os.remove(self._path(orphan, tile_format))
+            except FileNotFoundError:
+                pass
+        return etag
+
+    def invalidate(self, tiles):
+        """Marks the given (species, z, x, y) tiles as stale in every format."""
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE tiles SET gen = gen + 1 WHERE species = ? AND z = ? AND x = ? AND y = ?", tiles,
+            )
+
+    def stats(self):
+        row = self._connect().execute(
+            "SELECT COUNT(*), SUM(built_gen IS NOT NULL AND built_gen = gen) FROM tiles"
+        ).fetchone()
+        return {"tiles": row[0], "current": row[1] or 0}
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns this process's tile cache, or None if TILE_CACHE=off (every
+    request then computes its tile).
+
+    Environment:
+        TILE_CACHE_DIR: Directory for cached tiles and their index (default tile_cache).
+        TILE_GRID: Bins per tile side (default 64).
+        TILE_MAX_ZOOM: Highest zoom served (default 16).
+        TILE_DENSITY_SCALE: Markers per bin drawn at full intensity (default 50).
+    """
+    global _cache, _cache_pid
+    if os.getenv("TILE_CACHE", "on").lower() == "off":
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = TileCache(os.getenv("TILE_CACHE_DIR", "tile_cache"))
+            _cache_pid = os.getpid()
+        return _cache
+
+
+def get_tile(species, z, x, y, tile_format):
+    """
+    Returns (body, etag) for a tile, from the disk cache when it is current.
+
+    Raises:
+        ValueError: If the format, zoom or tile coordinates are out of range.
+    """
+    if tile_format not in FORMATS:
+        raise ValueError("format must be one of png, json")
+    if not 0 <= z <= MAX_ZOOM:
+        raise ValueError(f"zoom must be between 0 and {MAX_ZOOM}")
+    if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise ValueError("tile is outside the map")
+
+    cache = get_cache()
+    if cache is None:
+        body = compute_tile(species, z, x, y, tile_format)
+        return body, hashlib.sha1(body).hexdigest()
+
+    key = (species, z, x, y, tile_format)
+    gen, etag = cache.lookup(key)
+    if etag is not None:
+        body = cache.read(etag, tile_format)
+        if body is not None:
+            metrics.inc("tile_requests_total", result="hit")
+            return body, etag
+    metrics.inc("tile_requests_total", result="miss")
+    with metrics.timer("tile_render_duration_seconds", "tile-render"):
+        body = compute_tile(species, z, x, y, tile_format)
+    return body, cache.store(key, gen, body)
+
+
+def invalidate(lat, lng, species):
+    """
+    Marks the tiles containing a marker as stale, at every zoom level, for
+    its species and for "all". Call it after a write that adds, removes or
+    restores an active marker.
+    """
+    cache = get_cache()
+    lat = geo.to_float(lat)
+    lng = geo.to_float(lng)
+    if cache is None or lat is None or lng is None:
+        return
+    tiles = []
+    for z in range(MAX_ZOOM + 1):
+        x, y = tile_for(lat, lng, z)
+        tiles.append((species, z, x, y))
+        tiles.append((ALL_SPECIES, z, x, y))
+    try:
+        cache.invalidate(tiles)
+    except sqlite3.Error as e:
+        print(f"Error invalidating density tiles: {e}")
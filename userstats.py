@@ -0,0 +1,145 @@
+from google.cloud import firestore
+
+# Per-user report statistics, kept on the user's profile.
+#
+# Profiles are keyed by email: the 'users' document ID is profile_key(email),
+# so a profile view is one document read. Each profile holds a 'stats' map
+# with the user's report count, invasive count, removed count, per-species
+# report counts (whose size is the species diversity) and the time of their
+# latest report. Every storage write that adds a report or flips its removed
+# flag applies +1/-1 increments to the stats in the same batch or transaction
+# (see firestore_storage.py and sqlite_storage.py), so they never need to be
+# recomputed from the user's reports.
+#
+# A report counts for its owner and for every other reporter merged into it
+# as a sighting (see sightings.py); removals count against the owner only.
+#
+# to rebuild every user's stats from scratch: python userstats.py
+
+from firebase_client import db
+
+COLLECTION = 'users'
+
+
+def profile_key(email):
+    """Returns the 'users' document ID for an email ('/' cannot appear in an ID)."""
+    return email.replace('%', '%25').replace('/', '%2F')
+
+
+def _totals(deltas, email):
+    return deltas.setdefault(email, {'reports': 0, 'invasive': 0, 'removed': 0, 'species': {}})
+
+
+def accumulate(deltas, plant_data):
+    """
+    Adds one report's contribution to a {email: totals} dictionary, so a
+    batch of reports is applied with a single write per user (see apply).
+    """
+    owner = plant_data.get('userEmail')
+    for email in dict.fromkeys([owner] + list(plant_data.get('reporters') or [])):
+        if not email:
+            continue
+        total = _totals(deltas, email)
+        total['reports'] += 1
+        if plant_data.get('invasive_info') is True:
+            total['invasive'] += 1
+        name = plant_data.get('plant_name')
+        if name:
+            total['species'][name] = total['species'].get(name, 0) + 1
+        if email == owner and plant_data.get('removed') is True:
+            total['removed'] += 1
+
+
+def count_removed(deltas, email, delta=1):
+    """Adds (delta=1) or subtracts (delta=-1) one removed report of the user."""
+    if email:
+        _totals(deltas, email)['removed'] += delta
+
+
+def add_totals(stats, total, now):
+    """
+    Returns stats with a user's accumulated totals added, for backends that
+    update the stats with a read and a write. now becomes last_report_at if
+    the totals include new reports.
+    """
+    stats = dict(stats or {})
+    for field in ('reports', 'invasive', 'removed'):
+        stats[field] = stats.get(field, 0) + total[field]
+    species = dict(stats.get('species') or {})
+    for name, n in total['species'].items():
+        species[name] = species.get(name, 0) + n
+    stats['species'] = species
+    if total['reports'] > 0:
+        stats['last_report_at'] = now
+    return stats
+
+
+def apply(batch, client, deltas):
+    """Writes accumulated totals, one merge per user, into the batch or transaction."""
+    for email, total in deltas.items():
+        stats = {
+            'reports': firestore.Increment(total['reports']),
+            'invasive': firestore.Increment(total['invasive']),
+            'removed': firestore.Increment(total['removed']),
+            'species': {name: firestore.Increment(n) for name, n in total['species'].items()},
+        }
+        if total['reports'] > 0:
+            stats['last_report_at'] = firestore.SERVER_TIMESTAMP
+        batch.set(client.collection(COLLECTION).document(profile_key(email)),
+                  {'email': email, 'stats': stats}, merge=True)
+
+
+def summary(stats):
+    """
+    Returns the public form of a profile's 'stats' map:
+    {"reports", "invasive", "removed", "species", "last_report_at"} where
+    species is the number of distinct species reported.
+    """
+    stats = stats or {}
+    return {
+        'reports': stats.get('reports', 0),
+        'invasive': stats.get('invasive', 0),
+        'removed': stats.get('removed', 0),
+        'species': sum(1 for n in (stats.get('species') or {}).values() if n > 0),
+        'last_report_at': stats.get('last_report_at'),
+    }
+
+
+def rebuild():
+    """
+    Recomputes every user's stats from 'plant_info'. Profiles of users
+    without reports are left as they are.
+
+    Returns:
+        The number of users updated.
+    """
+    deltas = {}
+    latest = {}
+    fields = ['userEmail', 'reporters', 'plant_name', 'invasive_info', 'removed', 'created_at']
+    for doc in db.collection('plant_info').select(fields).stream():
+        data = doc.to_dict()
+        accumulate(deltas, data)
+        created_at = data.get('created_at')
+        for email in [data.get('userEmail')] + list(data.get('reporters') or []):
+            if email and created_at and (email not in latest or created_at > latest[email]):
+                latest[email] = created_at
+
+    batch = db.batch()
+    pending = 0
+    for email, total in deltas.items():
+        ref = db.collection(COLLECTION).document(profile_key(email))
+        # update() replaces the whole map, dropping species counted before.
+        batch.set(ref, {'email': email}, merge=True)
+        batch.update(ref, {'stats': dict(total, last_report_at=latest.get(email))})
+        pending += 2
+        if pending >= 400:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return len(deltas)
+
+
+if __name__ == "__main__":
+    print(f"Rebuilt stats for {rebuild()} users.")
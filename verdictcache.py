@@ -0,0 +1,299 @@
+import argparse
+import atexit
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import geo
+import metrics
+
+# Persistent cache of invasive-species verdicts.
+#
+# Whether a species is invasive barely changes within a region, so verdicts
+# are cached by (normalized species name, coarse geohash cell) in a SQLite
+# file. Every gunicorn worker on the host opens the same file, and the cache
+# survives restarts. Entries expire after a TTL and the least recently used
+# ones are evicted once the table is over its size limit.
+#
+# Lookups only read the file. Hit and miss counts are kept in process and
+# added to a counters table in the same file at most every
+# VERDICT_CACHE_COUNTER_FLUSH seconds (and at exit), so the stats command
+# sees the totals of every worker. A cache file that cannot be read or
+# written (locked, corrupt) counts as a miss; the verdict is then asked for.
+#
+# to run: python verdictcache.py stats|invalidate|prewarm ...
+
+load_dotenv()
+
+# Geohash precision of the region cell; 3 characters is roughly 156km x 156km.
+REGION_PRECISION = int(os.getenv("VERDICT_REGION_PRECISION", "3"))
+
+# Hits only refresh accessed_at when it is older than this, so hot rows are not rewritten on every hit.
+_TOUCH_INTERVAL = 60.0
+COUNTER_FLUSH_INTERVAL = float(os.getenv("VERDICT_CACHE_COUNTER_FLUSH", "30"))
+
+
+def normalize_species(plant_name):
+    """Lower-cases a species name and collapses whitespace."""
+    return re.sub(r"\s+", " ", (plant_name or "").strip()).lower()
+
+
+def region_key(lat, lng):
+    """
+    Returns the coarse region cell for a coordinate, or "" if it cannot be parsed.
+    """
+    lat = geo.to_float(lat)
+    lng = geo.to_float(lng)
+    if lat is None or lng is None:
+        return ""
+    return geo.encode(lat, lng, REGION_PRECISION)
+
+
+class VerdictCache:
+    def __init__(self, path, ttl_seconds, max_entries):
+        self.path = path
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        # Lookups by this process, and those not yet added to the counters table.
+        self.hits = 0
+        self.misses = 0
+        self._unflushed = {"hits": 0, "misses": 0}
+        self._flushed_at = time.monotonic()
+        self._counter_lock = threading.Lock()
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                " species TEXT NOT NULL,"
+                " region TEXT NOT NULL,"
+                " invasive INTEGER NOT NULL,"
+                " description TEXT,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (species, region))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS verdicts_accessed_at ON verdicts (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('hits', 0), ('misses', 0)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        metrics.inc("verdict_cache_lookups_total", result="hit" if hit else "miss")
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+                self._unflushed["hits"] += 1
+            else:
+                self.misses += 1
+                self._unflushed["misses"] += 1
+            due = time.monotonic() - self._flushed_at >= COUNTER_FLUSH_INTERVAL
+        if due:
+            self.flush_counters()
+
+    def flush_counters(self):
+        """Adds this process's lookups since the last flush to the counters table."""
+        with self._counter_lock:
+            counts = self._unflushed
+            self._unflushed = {"hits": 0, "misses": 0}
+            self._flushed_at = time.monotonic()
+        if not any(counts.values()):
+            return
+        try:
+            with self._connect() as conn:
+                conn.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                 [(n, name) for name, n in counts.items()])
+        except sqlite3.Error as e:
+            print(f"Error saving verdict cache counters: {e}")
+            with self._counter_lock:
+                for name, n in counts.items():
+                    self._unflushed[name] += n
+
+    def get(self, plant_name, lat, lng):
+        """
+        Returns the cached (is_invasive, description) tuple, or None on a miss
+        or if the cache file cannot be read.
+        """
+        species = normalize_species(plant_name)
+        region = region_key(lat, lng)
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT invasive, description, accessed_at FROM verdicts"
+                " WHERE species = ? AND region = ? AND created_at > ?",
+                (species, region, now - self.ttl),
+            ).fetchone()
+            if row is not None and now - row[2] > _TOUCH_INTERVAL:
+                with conn:
+                    conn.execute(
+                        "UPDATE verdicts SET accessed_at = ? WHERE species = ? AND region = ?",
+                        (now, species, region),
+                    )
+        except sqlite3.Error as e:
+            print(f"Error reading the verdict cache: {e}")
+            row = None
+        self._count(row is not None)
+        return (bool(row[0]), row[1]) if row is not None else None
+
+    def put(self, plant_name, lat, lng, verdict):
+        """
+        Stores a verdict tuple, then drops expired entries and evicts the least
+        recently used ones beyond max_entries. Errors writing the cache file
+        are logged and otherwise ignored.
+        """
+        try:
+            self._put(plant_name, lat, lng, verdict)
+        except sqlite3.Error as e:
+            print(f"Error writing the verdict cache: {e}")
+
+    def _put(self, plant_name, lat, lng, verdict):
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts"
+                " (species, region, invasive, description, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (normalize_species(plant_name), region_key(lat, lng), int(bool(verdict[0])), verdict[1], now, now),
+            )
+            conn.execute("DELETE FROM verdicts WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM verdicts WHERE rowid IN ("
+                " SELECT rowid FROM verdicts ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def invalidate(self, species_list=None):
+        """
+        Removes cached verdicts for the given species (in every region), or
+        every entry when species_list is None.
+
+        Returns:
+            The number of entries removed.
+        """
+        conn = self._connect()
+        with conn:
+            if species_list is None:
+                return conn.execute("DELETE FROM verdicts").rowcount
+            removed = 0
+            for plant_name in species_list:
+                removed += conn.execute(
+                    "DELETE FROM verdicts WHERE species = ?", (normalize_species(plant_name),)
+                ).rowcount
+            return removed
+
+    def stats(self):
+        """
+        Returns the hit/miss counters of every process using the file (as of
+        their last flush) and the number of stored entries.
+        """
+        self.flush_counters()
+        conn = self._connect()
+        entries = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide verdict cache, or None if VERDICT_CACHE=off.
+
+    Environment:
+        VERDICT_CACHE_DB: SQLite file (default verdict_cache.db).
+        VERDICT_CACHE_TTL: Seconds before a verdict expires (default 30 days).
+        VERDICT_CACHE_MAX: Maximum number of cached verdicts (default 50000).
+        VERDICT_CACHE_COUNTER_FLUSH: Seconds between writes of the hit/miss
+            counters to the cache file (default 30).
+    """
+    global _cache
+    if os.getenv("VERDICT_CACHE", "on").lower() == "off":
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = VerdictCache(
+                    os.getenv("VERDICT_CACHE_DB", "verdict_cache.db"),
+                    float(os.getenv("VERDICT_CACHE_TTL", str(30 * 24 * 3600))),
+                    int(os.getenv("VERDICT_CACHE_MAX", "50000")),
+                )
+            except sqlite3.Error as e:
+                # Classify without the cache; opening it is retried on the next call.
+                print(f"Error opening the verdict cache: {e}")
+                return None
+            atexit.register(_cache.flush_counters)
+        return _cache
+
+
+def prewarm(species_list, lat, lng):
+    """
+    Fills the cache for each species at the given coordinates by asking the
+    classifier for any that are not cached yet. Species the bundled index
+    answers are skipped.
+
+    Returns:
+        The number of species that were classified.
+    """
+    import checkinvasive as ci
+    import invasiveindex
+
+    classified = 0
+    cache = get_cache()
+    for plant_name in species_list:
+        if cache is not None and cache.get(plant_name, lat, lng) is not None:
+            continue
+        listing = invasiveindex.lookup(plant_name, lat, lng)
+        if listing is not None and listing.description:
+            continue
+        try:
+            ci.check_invasive_plant(plant_name, lat, lng)
+        except ci.ClassificationFailed as e:
+            print(f"Could not classify {plant_name}: {e}")
+            continue
+        classified += 1
+    return classified
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the invasive verdict cache.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats")
+    invalidate_parser = commands.add_parser("invalidate")
+    invalidate_parser.add_argument("species", nargs="*", help="Species to drop (all if omitted)")
+    prewarm_parser = commands.add_parser("prewarm")
+    prewarm_parser.add_argument("lat")
+    prewarm_parser.add_argument("lng")
+    prewarm_parser.add_argument("species", nargs="+")
+    args = parser.parse_args()
+
+    cache = get_cache()
+    if cache is None:
+        print("The verdict cache is disabled (VERDICT_CACHE=off).")
+    elif args.command == "stats":
+        print(cache.stats())
+    elif args.command == "invalidate":
+        print(f"Removed {cache.invalidate(args.species or None)} entries.")
+    else:
+        print(f"Classified {prewarm(args.species, args.lat, args.lng)} species.")